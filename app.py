@@ -1,37 +1,222 @@
-import ee
+import dataclasses
+import os
+import time
+
 import streamlit as st
+from dotenv import load_dotenv
 from streamlit_folium import st_folium
-from shapely.geometry import Polygon, box
 
-from geopeto.geocoder import Geocoder
-from geopeto.geodescriber import GeoDescriber
-from geopeto.visualize import foliumMapGEE, create_stacked_bar
-from geopeto.processing import ZonalStatistics
+from geopeto.visualize import foliumMapGEE, create_stacked_bar, create_change_chart, create_transition_table, \
+    create_statistics_table
+from geopeto.pipeline import AnalysisPipeline
 from geopeto.data import GEEData
-
-ee.Initialize()
+from geopeto.cache import ResultCache
+from geopeto.tiles import TileCache, TileProxy
+from geopeto.backends import LocalRasterBackend
+from geopeto.integral import IntegralIndexBackend
+from geopeto.geocoder import OfflineGeocoder
+from geopeto import execution, jobs, metrics
+from geopeto.admission import AdmissionController
+from geopeto.adaptive import AdaptiveResolution
+from geopeto.geometry import prepare_aoi, read_geojson
+from geopeto.timeseries import LandCoverChange
+from geopeto.session import SessionMemo
+from geopeto.incremental import LastAOI
+from geopeto.jobs import JobManager
+from geopeto.tiles import MAP_ID_TTL
+from geopeto.render import TileRenderer
+
+load_dotenv()  # take environment variables from .env.
+
+# Earth Engine and OpenAI are initialised on first use, see geopeto.resources
 
 MAP_CENTER = [25.0, 55.0]
 MAP_ZOOM = 3
 
+# set GEOPETO_CONTINUOUS_DATASETS=Elevation,NDVI,Precipitation to add the statistics of these datasets to
+# the analysis, they are reduced in the same Earth Engine request as the land cover and climate
+CONTINUOUS_DATASETS = [d for d in os.getenv("GEOPETO_CONTINUOUS_DATASETS", "").split(",") if d]
+
 MAX_ALLOWED_AREA_SIZE = 25.0
+# larger areas, up to this size, are reduced at native resolution in parallel tiles
+MAX_TILED_AREA_SIZE = 2500.0
+TILE_SIZE = 5.0
+# requests are admitted by the pixels they reduce at native scale, summed over the datasets
+REQUEST_PIXEL_BUDGET = 5e6
+TILED_PIXEL_BUDGET = 5e8
+SESSION_PIXEL_BUDGET = 5e7
+# in fast mode the first answer is reduced at the scale expected to take this many seconds,
+# then refined at the finest scale within the request budget in the background
+LATENCY_TARGET = float(os.getenv("GEOPETO_LATENCY_TARGET", "3"))
+ZS_CACHE_PATH = ".cache/zonal_statistics.json"
+ZS_CACHE_SIZE = 1024
+ZS_CACHE_GRID = 0.01
+DESCRIPTION_CACHE_PATH = ".cache/descriptions.json"
+DESCRIPTION_CACHE_SIZE = 512
+# set GEOPETO_BACKEND=local to compute the statistics from local copies of the rasters,
+# or GEOPETO_BACKEND=integral to answer them from the integral image indexes built from those copies
+ZS_BACKEND = os.getenv("GEOPETO_BACKEND", "ee")
+RASTER_PATHS = {
+    'Global-Land-Cover': os.getenv("GEOPETO_LAND_COVER_RASTER", "data/ESA_landcover_ipcc_2018.tif"),
+    'Koppen-Geiger-Climate': os.getenv("GEOPETO_CLIMATE_RASTER", "data/Global_19862010_KG_5m.tif"),
+}
+INDEX_DIRS = {
+    'Global-Land-Cover': os.getenv("GEOPETO_LAND_COVER_INDEX", "data/index/Global-Land-Cover"),
+    'Koppen-Geiger-Climate': os.getenv("GEOPETO_CLIMATE_INDEX", "data/index/Koppen-Geiger-Climate"),
+}
+# set GEOPETO_GEOCODER=offline to resolve regions from local admin boundaries instead of Nominatim
+GEOCODER = os.getenv("GEOPETO_GEOCODER", "nominatim")
+ADMIN1_PATH = os.getenv("GEOPETO_ADMIN1_PATH", "data/ne_10m_admin_1_states_provinces.geojson")
+ADMIN0_PATH = os.getenv("GEOPETO_ADMIN0_PATH", "data/ne_10m_admin_0_countries.geojson")
+# set GEOPETO_TILE_PROXY=1 to serve the map tiles through a local caching proxy
+TILE_PROXY_ENABLED = os.getenv("GEOPETO_TILE_PROXY", "0") == "1"
+# the proxy listens on the loopback interface unless GEOPETO_TILE_PROXY_HOST is set, e.g. to 0.0.0.0, and
+# browsers reach it at http://<host>:<port> unless GEOPETO_TILE_PROXY_URL is set
+TILE_PROXY_HOST = os.getenv("GEOPETO_TILE_PROXY_HOST", "127.0.0.1")
+TILE_PROXY_PORT = int(os.getenv("GEOPETO_TILE_PROXY_PORT", "8765"))
+TILE_PROXY_URL = os.getenv("GEOPETO_TILE_PROXY_URL")
+# set GEOPETO_MAP_TILES=local to render the map layer from the local rasters, through the tile proxy
+MAP_TILES = os.getenv("GEOPETO_MAP_TILES", "ee")
+TILE_CACHE_DIR = ".cache/tiles"
+TILE_CACHE_MAX_BYTES = 1024 ** 3
+# set GEOPETO_METRICS_PORT to serve Prometheus metrics, or GEOPETO_METRICS_FILE to write them after every request
+METRICS_PORT = os.getenv("GEOPETO_METRICS_PORT")
+METRICS_FILE = os.getenv("GEOPETO_METRICS_FILE")
+# analyses running at the same time, and seconds between two polls of a job
+MAX_JOBS = int(os.getenv("GEOPETO_MAX_JOBS", "4"))
+POLL_INTERVAL = 0.25
+# seconds an Earth Engine request may take, and retries of its transient and quota errors
+EE_TIMEOUT = float(os.getenv("GEOPETO_EE_TIMEOUT", "60"))
+EE_RETRIES = int(os.getenv("GEOPETO_EE_RETRIES", "3"))
+# set GEOPETO_DEBUG_PANEL=1 to show the stage timings of the last request in the sidebar
+DEBUG_PANEL = os.getenv("GEOPETO_DEBUG_PANEL", "0") == "1"
+# first year of the land cover change analysis until the user picks another one
+CHANGE_FIRST_YEAR = 2015
 BTN_LABEL_COMPUTE = "Compute Zonal Statistics"
+BTN_LABEL_CHANGE = "Compute Land Cover Change"
+LABEL_UPLOAD = "Upload a GeoJSON region"
+LABEL_FAST_MODE = "Fast preview, refined in the background"
+
+
+@st.cache_resource
+def get_zs_cache() -> ResultCache:
+    # persisted across restarts
+    return ResultCache(maxsize=ZS_CACHE_SIZE, path=ZS_CACHE_PATH)
+
+
+@st.cache_resource
+def get_description_cache() -> ResultCache:
+    return ResultCache(maxsize=DESCRIPTION_CACHE_SIZE, path=DESCRIPTION_CACHE_PATH)
+
+
+@st.cache_resource
+def get_tile_proxy():
+    if not TILE_PROXY_ENABLED and MAP_TILES != "local":
+        return None
+    cache = TileCache(TILE_CACHE_DIR, max_bytes=TILE_CACHE_MAX_BYTES)
+    return TileProxy(cache, host=TILE_PROXY_HOST, port=TILE_PROXY_PORT, public_url=TILE_PROXY_URL).start()
+
+
+@st.cache_resource
+def get_land_cover_change() -> LandCoverChange:
+    return LandCoverChange('Global-Land-Cover', cache=get_zs_cache(), cache_grid=ZS_CACHE_GRID)
+
+
+@st.cache_resource
+def get_tile_renderer():
+    return TileRenderer(RASTER_PATHS) if MAP_TILES == "local" else None
+
+
+@st.cache_resource
+def get_backend():
+    if ZS_BACKEND == "local":
+        return LocalRasterBackend(RASTER_PATHS)
+    elif ZS_BACKEND == "integral":
+        return IntegralIndexBackend(INDEX_DIRS, raster_paths=RASTER_PATHS)
+    return None
+
+
+@st.cache_resource
+def get_geocoder():
+    if GEOCODER == "offline":
+        return OfflineGeocoder(ADMIN1_PATH, ADMIN0_PATH)
+    return None
+
+
+@st.cache_resource
+def start_metrics_server():
+    # once per process, the port cannot be bound again by later sessions
+    if METRICS_PORT:
+        metrics.start_server(int(METRICS_PORT))
+
+
+@st.cache_resource
+def configure_execution():
+    # before Earth Engine is initialised, which sets the deadline of its client to the same timeout
+    return execution.configure(timeout=EE_TIMEOUT, retries=EE_RETRIES)
 
 
-def _get_bbox(geojson: dict) -> box:
-    # Create a Shapely polygon from the coordinates
-    poly = Polygon(geojson['geometry']['coordinates'][0])
-    # Get the bbox coordinates using the bounds() method
-    min_x, min_y, max_x, max_y = poly.bounds
-    # Create the box object using the box() function
-    shapely_box = box(min_x, min_y, max_x, max_y)
+@st.cache_resource
+def get_datasets() -> dict:
+    datasets = {}
+    for dataset in ['Global-Land-Cover', 'Koppen-Geiger-Climate'] + CONTINUOUS_DATASETS:
+        datasets[dataset] = GEEData(dataset)
+    return datasets
 
-    return shapely_box
 
+@st.cache_resource
+def get_pipeline() -> AnalysisPipeline:
+    return AnalysisPipeline(get_datasets(), MAX_ALLOWED_AREA_SIZE, cache=get_zs_cache(), cache_grid=ZS_CACHE_GRID,
+                            backend=get_backend(), max_tiled_area_size=MAX_TILED_AREA_SIZE, tile_size=TILE_SIZE,
+                            geocoder=get_geocoder(), description_cache=get_description_cache())
 
-datasets = {}
-for dataset in ['Global-Land-Cover', 'Koppen-Geiger-Climate']:
-    datasets[dataset] = GEEData(dataset)
+
+@st.cache_resource
+def get_jobs() -> JobManager:
+    return JobManager(get_pipeline(), max_jobs=MAX_JOBS)
+
+
+def describe_job(job) -> str:
+    seconds = time.monotonic() - job.submitted
+    shared = f", shared with {job.waiters - 1} other session{'s' if job.waiters > 2 else ''}" if job.waiters > 1 else ""
+    return f"{job.status.capitalize()} for {seconds:.0f} s{shared}."
+
+
+def get_map(uploaded) -> foliumMapGEE:
+    # reruns of the page reuse the map of the session, until the uploaded region changes or the map id
+    # of the layer is due to be refreshed
+    maps = SessionMemo(st.session_state, 'maps', maxsize=1)
+    key = {'uploaded': uploaded, 'map_id_period': int(time.time() // MAP_ID_TTL)}
+    m = maps.get(key)
+    if m is not None:
+        return m
+
+    m = foliumMapGEE(center=MAP_CENTER, zoom=MAP_ZOOM)
+
+    if get_tile_renderer() is not None:
+        m.add_local_layer(get_tile_renderer(), 'Global-Land-Cover', tile_proxy=get_tile_proxy())
+    else:
+        m.add_gee_layer(
+            image=datasets['Global-Land-Cover'].ee_image(),
+            sld_interval=datasets['Global-Land-Cover'].sld_interval(),
+            name='Global-Land-Cover',
+            tile_proxy=get_tile_proxy()
+        )
+
+    if uploaded is not None:
+        m.add_aoi(uploaded)
+
+    m.add_layer_control()
+    maps.set(key, m)
+    return m
+
+
+configure_execution()
+datasets = get_datasets()
+
+admission = AdmissionController(datasets, request_budget=REQUEST_PIXEL_BUDGET, tiled_budget=TILED_PIXEL_BUDGET,
+                                session_budget=SESSION_PIXEL_BUDGET)
+adaptive = AdaptiveResolution(admission, latency_budget=LATENCY_TARGET)
 
 if __name__ == "__main__":
     st.set_page_config(
@@ -50,18 +235,28 @@ if __name__ == "__main__":
     )
 
     st.write("\n")
-    
-    m = foliumMapGEE(center=MAP_CENTER, zoom=MAP_ZOOM)
-    
-    m.add_gee_layer(
-        image=datasets['Global-Land-Cover'].ee_image(),
-        sld_interval=datasets['Global-Land-Cover'].sld_interval(),
-        name='Global-Land-Cover'
-    )
-    
-    m.add_layer_control()
-    
-    output = st_folium(m, key="init", width=1300, height=600)
+
+    start_metrics_server()
+
+    # ensure progress bar resides at top of sidebar and is invisible initially
+    progress_bar = st.sidebar.progress(0)
+    progress_bar.empty()
+    # and the state of the job of the session under it
+    status_container = st.sidebar.empty()
+
+    uploaded = None
+    uploaded_file = st.sidebar.file_uploader(LABEL_UPLOAD, type=["geojson", "json"])
+    if uploaded_file is not None:
+        try:
+            uploaded = read_geojson(uploaded_file.getvalue())
+        except ValueError as e:
+            st.sidebar.warning(f"The uploaded file cannot be read: {e}")
+
+    m = get_map(uploaded)
+
+    # only drawing triggers a rerun, panning and zooming the map stay in the browser
+    output = st_folium(m, key="init", width=1300, height=600,
+                       returned_objects=["all_drawings", "last_active_drawing"])
 
     geojson = None
     if output["all_drawings"] is not None:
@@ -70,10 +265,9 @@ if __name__ == "__main__":
                 # get latest modified drawing
                 geojson = output["last_active_drawing"]
 
-
-    # ensure progress bar resides at top of sidebar and is invisible initially
-    progress_bar = st.sidebar.progress(0)
-    progress_bar.empty()
+    # a drawn region takes precedence over an uploaded one
+    if geojson is None and uploaded is not None:
+        geojson = {"type": "Feature", "properties": {}, "geometry": uploaded}
 
     # Getting Started container
     with st.sidebar.container():
@@ -81,7 +275,7 @@ if __name__ == "__main__":
             f"""
             # Getting Started
             1. Click the black square on the map
-            2. Draw a rectangle on the map
+            2. Draw a rectangle or polygon on the map, or upload a GeoJSON file
             3. Click on <kbd>{BTN_LABEL_COMPUTE}</kbd>
             """,
             unsafe_allow_html=True,
@@ -92,66 +286,194 @@ if __name__ == "__main__":
 
         # Create an empty container for the plotly figure
         fig_container = st.empty()
-
-        # Add the button and its callback
-        if st.button(
-            BTN_LABEL_COMPUTE,
-            key="compute_zs",
-            disabled=False if geojson is not None else True,
-        ):
-            #data = datasets['Koppen-Geiger-Climate']
-            top = {}
-            for dataset, data in datasets.items():
-                zs = ZonalStatistics(data, MAX_ALLOWED_AREA_SIZE)
-
-                # Call the zs.check_area_and_compute function to get the plotly figure
-                stats = zs.check_area_and_compute(geojson=geojson)
-
-                # sort the items from top to bottom and take the top 8 elements
-                top_8 = sorted(stats.items(), key=lambda x: x[1], reverse=True)[:8]
-                top_8 = {k: v for k, v in top_8}
-
-                top[dataset] = top_8
-
-                if dataset == 'Global-Land-Cover':
-                    # Update the empty container with the plotly figure
-                    colors = {data.class_names()[key]: item for key, item in
-                              data.class_colors().items()}
-
-                    fig = create_stacked_bar(values=stats, colors=colors)
-                    fig_container.plotly_chart(fig, use_container_width=True)
-
-            # Update the empty container with the description of the region
-            bbox = _get_bbox(geojson=geojson)
-
-            # create Geocoder object
-            geolocator = Geocoder(user_agent="my-app")
-
-            # reverse geocode center point of box to get region and country
-            center_point = bbox.centroid
-            region, country = geolocator.reverse_geocode(center_point)
-
-            print("Region: ", region)
-            print("Country: ", country)
-
-            # geodescribe the region with OpenAI API
-            geo_describer = GeoDescriber(model_name="text-davinci-003")
-            description = geo_describer.generate_description(
-                land_cover_per=top['Global-Land-Cover'],
-                climate_per=top['Koppen-Geiger-Climate'],
-                region_name=region,
-                country=country
-            )
-
+        # and one for the scale the figure was computed at
+        scale_container = st.empty()
+        # and one for the statistics of the continuous datasets
+        statistics_container = st.empty()
+
+        fast_mode = st.checkbox(LABEL_FAST_MODE, key="fast_mode")
+
+        # results of the session by region, shown again by the reruns that do not change the region
+        results = SessionMemo(st.session_state, 'results')
+
+        def describe_scale(plan) -> str:
+            if plan is None or plan.execution == 'native':
+                return "Scale chosen by Earth Engine."
+            return f"Computed at: {plan.describe()}."
+
+        def describe_path(result) -> str:
+            if not result.path:
+                return describe_scale(result.plan)
+            return f"{describe_scale(result.plan)} From: {result.path}."
+
+        def charge(pixels):
+            st.session_state['spent_pixels'] = st.session_state.get('spent_pixels', 0.) + pixels
+
+        def show_chart(result, fig=None):
+            # Update the empty container with the plotly figure
+            if fig is None:
+                colors = datasets['Global-Land-Cover'].spec.colors_by_name
+                fig = create_stacked_bar(values=result.stats['Global-Land-Cover'], colors=colors)
+            fig_container.plotly_chart(fig, use_container_width=True)
+            scale_container.caption(describe_path(result))
+            if CONTINUOUS_DATASETS:
+                table = create_statistics_table(
+                    {dataset: result.stats[dataset] for dataset in CONTINUOUS_DATASETS},
+                    {dataset: datasets[dataset].spec.unit for dataset in CONTINUOUS_DATASETS})
+                statistics_container.dataframe(table, use_container_width=True)
+            return fig
+
+        def show_description(description):
             text_container.markdown(
                 f"""
                 **Description of the region:**
-                
+
                 {description}
                 """,
                 unsafe_allow_html=True,
             )
 
+        def analyse(plan):
+            # the region checks write to the sidebar, so they run here rather than in the job
+            if not get_pipeline().check_region(geojson['geometry'], plan):
+                return
+            # zonal statistics and reverse geocoding run concurrently in a job shared by the sessions analysing
+            # the same region, the description waits for both and is shown word by word as it is generated
+            job, coalesced = get_jobs().analyse(geojson, plan,
+                                                last_aoi=st.session_state.setdefault('last_aoi', LastAOI()))
+            st.session_state['job'] = {'id': job.id, 'geojson': geojson, 'plan': plan, 'coalesced': coalesced}
+
+        def show_stats(result, geometry):
+            # it is important to spawn these messages in the sidebar, because state will get lost otherwise
+            if result.failed:
+                st.sidebar.error(f"Zonal Statistics could not be computed ({result.path}), please try again later.")
+                return
+            st.sidebar.success("Successfully computed Zonal Statistics!")
+            # the description is added to the same result once it is generated
+            results.set(geometry, {'result': result, 'fig': show_chart(result)})
+
+        def follow() -> bool:
+            # show the job of the session as it is now, True while the page should rerun to poll it again
+            state = st.session_state.get('job')
+            if state is None:
+                return False
+            job = get_jobs().get(state['id'])
+            if job is None:
+                # expired, or lost with a restart of the process
+                del st.session_state['job']
+                return False
+
+            # the job of a region no longer on the page is not polled, it is finished by a later rerun
+            geometry = state['geojson']['geometry']
+            visible = geojson is not None and geojson['geometry'] == geometry
+            # read first, everything else is complete once the job is done
+            done = job.done
+            shown_stats = False
+            if visible:
+                if not done:
+                    status_container.caption(describe_job(job))
+                    if job.progress:
+                        progress_bar.progress(job.progress)
+                if job.kind == 'analyse' and job.result is not None:
+                    show_stats(job.result, geometry)
+                    shown_stats = True
+                if job.kind == 'analyse' and job.text:
+                    show_description(job.text)
+            if not done:
+                return visible
+
+            del st.session_state['job']
+            if job.kind == 'analyse':
+                return finish_analysis(state, job, visible, shown_stats=shown_stats)
+            finish_refinement(state, job, visible)
+            return False
+
+        def finish_analysis(state, job, visible, shown_stats) -> bool:
+            aoi, plan, result = state['geojson'], state['plan'], job.result
+            if job.status == jobs.FAILED:
+                if visible:
+                    st.sidebar.error(f"Zonal Statistics could not be computed ({job.error}), please try again later.")
+                return False
+            if visible and not shown_stats:
+                show_stats(result, aoi['geometry'])
+            if visible and job.description_error:
+                st.sidebar.warning(f"The region could not be described ({job.description_error}).")
+            # failed requests are not charged, nor do they say anything of the throughput
+            if result.failed:
+                return False
+            if not visible:
+                results.set(aoi['geometry'], {'result': result, 'fig': None})
+            charge(plan.pixels)
+            # a coalesced job is timed once, by the session that submitted it
+            if not state['coalesced']:
+                adaptive.observe(result.plan, result.stats_seconds)
+            st.session_state['last_trace'] = job.trace
+            if METRICS_FILE:
+                metrics.write_textfile(METRICS_FILE)
+
+            if plan.execution != 'scaled':
+                return False
+            remaining = admission.session_budget - st.session_state.get('spent_pixels', 0.)
+            refinement = adaptive.refinement(aoi['geometry'], plan, remaining=remaining)
+            if refinement is None:
+                return False
+            # the coarse answer stays on the page until the finer one replaces it
+            if visible:
+                scale_container.caption(f"{describe_path(result)} Refining at {refinement.scale:,.0f} m...")
+            job, coalesced = get_jobs().refine(aoi, refinement)
+            st.session_state['job'] = {'id': job.id, 'geojson': aoi, 'plan': refinement,
+                                       'coalesced': coalesced, 'result': result}
+            return follow()
+
+        def finish_refinement(state, job, visible):
+            result, refined = state['result'], job.result
+            if job.status == jobs.FAILED or refined.failed:
+                if visible:
+                    scale_container.caption(f"{describe_path(result)} The refinement failed.")
+                return
+            charge(state['plan'].pixels)
+            if not state['coalesced']:
+                adaptive.observe(refined.plan, refined.stats_seconds)
+            # a copy, the result of the analysis may be shared with the other sessions of its job
+            result = dataclasses.replace(result, stats=refined.stats, plan=refined.plan,
+                                         stats_seconds=refined.stats_seconds, path=refined.path)
+            results.set(state['geojson']['geometry'],
+                        {'result': result, 'fig': show_chart(result) if visible else None})
+
+        memoized = results.get(geojson['geometry']) if geojson is not None else None
+        if memoized is not None:
+            memoized['fig'] = show_chart(memoized['result'], memoized['fig'])
+            if memoized['result'].description:
+                show_description(memoized['result'].description)
+
+        # Add the button and its callback
+        if st.button(
+            BTN_LABEL_COMPUTE,
+            key="compute_zs",
+            disabled=False if geojson is not None else True,
+        ):
+            st.session_state.pop('pending', None)
+            decision = admission.admit(geojson['geometry'], spent=st.session_state.get('spent_pixels', 0.))
+            if decision.admitted:
+                # in fast mode the scale is chosen to answer within LATENCY_TARGET rather than by Earth Engine
+                analyse(adaptive.plan(geojson['geometry']) if fast_mode else decision.options[0])
+            else:
+                # the offered plans must survive the rerun triggered by choosing one of them
+                st.session_state['pending'] = (geojson, decision)
+
+        pending = st.session_state.get('pending')
+        if pending is not None and pending[0] == geojson:
+            decision = pending[1]
+            st.warning(decision.reason)
+            if decision.options:
+                plan = st.radio("How should the region be computed?", decision.options,
+                                format_func=lambda plan: plan.describe(), key="plan")
+                if st.button("Continue", key="compute_plan"):
+                    del st.session_state['pending']
+                    analyse(plan)
+
+        polling = follow()
+
         st.markdown(
             f"""
             4. Wait for the computation to finish
@@ -159,5 +481,62 @@ if __name__ == "__main__":
             unsafe_allow_html=True,
         )
 
-
-
+    with st.expander("Land cover change"):
+        spec = datasets['Global-Land-Cover'].spec
+        first_year, last_year = st.select_slider("Years", options=spec.years, key="change_years",
+                                                 value=(CHANGE_FIRST_YEAR, spec.default_year))
+        years = list(range(first_year, last_year + 1))
+        changes = SessionMemo(st.session_state, 'changes')
+        change_key = {'aoi': geojson['geometry'] if geojson is not None else None, 'years': years}
+
+        if st.button(BTN_LABEL_CHANGE, key="compute_change", disabled=geojson is None or len(years) < 2):
+            # every year is reduced, and both ends once more for the transitions
+            pixels = admission.estimate(geojson['geometry']).pixels['Global-Land-Cover'] * (len(years) + 2)
+            if st.session_state.get('spent_pixels', 0.) + pixels > admission.session_budget:
+                st.warning("The compute budget left in this session is too small for this region and years. "
+                           "Please select a smaller region or fewer years.")
+            else:
+                try:
+                    land_cover_change = get_land_cover_change()
+                    land_cover_change.check_years(years)
+                    aoi = prepare_aoi(geojson['geometry'])
+                except ValueError as e:
+                    st.warning(f"{e} Please select another region.")
+                else:
+                    job, _ = get_jobs().land_cover_change(land_cover_change, aoi, years)
+                    st.session_state['change_job'] = {'id': job.id, 'key': change_key, 'pixels': pixels}
+
+        # polled like the job of the analysis, only while its region and years are selected
+        state = st.session_state.get('change_job')
+        job = get_jobs().get(state['id']) if state is not None else None
+        if state is not None and job is None:
+            del st.session_state['change_job']
+        elif job is not None and state['key'] == change_key and not job.done:
+            st.caption(f"Computing the land cover of {len(years)} years. {describe_job(job)}")
+            polling = True
+        elif job is not None and state['key'] == change_key:
+            del st.session_state['change_job']
+            change = job.result
+            if job.status == jobs.FAILED or change.failed:
+                st.error(f"The land cover change could not be computed "
+                         f"({job.error if job.status == jobs.FAILED else change.path}), please try again later.")
+            else:
+                changes.set(change_key, {'change': change,
+                                         'fig': create_change_chart(change.years, spec.colors_by_name)})
+                st.session_state['spent_pixels'] = st.session_state.get('spent_pixels', 0.) + state['pixels']
+
+        memoized = changes.get(change_key)
+        if memoized is not None:
+            st.plotly_chart(memoized['fig'], use_container_width=True)
+            st.caption(f"Percentage of the region going from each class in {first_year} (rows) "
+                       f"to each class in {last_year} (columns), from: {memoized['change'].path}")
+            st.dataframe(create_transition_table(memoized['change'].transitions), use_container_width=True)
+
+    if DEBUG_PANEL and 'last_trace' in st.session_state:
+        with st.sidebar.expander("Stage timings of the last request"):
+            st.dataframe(st.session_state['last_trace'], use_container_width=True)
+
+    # the page is drawn in full before the jobs are polled again, by a rerun rather than a loop in this script
+    if polling:
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
@@ -0,0 +1,189 @@
+"""
+Time the stages of an analysis against offline stand-ins of Earth Engine, Nominatim and OpenAI.
+
+Every external call is answered by `benchmarks/standins.py` after an injected latency, from a recording
+when one is given and synthesized otherwise, so the suite runs without network access or credentials.
+
+    python benchmarks/stages.py --runs 5 --output stages.json
+    python benchmarks/stages.py --baseline stages.json --tolerance 0.2
+    python benchmarks/stages.py --latency ee.getInfo=0 openai=0      # only the cost of our own code
+
+Record the answers of the real services once, with Earth Engine and OpenAI credentials, to replay them later:
+
+    python benchmarks/stages.py --record recording.json --runs 1
+    python benchmarks/stages.py --replay recording.json
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from typing import Callable, Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# a rectangle of about 4 square degrees in the Basque Country, within the allowed area of the app
+GEOJSON = {'type': 'Feature', 'properties': {},
+           'geometry': {'type': 'Polygon',
+                        'coordinates': [[[-3.2, 42.4], [-3.2, 43.4], [-1.2, 43.4], [-1.2, 42.4], [-3.2, 42.4]]]}}
+
+KOPPEN_ASSET = 'users/fsn1995/Global_19862010_KG_5m'
+
+
+def time_stage(function: Callable, runs: int, number: int = 1, setup: Callable = None) -> dict:
+    """Time `runs` samples of `number` calls of `function`, `setup` runs untimed before every sample."""
+    samples = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        samples.append((time.perf_counter() - start) / number * 1000.)
+    return {'median_ms': statistics.median(samples), 'min_ms': min(samples), 'max_ms': max(samples),
+            'runs': runs, 'number': number}
+
+
+def stages() -> Dict[str, tuple]:
+    """The timed stages, as `name: (function, number, setup)`."""
+    from geopeto import tiles
+    from geopeto.data import GEEData
+    from geopeto.geocoder import Geocoder, ReverseGeocodeCache, TokenBucket
+    from geopeto.geodescriber import GeoDescriber
+    from geopeto.processing import (CombinedZonalStatistics, ZonalStatistics, reduce_region_params,
+                                    serialize_output, to_percentages)
+    from geopeto.utils import get_region
+    from geopeto.visualize import create_stacked_bar, foliumMapGEE
+    from shapely.geometry import shape
+
+    land_cover, climate = GEEData('Global-Land-Cover'), GEEData('Koppen-Geiger-Climate')
+    geometry = GEOJSON['geometry']
+    response = land_cover.ee_image().reduceRegion(**reduce_region_params(get_region(geometry), True)).getInfo()
+    land_cover_per = to_percentages(serialize_output(response), land_cover)
+    climate_per = ZonalStatistics(climate).compute_stats(geometry)
+    center = shape(geometry).centroid
+
+    # a new cache and no rate limit for every lookup, so each one reaches the stand-in
+    geocoders = {}
+
+    def new_geocoder():
+        geocoders['cold'] = Geocoder('geopeto-benchmark', cache=ReverseGeocodeCache(),
+                                     rate_limiter=TokenBucket(rate=1e9))
+
+    warm = Geocoder('geopeto-benchmark', cache=ReverseGeocodeCache(), rate_limiter=TokenBucket(rate=1e9))
+    warm.reverse_geocode(center)
+
+    def build_map():
+        m = foliumMapGEE(center=[25.0, 55.0], zoom=3)
+        for gee_data in (land_cover, climate):
+            m.add_gee_layer(image=gee_data.ee_image(), sld_interval=gee_data.sld_interval(), name=gee_data.dataset)
+        m.add_layer_control()
+        # st_folium renders the map to html on every rerun
+        return m.get_root().render()
+
+    def clear_map_ids():
+        with tiles._map_ids_lock:
+            tiles._map_ids.clear()
+
+    return {
+        'check_area_and_compute': (lambda: ZonalStatistics(land_cover).check_area_and_compute(GEOJSON), 1, None),
+        'combined_compute': (lambda: CombinedZonalStatistics({'lc': land_cover, 'climate': climate})
+                             .compute_stats(geometry), 1, None),
+        'serialize_output': (lambda: serialize_output(response), 1000, None),
+        'reverse_geocode': (lambda: geocoders['cold'].reverse_geocode(center), 1, new_geocoder),
+        'reverse_geocode_cached': (lambda: warm.reverse_geocode(center), 1000, None),
+        'generate_description': (lambda: GeoDescriber('text-davinci-003')
+                                 .generate_description(land_cover_per, climate_per, 'Gipuzkoa', 'Spain'), 1, None),
+        'create_stacked_bar': (lambda: create_stacked_bar(land_cover_per, land_cover.spec.colors_by_name), 1, None),
+        'map_construction': (build_map, 1, clear_map_ids),
+        'map_construction_cached': (build_map, 1, None),
+    }
+
+
+def run(recording, runs: int, only: list = None) -> dict:
+    from standins import nominatim_standin
+
+    results = {}
+    with nominatim_standin(recording):
+        for name, (function, number, setup) in stages().items():
+            if only and name not in only:
+                continue
+            # warm up imports and caches of the stage
+            if setup is not None:
+                setup()
+            function()
+            results[name] = time_stage(function, runs, number, setup)
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_ms: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        value = result['median_ms']
+        if before is not None and value > min_ms and value > before['median_ms'] * (1 + tolerance):
+            regressions.append((name, before['median_ms'], value))
+    return regressions
+
+
+def _latency(values: list) -> dict:
+    return {key: float(value) for key, value in (value.split('=', 1) for value in values or [])}
+
+
+def install_standins(recording):
+    """Replace ee and openai by their stand-ins; must run before geopeto is imported."""
+    from standins import EEStandIn, OpenAIStandIn
+
+    sys.path.insert(0, ROOT)
+    from geopeto import resources
+    from geopeto.registry import DATASETS
+
+    classes = {DATASETS['Global-Land-Cover'].image_collection_id: DATASETS['Global-Land-Cover'].codes.tolist(),
+               KOPPEN_ASSET: DATASETS['Koppen-Geiger-Climate'].codes.tolist()}
+    ee = EEStandIn(recording, classes=classes)
+    sys.modules['ee'] = ee
+    resources.register('ee', lambda: (ee.Initialize(), ee)[1])
+    resources.register('openai', lambda: OpenAIStandIn(recording))
+
+
+if __name__ == '__main__':
+    from standins import Recording
+
+    parser = argparse.ArgumentParser(description='Stage timings of an analysis against offline stand-ins.')
+    parser.add_argument('--runs', type=int, default=5, help='samples per stage, the median is reported')
+    parser.add_argument('--stages', nargs='+', help='stages to run, all of them by default')
+    parser.add_argument('--latency', nargs='+', metavar='SERVICE=SECONDS',
+                        help='injected latency of ee.getInfo, ee.getMapId, nominatim and openai')
+    parser.add_argument('--replay', help='recording to answer from, unrecorded requests are synthesized')
+    parser.add_argument('--record', help='call the real services and record their answers to this file')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown')
+    parser.add_argument('--min-ms', type=float, default=1., help='ignore stages faster than this')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    recording = Recording(args.record or args.replay, mode='record' if args.record else 'replay',
+                          latency=_latency(args.latency))
+    install_standins(recording)
+
+    results = run(recording, args.runs, args.stages)
+    recording.save()
+    for name, result in results.items():
+        print(f'{result["median_ms"]:10.2f} ms  {name}')
+    if not recording.recording:
+        print(f'{recording.replayed} answers replayed, {recording.synthesized} synthesized')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'runs': args.runs, 'latency': recording.latency, 'stages': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['stages']
+        regressions = compare(results, baseline, args.tolerance, args.min_ms)
+        for name, before, after in regressions:
+            print(f'REGRESSION {name}: {before:.2f} ms -> {after:.2f} ms')
+        sys.exit(1 if regressions else 0)
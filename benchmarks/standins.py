@@ -0,0 +1,312 @@
+"""
+Record/replay stand-ins for Earth Engine, Nominatim and the OpenAI completion API.
+
+In replay mode nothing leaves the machine: answers come from a recording file, or are synthesized
+deterministically from the request when the recording has none, after sleeping for the injected latency.
+In record mode the real services are called and their answers stored under the same keys.
+
+    recording = Recording('benchmarks/recording.json', latency={'ee.getInfo': 0.5})
+    sys.modules['ee'] = EEStandIn(recording)           # before geopeto is imported
+    resources.register('openai', lambda: OpenAIStandIn(recording))
+    with nominatim_standin(recording): ...
+    recording.save()
+"""
+import contextlib
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+# seconds slept before every answer in replay mode
+DEFAULT_LATENCY = {
+    'ee.getInfo': 0.5,
+    'ee.getMapId': 0.3,
+    'nominatim': 0.2,
+    'openai': 1.0,
+}
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class Recording:
+    """
+    Answers of the stand-ins, keyed by service and by a hash of the request.
+
+    Parameters:
+    path: str, optional
+        JSON file the answers are read from and saved to.
+    mode: str, default "replay"
+        "replay" answers offline, "record" calls the real services and stores their answers.
+    latency: dict, optional
+        Seconds slept per service in replay mode, overriding DEFAULT_LATENCY.
+    """
+
+    def __init__(self, path: str = None, mode: str = 'replay', latency: Dict[str, float] = None):
+        if mode not in ('replay', 'record'):
+            raise ValueError(mode)
+        self.path = path
+        self.mode = mode
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.answers = {}
+        self.replayed = 0
+        self.synthesized = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.answers = json.load(f)
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == 'record'
+
+    def answer(self, service: str, request: str, call: Callable, synthesize: Callable):
+        """Answer `request` from the recording, or by `call` in record mode and `synthesize` if nothing was recorded."""
+        key = _hash(request)
+        if self.recording:
+            value = call()
+            with self._lock:
+                self.answers.setdefault(service, {})[key] = value
+            return value
+
+        time.sleep(self.latency.get(service, 0.))
+        answers = self.answers.get(service, {})
+        with self._lock:
+            if key in answers:
+                self.replayed += 1
+                return answers[key]
+            self.synthesized += 1
+        return synthesize()
+
+    def save(self):
+        if self.path and self.recording:
+            with open(self.path, 'w') as f:
+                json.dump(self.answers, f, indent=1, sort_keys=True)
+
+
+# ------------------------------------------------------------------------------------------------- Earth Engine
+
+def _describe(value) -> str:
+    if isinstance(value, (_Proxy, _Namespace)):
+        return value._desc
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(_describe(v) for v in value) + ']'
+    if isinstance(value, dict):
+        return '{' + ', '.join(f'{k}={_describe(value[k])}' for k in sorted(value)) + '}'
+    return repr(value)
+
+
+def _unwrap(value):
+    if isinstance(value, (_Proxy, _Namespace)):
+        return value._real
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unwrap(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _unwrap(v) for k, v in value.items()}
+    return value
+
+
+class _Proxy:
+    """An ee object: a description of the computation and, when recording, the real object."""
+
+    def __init__(self, ee, desc: str, real=None):
+        self._ee = ee
+        self._desc = desc
+        self._real = real
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            desc = f'{self._desc}.{name}({_describe(args)[1:-1]}{", " if args and kwargs else ""}' \
+                   f'{_describe(kwargs)[1:-1]})'
+            real = None
+            if self._ee._recording.recording:
+                real = getattr(self._real, name)(*_unwrap(args), **_unwrap(kwargs))
+            return _Proxy(self._ee, desc, real)
+        return method
+
+    def getInfo(self):
+        return self._ee._recording.answer('ee.getInfo', self._desc,
+                                          lambda: self._real.getInfo(),
+                                          lambda: self._ee._synthesize_info(self._desc))
+
+    def getMapId(self, vis_params=None):
+        def call():
+            mapid = self._real.getMapId(vis_params)
+            return {'mapid': mapid['mapid'], 'url_format': mapid['tile_fetcher'].url_format}
+
+        def synthesize():
+            mapid = _hash(self._desc)[:32]
+            return {'mapid': mapid,
+                    'url_format': f'https://earthengine.googleapis.com/v1/projects/standin/maps/{mapid}/tiles/'
+                                  '{z}/{x}/{y}'}
+
+        answer = self._ee._recording.answer('ee.getMapId', f'{self._desc}.getMapId({_describe(vis_params)})',
+                                            call, synthesize)
+        return {'mapid': answer['mapid'], 'token': '',
+                'tile_fetcher': SimpleNamespace(url_format=answer['url_format'])}
+
+
+class _Namespace:
+    """A constructor or function of the ee module, e.g. `ee.Image` or `ee.Reducer.frequencyHistogram`."""
+
+    def __init__(self, ee, desc: str, real=None):
+        self._ee = ee
+        self._desc = desc
+        self._real = real
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Namespace(self._ee, f'{self._desc}.{name}', getattr(self._real, name, None))
+
+    def __call__(self, *args, **kwargs):
+        desc = f'{self._desc}({_describe(args)[1:-1]}{", " if args and kwargs else ""}{_describe(kwargs)[1:-1]})'
+        real = None
+        if self._ee._recording.recording:
+            real = self._real(*_unwrap(args), **_unwrap(kwargs))
+        return _Proxy(self._ee, desc, real)
+
+
+class EEStandInException(Exception):
+    pass
+
+
+class EEStandIn:
+    """
+    Drop-in replacement of the `ee` module, install it with `sys.modules['ee'] = EEStandIn(recording)`.
+
+    `getInfo` and `getMapId` are answered by the recording; everything else only builds the description
+    of the computation, which is what the answers are keyed by.
+
+    Parameters:
+    recording: Recording
+        Answers, and mode, of the stand-in.
+    classes: dict, optional
+        Mapping of asset id to its class codes, used to synthesize frequency histograms.
+    """
+
+    __name__ = 'ee'
+
+    def __init__(self, recording: Recording, classes: Dict[str, List[int]] = None):
+        self._recording = recording
+        self._classes = classes or {}
+        self._real = None
+        if recording.recording:
+            import ee
+            self._real = ee
+        self.EEException = self._real.EEException if self._real else EEStandInException
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Namespace(self, name, getattr(self._real, name, None))
+
+    def _synthesize_info(self, desc: str):
+        if '.reduceRegion(' not in desc:
+            return None
+
+        # one band per renamed image of an Image.cat, each reading the first asset of its own description
+        assets = []
+        for asset in re.findall(r"Image(?:Collection)?\('([^']+)'\)", desc):
+            if not assets or assets[-1] != asset:
+                assets.append(asset)
+        names = re.findall(r"\.select\(0\)\.rename\('(b\d+)'\)", desc) or ['b1']
+        # bands reduced by the statistics reducer of the continuous datasets
+        statistics = re.search(r"Reducer\.count\(\), sharedInputs=True\)\.forEach\(\[([^\]]*)\]\)", desc)
+        continuous = re.findall(r"'(b\d+)'", statistics.group(1)) if statistics else []
+
+        rng = random.Random(_hash(desc))
+        if '.group(' in desc:
+            # grouped histogram: the classes of the last band per class of the second one
+            codes = self._classes.get(assets[0] if assets else None) or list(range(1, 21))
+            return {'groups': [{'from': code, 'histogram': {f'{to}': round(rng.uniform(1, 1e5), 4)
+                                                            for to in rng.sample(codes, k=max(1, len(codes) // 4))}}
+                               for code in rng.sample(codes, k=max(1, len(codes) // 2))]}
+
+        result = {}
+        for band in continuous:
+            values = sorted(rng.uniform(-10, 3000) for _ in range(5))
+            result.update({f'{band}_min': values[0], f'{band}_p10': values[1], f'{band}_p50': values[2],
+                           f'{band}_p90': values[3], f'{band}_max': values[4], f'{band}_mean': values[2],
+                           f'{band}_stdDev': (values[3] - values[1]) / 2.56, f'{band}_count': rng.randint(1, 100000)})
+        for i, band in enumerate(names):
+            if band in continuous:
+                continue
+            # the bands of a stack of one collection, e.g. several years, all read its first asset
+            codes = self._classes.get(assets[min(i, len(assets) - 1)] if assets else None) or list(range(1, 21))
+            present = rng.sample(codes, k=max(1, len(codes) // 2))
+            # bestEffort histograms hold weighted, fractional pixel counts
+            result[band] = {f'{code}': round(rng.uniform(1, 1e5), 4) for code in present}
+        return result
+
+
+# ------------------------------------------------------------------------------------------------- Nominatim
+
+@contextlib.contextmanager
+def nominatim_standin(recording: Recording):
+    """Answer the requests of every geopy Nominatim geocoder from the recording while active."""
+    from geopy.geocoders import Nominatim
+
+    call_geocoder = Nominatim._call_geocoder
+
+    def standin(self, url, callback, **kwargs):
+        def call():
+            return call_geocoder(self, url, lambda x: x, **kwargs)
+
+        def synthesize():
+            lat, lon = (float(v) for v in re.search(r'lat=([-\d.]+)&lon=([-\d.]+)', url).groups())
+            rng = random.Random(_hash(url))
+            return {'lat': str(lat), 'lon': str(lon),
+                    'display_name': f'Region {rng.randint(1, 500)}, {rng.randint(1000, 99999)}, '
+                                    f'Country {rng.randint(1, 200)}'}
+
+        # the url holds the coordinates, language and zoom of the lookup
+        return callback(recording.answer('nominatim', url, call, synthesize))
+
+    Nominatim._call_geocoder = standin
+    try:
+        yield
+    finally:
+        Nominatim._call_geocoder = call_geocoder
+
+
+# ------------------------------------------------------------------------------------------------- OpenAI
+
+def _completion(text: str):
+    return SimpleNamespace(choices=[SimpleNamespace(text=text)])
+
+
+class OpenAIStandIn:
+    """Stand-in of the `openai` module exposing `Completion.create`, register it as the 'openai' resource."""
+
+    def __init__(self, recording: Recording):
+        self._recording = recording
+        self._real = None
+        if recording.recording:
+            from geopeto.resources import _init_openai
+            self._real = _init_openai()
+        self.Completion = SimpleNamespace(create=self._create)
+
+    def _create(self, model, prompt, stream=False, **kwargs):
+        def call():
+            return self._real.Completion.create(model=model, prompt=prompt, **kwargs).choices[0].text
+
+        def synthesize():
+            rng = random.Random(_hash(prompt))
+            words = re.findall(r'[A-Za-z]+', prompt) or ['region']
+            return '\n\n' + ' '.join(rng.choice(words) for _ in range(180)) + '.'
+
+        text = self._recording.answer('openai', json.dumps([model, prompt, kwargs], sort_keys=True), call, synthesize)
+        if not stream:
+            return _completion(text)
+        # chunks of a few characters, as the API streams tokens
+        return (_completion(text[i:i + 4]) for i in range(0, len(text), 4))
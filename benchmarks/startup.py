@@ -0,0 +1,93 @@
+"""
+Measure the cold start cost of importing the app, per module.
+
+Runs `python -X importtime` in a fresh interpreter, which imports the app without running the page,
+and reports the cumulative import time of each top-level package and of every geopeto module.
+
+    python benchmarks/startup.py --runs 5 --output startup.json
+    python benchmarks/startup.py --baseline startup.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def import_times(module: str) -> dict:
+    """Cumulative import time, in milliseconds, of every module imported by `import <module>`."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'importing {module} failed:\n{result.stderr[-2000:]}')
+
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            _, cumulative, _, name = match.groups()
+            times[name] = int(cumulative) / 1000.
+    return times
+
+
+def summarize(times: dict, module: str) -> dict:
+    # third party cost is attributed to the top-level package, geopeto modules are kept apart
+    packages = defaultdict(float)
+    for name, cumulative in times.items():
+        if name.startswith('geopeto') or name == module:
+            packages[name] = cumulative
+        elif '.' not in name:
+            packages[name] += cumulative
+    return dict(packages)
+
+
+def run(module: str, runs: int) -> dict:
+    samples = defaultdict(list)
+    for _ in range(runs):
+        for name, cumulative in summarize(import_times(module), module).items():
+            samples[name].append(cumulative)
+    return {name: statistics.median(values) for name, values in samples.items()}
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_ms: float) -> list:
+    regressions = []
+    for name, value in results.items():
+        before = baseline.get(name)
+        if before is not None and value > min_ms and value > before * (1 + tolerance):
+            regressions.append((name, before, value))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time of the app per module.')
+    parser.add_argument('--module', default='app', help='module to import, default app')
+    parser.add_argument('--runs', type=int, default=3, help='number of cold starts, the median is reported')
+    parser.add_argument('--top', type=int, default=25, help='number of modules printed')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown')
+    parser.add_argument('--min-ms', type=float, default=5., help='ignore modules faster than this')
+    args = parser.parse_args()
+
+    results = run(args.module, args.runs)
+    for name, value in sorted(results.items(), key=lambda x: -x[1])[:args.top]:
+        print(f'{value:10.1f} ms  {name}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'module': args.module, 'runs': args.runs, 'import_ms': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['import_ms']
+        regressions = compare(results, baseline, args.tolerance, args.min_ms)
+        for name, before, after in regressions:
+            print(f'REGRESSION {name}: {before:.1f} ms -> {after:.1f} ms')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,113 @@
+"""
+Adaptive-resolution reductions: the finest scale of the resolution ladder that fits a pixel or latency budget.
+"""
+import logging
+import threading
+from typing import Optional
+
+from .admission import AdmissionController, Plan
+
+log = logging.getLogger(__name__)
+
+# Reductions answered faster than this are cache hits or tiny regions dominated by the request overhead,
+# they say nothing about the throughput.
+MIN_OBSERVED_SECONDS = 0.5
+
+
+class Throughput:
+    """
+    Exponential moving average of the pixels reduced per second.
+
+    Parameters:
+    initial: float, default 1e6
+        Pixels per second assumed until a reduction has been observed.
+    alpha: float, default 0.2
+        Weight of every new observation.
+    """
+
+    def __init__(self, initial: float = 1e6, alpha: float = 0.2):
+        self.pixels_per_second = initial
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+    def observe(self, pixels: float, seconds: float):
+        if seconds < MIN_OBSERVED_SECONDS:
+            return
+        with self._lock:
+            self.pixels_per_second += self.alpha * (pixels / seconds - self.pixels_per_second)
+
+    def pixels_for(self, seconds: float) -> float:
+        return self.pixels_per_second * seconds
+
+
+# default throughput model of AdaptiveResolution
+_throughput = Throughput()
+
+
+class AdaptiveResolution:
+    """
+    Choose the scale of a reduction from the resolution ladder to fit a pixel or latency budget.
+
+    Parameters:
+    admission: AdmissionController
+        Provides the resolution ladder and the pixel estimates.
+    pixel_budget: float, optional
+        Largest number of pixels of the first answer.
+    latency_budget: float, optional
+        Target duration, in seconds, of the first answer. The tighter of both budgets applies,
+        the request budget of `admission` if neither is given.
+    refine_budget: float, optional
+        Largest number of pixels of the background refinement, the request budget of `admission`
+        if not given. No refinement is offered if it is 0.
+    throughput: Throughput, optional
+        Throughput model, shared by the whole process if not given.
+    """
+
+    def __init__(self, admission: AdmissionController, pixel_budget: float = None, latency_budget: float = None,
+                 refine_budget: float = None, throughput: Throughput = None):
+        self.admission = admission
+        self.pixel_budget = pixel_budget
+        self.latency_budget = latency_budget
+        self.refine_budget = admission.request_budget if refine_budget is None else refine_budget
+        self.throughput = throughput if throughput is not None else _throughput
+
+    def budget(self) -> float:
+        budgets = [self.admission.request_budget]
+        if self.pixel_budget is not None:
+            budgets.append(self.pixel_budget)
+        if self.latency_budget is not None:
+            budgets.append(self.throughput.pixels_for(self.latency_budget))
+        return min(budgets)
+
+    def _fit(self, geometry: dict, budget: float) -> Plan:
+        estimate = self.admission.estimate(geometry)
+        ladder = self.admission.ladder()
+        for scale in ladder:
+            pixels = self.admission.pixels_at(estimate, scale)
+            if pixels <= budget:
+                return Plan('scaled', pixels, scale=scale)
+        # nothing fits, the coarsest scale is the fastest answer there is
+        return Plan('scaled', self.admission.pixels_at(estimate, ladder[-1]), scale=ladder[-1])
+
+    def plan(self, geometry: dict) -> Plan:
+        """The plan of the first answer."""
+        plan = self._fit(geometry, self.budget())
+        log.info(f'[AdaptiveResolution]: {plan.describe()}, '
+                 f'{self.throughput.pixels_per_second:,.0f} pixels/s')
+        return plan
+
+    def refinement(self, geometry: dict, plan: Plan, remaining: float = None) -> Optional[Plan]:
+        """
+        The plan refining `plan` at the finest scale that fits the refinement budget, and the `remaining`
+        budget of the session if given. None if no scale is finer than the one of `plan`.
+        """
+        budget = self.refine_budget if remaining is None else min(self.refine_budget, remaining)
+        if budget <= 0:
+            return None
+        refined = self._fit(geometry, budget)
+        return refined if refined.scale < plan.scale and refined.pixels <= budget else None
+
+    def observe(self, plan: Optional[Plan], seconds: Optional[float]):
+        """Learn the throughput from a finished reduction."""
+        if plan is not None and plan.scale is not None and seconds is not None:
+            self.throughput.observe(plan.pixels, seconds)
@@ -0,0 +1,148 @@
+"""
+Admission control of zonal statistics requests by the pixels they reduce at the native scale of every dataset.
+"""
+import logging
+import math
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from geographiclib.geodesic import Geodesic
+from shapely.geometry import shape
+
+from .registry import METRES_PER_DEGREE
+
+log = logging.getLogger(__name__)
+
+# coarser scales offered are the finest native scale times these factors
+SCALE_FACTORS = (2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64)
+
+
+def geodesic_area(geometry: dict) -> float:
+    """Area of a Polygon or MultiPolygon on the WGS84 ellipsoid, in square metres."""
+    aoi = shape(geometry)
+    polygons = getattr(aoi, 'geoms', [aoi])
+
+    def ring_area(ring) -> float:
+        polygon = Geodesic.WGS84.Polygon()
+        # the closing vertex is implied
+        for lon, lat in list(ring.coords)[:-1]:
+            polygon.AddPoint(lat, lon)
+        # the signed area is negative for clockwise rings, which the GeoJSON spec allows
+        _, _, area = polygon.Compute(reverse=False, sign=True)
+        return abs(area)
+
+    return sum(ring_area(p.exterior) - sum(ring_area(hole) for hole in p.interiors) for p in polygons)
+
+
+@dataclass(frozen=True)
+class Plan:
+    """How a request is executed: "native", "coarser" or "scaled" to `scale` metres, or "tiled" at native resolution."""
+    execution: str
+    pixels: float
+    scale: Optional[float] = None
+
+    def describe(self) -> str:
+        if self.execution == 'coarser':
+            return f'Coarser scale of {self.scale / 1000:.1f} km (~{self.pixels:,.0f} pixels)'
+        elif self.execution == 'scaled':
+            return f'Scale of {self.scale:,.0f} m (~{self.pixels:,.0f} pixels)'
+        elif self.execution == 'tiled':
+            return f'Native resolution in tiles (~{self.pixels:,.0f} pixels, slower)'
+        return f'Native resolution (~{self.pixels:,.0f} pixels)'
+
+
+@dataclass
+class Estimate:
+    area_km2: float
+    area_deg2: float
+    # pixels of every dataset at its native scale
+    pixels: Dict[str, float]
+
+    @property
+    def total(self) -> float:
+        return sum(self.pixels.values())
+
+
+@dataclass
+class Decision:
+    admitted: bool
+    estimate: Estimate
+    # the plan of an admitted request, or the alternatives offered for one over budget
+    options: List[Plan] = field(default_factory=list)
+    reason: str = ''
+
+
+class AdmissionController:
+    """
+    Estimate the pixel work of a request and admit it, or offer cheaper ways to run it.
+
+    Parameters:
+    datasets: dict
+        Mapping of dataset name to GEEData, every dataset is reduced by a request.
+    request_budget: float, default 5e6
+        Largest number of pixels reduced by a single, non tiled, request.
+    tiled_budget: float, default 5e8
+        Largest number of pixels reduced by a tiled request.
+    session_budget: float, default 5e7
+        Pixels a session may reduce in total.
+    """
+
+    def __init__(self, datasets: dict, request_budget: float = 5e6, tiled_budget: float = 5e8,
+                 session_budget: float = 5e7):
+        self.specs = {dataset: data.spec for dataset, data in datasets.items()}
+        self.request_budget = request_budget
+        self.tiled_budget = tiled_budget
+        self.session_budget = session_budget
+
+    @staticmethod
+    def _pixels(spec, area_deg2: float, area_m2: float, scale: float = None) -> float:
+        """Pixels of `spec` in the AOI, at its native scale or resampled to `scale` metres if that is coarser."""
+        if scale is None or scale <= spec.nominal_scale:
+            size = spec.pixel_size
+        else:
+            size = scale / METRES_PER_DEGREE if spec.geographic else scale
+        return (area_deg2 if spec.geographic else area_m2) / size ** 2
+
+    def estimate(self, geometry: dict) -> Estimate:
+        area_deg2, area_m2 = shape(geometry).area, geodesic_area(geometry)
+        return Estimate(area_km2=area_m2 / 1e6, area_deg2=area_deg2,
+                        pixels={dataset: self._pixels(spec, area_deg2, area_m2)
+                                for dataset, spec in self.specs.items()})
+
+    def ladder(self) -> List[float]:
+        """Scales, in metres and from finest to coarsest, requests can be reduced at."""
+        finest = min(spec.nominal_scale for spec in self.specs.values())
+        return [finest] + [math.ceil(finest * factor) for factor in SCALE_FACTORS]
+
+    def pixels_at(self, estimate: Estimate, scale: float) -> float:
+        """Pixels reduced when every dataset finer than `scale` metres is resampled to it."""
+        return sum(self._pixels(spec, estimate.area_deg2, estimate.area_km2 * 1e6, scale)
+                   for spec in self.specs.values())
+
+    def admit(self, geometry: dict, spent: float = 0.) -> Decision:
+        """Decide on a request of a session that has already reduced `spent` pixels."""
+        estimate = self.estimate(geometry)
+        remaining = max(0., self.session_budget - spent)
+        log.info(f'[AdmissionController]: {estimate.area_km2:,.0f} km2, {estimate.total:,.0f} pixels, '
+                 f'{remaining:,.0f} left in the session')
+
+        if estimate.total <= min(self.request_budget, remaining):
+            return Decision(True, estimate, [Plan('native', estimate.total)])
+
+        options = []
+        for scale in self.ladder()[1:]:
+            pixels = self.pixels_at(estimate, scale)
+            if pixels <= min(self.request_budget, remaining):
+                options.append(Plan('coarser', pixels, scale=scale))
+                break
+        if estimate.total <= min(self.tiled_budget, remaining):
+            options.append(Plan('tiled', estimate.total))
+
+        if not options:
+            reason = ("The compute budget left in this session is too small for this region." if estimate.total > remaining
+                      else "This region is too large to be computed.") + " Please select a smaller region."
+        elif estimate.total > remaining:
+            reason = "This region exceeds the compute budget left in this session at native resolution."
+        else:
+            reason = "This region is too large to be computed at native resolution in a single request."
+        return Decision(False, estimate, options, reason)
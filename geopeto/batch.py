@@ -0,0 +1,254 @@
+"""
+Headless batch zonal statistics over many AOIs.
+
+    python -m geopeto.batch aois.geojson results/ --workers 8 --retries 3
+
+Reads the AOIs of a GeoJSON FeatureCollection, GeoJSON sequence or GeoParquet file, computes the histogram of every
+registered categorical dataset for each of them and streams the results to Parquet part files in the output
+directory, one row per AOI, dataset and class. Completed AOIs are recorded in a checkpoint, so a run
+that is interrupted resumes where it stopped when started again with the same output directory.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Tuple
+
+from .backends import LocalRasterBackend
+from .data import GEEData
+from .geometry import prepare_aoi
+from .integral import IntegralIndexBackend
+from .processing import CombinedZonalStatistics
+from .registry import DATASETS
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_FILE = '_checkpoint.jsonl'
+# AOIs read ahead of the workers, per worker
+READ_AHEAD = 2
+# features per batch read from a GeoParquet file
+PARQUET_BATCH_SIZE = 1024
+# the rows hold class counts, the statistics of the continuous datasets have no classes
+CATEGORICAL_DATASETS = [name for name, spec in DATASETS.items() if not spec.continuous]
+
+
+def read_aois(path: str, id_field: str = None) -> Iterator[Tuple[str, dict]]:
+    """
+    Yield `(aoi_id, geometry)` for every feature; features without `id_field` are numbered.
+
+    GeoParquet files and GeoJSON sequences, one feature per line, are read as they are consumed; a GeoJSON
+    FeatureCollection is loaded whole.
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        import shapely
+
+        columns = ['geometry'] + ([id_field] if id_field else [])
+        i = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=PARQUET_BATCH_SIZE, columns=columns):
+            geometries = shapely.from_wkb(batch.column('geometry').to_numpy(zero_copy_only=False))
+            ids = batch.column(id_field).to_pylist() if id_field else range(i, i + len(geometries))
+            for aoi_id, geometry in zip(ids, geometries):
+                yield str(aoi_id), json.loads(shapely.to_geojson(geometry))
+            i += len(geometries)
+    elif path.endswith(('.geojsonl', '.geojsons', '.ndjson')):
+        with open(path) as f:
+            features = (json.loads(line.lstrip('\x1e')) for line in f if line.strip())
+            yield from _features(features, id_field)
+    else:
+        with open(path) as f:
+            features = json.load(f)['features']
+        yield from _features(features, id_field)
+
+
+def _features(features: Iterator[dict], id_field: str = None) -> Iterator[Tuple[str, dict]]:
+    for i, feature in enumerate(features):
+        properties = feature.get('properties') or {}
+        aoi_id = properties[id_field] if id_field else feature.get('id', i)
+        yield str(aoi_id), feature['geometry']
+
+
+def read_checkpoint(output_dir: str) -> set:
+    path = os.path.join(output_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {json.loads(line)['id'] for line in f if line.strip()}
+
+
+def to_rows(aoi_id: str, stats: dict, gee_datas: Dict[str, GEEData]) -> List[dict]:
+    rows = []
+    for dataset, histogram in stats.items():
+        spec = gee_datas[dataset].spec
+        counts = spec.count_vector(histogram.get('b1'))
+        total = counts.sum()
+        for i in counts.nonzero()[0]:
+            rows.append({'aoi_id': aoi_id,
+                         'dataset': dataset,
+                         'class_code': int(spec.codes[i]),
+                         'class_name': spec.names[i],
+                         'count': float(counts[i]),
+                         'percentage': float(counts[i] / total * 100)})
+    return rows
+
+
+class BatchRunner:
+    """
+    Compute the zonal statistics of many AOIs concurrently, with retries and checkpoint/resume.
+
+    Parameters:
+    output_dir: str
+        Directory of the Parquet part files and of the checkpoint.
+    datasets: list of str, optional
+        Categorical datasets to evaluate, every registered one if not given.
+    workers: int, default 4
+        AOIs computed at the same time.
+    retries: int, default 3
+        Attempts after the first one before an AOI is reported as failed.
+    flush_every: int, default 100
+        AOIs per Parquet part file; they are marked done once their part file is closed.
+    tile_size: float, optional
+        Reduce every AOI in tiles of this many degrees at native resolution.
+    backend: optional
+        Backend of the zonal statistics, Earth Engine if not given.
+    """
+
+    def __init__(self, output_dir: str, datasets: List[str] = None, workers: int = 4, retries: int = 3,
+                 flush_every: int = 100, tile_size: float = None, backend=None):
+        self.output_dir = output_dir
+        datasets = datasets or CATEGORICAL_DATASETS
+        continuous = [dataset for dataset in datasets if DATASETS[dataset].continuous]
+        if continuous:
+            raise ValueError(f'Batch mode only computes class counts, not the continuous {", ".join(continuous)}')
+        self.gee_datas = {dataset: GEEData(dataset) for dataset in datasets}
+        self.workers = workers
+        self.retries = retries
+        self.flush_every = flush_every
+        self.tile_size = tile_size
+        self.zonal_statistics = CombinedZonalStatistics(self.gee_datas, backend=backend,
+                                                        best_effort=tile_size is None)
+
+    def compute(self, aoi_id: str, geometry: dict) -> List[dict]:
+        # validated, wrapped and split along the antimeridian like the AOIs of the app; an invalid one is not retried
+        try:
+            geometry = prepare_aoi(geometry)
+        except ValueError as e:
+            raise ValueError(f'{aoi_id} is not a valid AOI: {e}')
+
+        for attempt in range(self.retries + 1):
+            if self.tile_size is not None:
+                stats = self.zonal_statistics.compute_tiled(geometry, self.tile_size)
+            else:
+                stats = self.zonal_statistics.compute(geometry)
+            # a failed request leaves the histograms of a dataset empty, one without valid pixels has no classes
+            if all(stats.get(dataset) for dataset in self.gee_datas):
+                return to_rows(aoi_id, stats, self.gee_datas)
+            if attempt < self.retries:
+                delay = min(60., 2 ** attempt) * random.uniform(0.5, 1.5)
+                log.warning(f'[BatchRunner]: {aoi_id} failed, retrying in {delay:.1f}s')
+                time.sleep(delay)
+        raise RuntimeError(f'{aoi_id} failed after {self.retries + 1} attempts')
+
+    def run(self, aois: Iterator[Tuple[str, dict]]) -> dict:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        done = read_checkpoint(self.output_dir)
+        todo = ((aoi_id, geometry) for aoi_id, geometry in aois if aoi_id not in done)
+        log.info(f'[BatchRunner]: {len(done)} AOIs already done')
+
+        part = len([f for f in os.listdir(self.output_dir) if f.endswith('.parquet')])
+        checkpoint = open(os.path.join(self.output_dir, CHECKPOINT_FILE), 'a')
+        rows, ids, failed = [], [], []
+        completed, start = 0, time.monotonic()
+
+        def flush():
+            nonlocal part, rows, ids
+            if not ids:
+                return
+            if rows:
+                path = os.path.join(self.output_dir, f'part-{part:05d}.parquet')
+                pq.write_table(pa.Table.from_pylist(rows), f'{path}.tmp')
+                os.replace(f'{path}.tmp', path)
+                part += 1
+            # AOIs are only marked done once their rows are safely on disk
+            for aoi_id in ids:
+                checkpoint.write(json.dumps({'id': aoi_id}) + '\n')
+            checkpoint.flush()
+            rows, ids = [], []
+
+        def collect(futures: dict, return_when: str):
+            nonlocal completed
+            finished, _ = wait(futures, return_when=return_when)
+            for future in finished:
+                aoi_id = futures.pop(future)
+                try:
+                    rows.extend(future.result())
+                    ids.append(aoi_id)
+                except Exception as e:
+                    log.error(f'[BatchRunner]: {e}')
+                    failed.append(aoi_id)
+
+                completed += 1
+                if len(ids) >= self.flush_every:
+                    flush()
+                if completed % 10 == 0:
+                    rate = completed / max(time.monotonic() - start, 1e-9) * 60
+                    log.info(f'[BatchRunner]: {completed} AOIs, {rate:.1f} AOIs/min')
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # AOIs are read as the workers take them, so a large file is never held in memory at once
+                futures = {}
+                for aoi_id, geometry in todo:
+                    if len(futures) >= READ_AHEAD * self.workers:
+                        collect(futures, FIRST_COMPLETED)
+                    futures[executor.submit(self.compute, aoi_id, geometry)] = aoi_id
+                while futures:
+                    collect(futures, FIRST_COMPLETED)
+        finally:
+            flush()
+            checkpoint.close()
+
+        elapsed = time.monotonic() - start
+        return {'done': completed - len(failed), 'failed': failed, 'skipped': len(done),
+                'aois_per_minute': completed / elapsed * 60 if elapsed else 0.}
+
+
+def _paths(values: List[str]) -> Dict[str, str]:
+    return dict(value.split('=', 1) for value in values or [])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Zonal statistics of many AOIs, streamed to Parquet.')
+    parser.add_argument('aois', help='GeoJSON FeatureCollection or GeoParquet of the AOIs')
+    parser.add_argument('output_dir', help='directory of the Parquet results and of the checkpoint')
+    parser.add_argument('--id-field', help='property holding the AOI id, the feature id or index if not given')
+    parser.add_argument('--datasets', nargs='+', choices=CATEGORICAL_DATASETS,
+                        help='categorical datasets, all of them by default')
+    parser.add_argument('--workers', type=int, default=4, help='AOIs computed at the same time')
+    parser.add_argument('--retries', type=int, default=3, help='retries of a failed AOI')
+    parser.add_argument('--flush-every', type=int, default=100, help='AOIs per Parquet part file')
+    parser.add_argument('--tile-size', type=float, help='reduce AOIs in tiles of this many degrees')
+    parser.add_argument('--raster', nargs='+', metavar='DATASET=PATH',
+                        help='compute from local rasters instead of Earth Engine, or of the datasets without --index')
+    parser.add_argument('--index', nargs='+', metavar='DATASET=DIR',
+                        help='compute from integral image indexes instead of Earth Engine')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    backend = None
+    if args.index:
+        backend = IntegralIndexBackend(_paths(args.index), raster_paths=_paths(args.raster))
+    elif args.raster:
+        backend = LocalRasterBackend(_paths(args.raster))
+
+    runner = BatchRunner(args.output_dir, datasets=args.datasets, workers=args.workers, retries=args.retries,
+                         flush_every=args.flush_every, tile_size=args.tile_size, backend=backend)
+    summary = runner.run(read_aois(args.aois, args.id_field))
+    log.info(f'[BatchRunner]: {summary}')
@@ -0,0 +1,158 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional
+
+log = logging.getLogger(__name__)
+
+
+def _snap(value: float, grid: float) -> float:
+    return round(round(value / grid) * grid, 10)
+
+
+def _normalize_ring(ring: List[List[float]], grid: float) -> List[List[float]]:
+    ring = [[_snap(x, grid), _snap(y, grid)] for x, y, *_ in ring]
+    # drop consecutive duplicates created by snapping, then the closing vertex and those snapped onto it
+    ring = [c for i, c in enumerate(ring) if i == 0 or c != ring[i - 1]]
+    while len(ring) > 1 and ring[0] == ring[-1]:
+        ring = ring[:-1]
+
+    # start every ring at its smallest vertex so that the same shape drawn from another corner matches
+    start = ring.index(min(ring))
+    return ring[start:] + ring[:start]
+
+
+def normalize_geometry(geometry: dict, grid: float = 0.01) -> str:
+    """Return a canonical digest of a GeoJSON (Multi)Polygon with coordinates snapped to `grid` degrees."""
+    coordinates = geometry['coordinates']
+    if geometry.get('type') == 'MultiPolygon':
+        coordinates = sorted([[_normalize_ring(ring, grid) for ring in polygon] for polygon in coordinates])
+    else:
+        coordinates = [_normalize_ring(ring, grid) for ring in coordinates]
+
+    # a digest keeps the keys short however many vertices the geometry has
+    return hashlib.sha1(json.dumps(coordinates, separators=(',', ':')).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache that can optionally persist its entries to a JSON file.
+
+    Parameters:
+    maxsize: int, default 1024
+        Maximum number of entries held in memory; the least recently used one is evicted first.
+    path: str, optional
+        File where entries are persisted. It is read on creation and rewritten `save_delay` seconds after an
+        insert, with every insert made in the meantime, and at exit.
+    save_delay: float, default 5
+        Seconds between an insert and the rewrite of `path`.
+    """
+
+    def __init__(self, maxsize: int = 1024, path: Optional[str] = None, save_delay: float = 5.):
+        self.maxsize = maxsize
+        self.path = path
+        self.save_delay = save_delay
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._timer = None
+
+        if self.path:
+            if os.path.exists(self.path):
+                self._load()
+            atexit.register(self.flush)
+
+    @staticmethod
+    def make_key(*parts: Hashable) -> str:
+        return '|'.join(str(part) for part in parts)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self._schedule_save()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self._schedule_save()
+
+    def flush(self) -> None:
+        """Write the entries to `path` now rather than when the pending save is due."""
+        if not self.path:
+            return
+
+        with self._save_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                entries = list(self._data.items())
+            self._save(entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.,
+                'size': len(self._data),
+                'maxsize': self.maxsize}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            log.warning(f'[ResultCache]: could not read {self.path}, starting empty.')
+            return
+
+        for key, value in entries[-self.maxsize:]:
+            self._data[key] = value
+
+    def _schedule_save(self):
+        # inserts within `save_delay` of each other are written together, outside the lock of the readers
+        if not self.path or self._timer is not None:
+            return
+        self._timer = threading.Timer(self.save_delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _save(self, entries: list):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # write to a temporary file first so that a crash never leaves a truncated cache behind
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except (OSError, TypeError):
+            log.error(f'[ResultCache]: could not write {self.path}.')
@@ -0,0 +1,277 @@
+"""
+Resilient execution of the Earth Engine requests.
+
+Every `getInfo` and `getMapId` goes through an EEExecutor, which
+- waits at most `timeout` seconds for each attempt, the call runs on a bounded pool of its own,
+- retries transient and quota errors with jittered exponential backoff,
+- fails fast while a circuit breaker is open after repeated failures, so a degraded Earth Engine
+  does not hold Streamlit workers for the length of every timeout,
+- raises LimitExceeded when Earth Engine reports its memory or computation time limits, for the caller
+  to retry at an explicitly coarser scale, see ZonalStatistics.compute. A call without answer within the
+  deadline is not retried: Earth Engine is slow or unreachable, and waiting again would only hang the page.
+
+How the statistics of a request were produced is collected in an Outcome, across the threads working on it:
+
+    with execution.outcome() as outcome:
+        ...
+    outcome.describe()  # e.g. "Earth Engine, 1 retry"
+"""
+import contextlib
+import contextvars
+import logging
+import random
+import threading
+import time
+from concurrent import futures
+from typing import Callable, List, Optional, TypeVar
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# seconds an attempt may take, Earth Engine's own deadline is set to the same, see resources._init_ee
+CALL_TIMEOUT = 60.
+# Earth Engine calls running at the same time in the process; callers wait for a slot within their deadline
+MAX_EE_CALLS = 16
+
+# lower case fragments of the Earth Engine error messages, the limits are checked first
+LIMIT_ERRORS = ('memory limit', 'computation timed out', 'too many pixels', 'maxpixels')
+# the client gave up waiting, e.g. on the deadline of Earth Engine set in resources._init_ee or a socket timeout
+DEADLINE_ERRORS = ('deadline', 'timed out')
+TRANSIENT_ERRORS = ('too many concurrent', 'too many requests', 'quota', 'rate limit', 'service unavailable',
+                    'internal error', 'backend error', 'connection', 'temporarily', '429', '500', '502', '503')
+
+
+class ExecutionError(Exception):
+    pass
+
+
+class CircuitOpen(ExecutionError):
+    pass
+
+
+class LimitExceeded(ExecutionError):
+    """Earth Engine could not complete the request within its limits, a coarser scale may."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class DeadlineExceeded(ExecutionError):
+    pass
+
+
+def limit_reason(error: Exception) -> Optional[str]:
+    """The Earth Engine limit `error` reports, e.g. "memory limit", None if it is not about a limit."""
+    message = str(error).lower()
+    return next((fragment for fragment in LIMIT_ERRORS if fragment in message), None)
+
+
+def classify(error: Exception) -> str:
+    """'limit', 'deadline', 'transient' or 'permanent'."""
+    if isinstance(error, LimitExceeded) or limit_reason(error) is not None:
+        return 'limit'
+    message = str(error).lower()
+    if isinstance(error, (DeadlineExceeded, TimeoutError)) or any(fragment in message for fragment in DEADLINE_ERRORS):
+        return 'deadline'
+    if isinstance(error, (ConnectionError, OSError)):
+        return 'transient'
+    if any(fragment in message for fragment in TRANSIENT_ERRORS):
+        return 'transient'
+    return 'permanent'
+
+
+class CircuitBreaker:
+    """
+    Open after `failure_threshold` consecutive failures; let a single trial call through after `reset_timeout`
+    seconds, which closes it again if it succeeds.
+
+    Parameters:
+    failure_threshold: int, default 5
+        Consecutive failures opening the circuit.
+    reset_timeout: float, default 30.
+        Seconds the circuit stays open.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened is None:
+                return 'closed'
+            return 'half-open' if time.monotonic() - self._opened >= self.reset_timeout else 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened is None:
+                return True
+            if time.monotonic() - self._opened < self.reset_timeout or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                if self._opened is None or self._trial:
+                    log.error(f'[CircuitBreaker]: open for {self.reset_timeout:g}s after {self.failures} failures')
+                self._opened = time.monotonic()
+                self._trial = False
+
+
+class Outcome:
+    """How the statistics of a request were produced: the paths taken and the retries, from every thread."""
+
+    def __init__(self):
+        self.paths: List[str] = []
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def add(self, path: str):
+        with self._lock:
+            if path not in self.paths:
+                self.paths.append(path)
+
+    def retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def describe(self) -> str:
+        with self._lock:
+            paths = list(self.paths)
+            if self.retries:
+                paths.append(f'{self.retries} {"retry" if self.retries == 1 else "retries"}')
+        return ', '.join(paths)
+
+
+_outcome = contextvars.ContextVar('geopeto_outcome', default=None)
+
+
+@contextlib.contextmanager
+def outcome():
+    """Collect the paths of the enclosed request, including those of the work it submits with `metrics.bind`."""
+    current = Outcome()
+    token = _outcome.set(current)
+    try:
+        yield current
+    finally:
+        _outcome.reset(token)
+
+
+def record(path: str):
+    current = _outcome.get()
+    if current is not None:
+        current.add(path)
+
+
+class EEExecutor:
+    """
+    Run Earth Engine calls with a deadline, retries and a circuit breaker.
+
+    Parameters:
+    timeout: float, default CALL_TIMEOUT
+        Seconds each attempt may take, DeadlineExceeded is raised after that.
+    retries: int, default 3
+        Retries of transient and quota errors.
+    backoff: float, default 0.5
+        Upper bound, in seconds, of the first backoff, doubled on every retry; the actual wait is
+        drawn uniformly below it so that concurrent sessions do not retry in lockstep.
+    max_backoff: float, default 8.
+        Upper bound of any backoff.
+    breaker: CircuitBreaker, optional
+        Shared by every call of the executor.
+    max_calls: int, default MAX_EE_CALLS
+        Calls running at the same time.
+    """
+
+    def __init__(self, timeout: float = CALL_TIMEOUT, retries: int = 3, backoff: float = 0.5,
+                 max_backoff: float = 8., breaker: CircuitBreaker = None, max_calls: int = MAX_EE_CALLS):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._pool = futures.ThreadPoolExecutor(max_workers=max_calls, thread_name_prefix='geopeto-ee')
+
+    def run(self, call: Callable[[], T], operation: str = 'getInfo') -> T:
+        """Return the result of `call`, raise CircuitOpen, LimitExceeded, DeadlineExceeded or the last error."""
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                metrics.EE_ERRORS.labels(operation).inc()
+                raise CircuitOpen(f'Earth Engine is failing, {operation} not attempted')
+            try:
+                result = self._call(call)
+            except Exception as e:
+                metrics.EE_ERRORS.labels(operation).inc()
+                kind = classify(e)
+                log.warning(f'[EEExecutor]: {operation} failed ({kind}): {e}')
+                if kind == 'limit':
+                    # the request is too heavy, but Earth Engine answered
+                    self.breaker.success()
+                    raise LimitExceeded(limit_reason(e) or str(e)) from e
+                if kind == 'permanent':
+                    raise
+                self.breaker.failure()
+                if kind == 'deadline':
+                    if isinstance(e, DeadlineExceeded):
+                        raise
+                    # the client's own timeout fired first, see resources._init_ee
+                    raise DeadlineExceeded(str(e)) from e
+                if attempt >= self.retries:
+                    raise
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+                attempt += 1
+                metrics.EE_RETRIES.labels(operation).inc()
+                current = _outcome.get()
+                if current is not None:
+                    current.retry()
+                continue
+
+            self.breaker.success()
+            return result
+
+    def _call(self, call: Callable[[], T]) -> T:
+        future = self._pool.submit(metrics.bind(call))
+        try:
+            return future.result(timeout=self.timeout)
+        except futures.TimeoutError:
+            if future.done():
+                # raised by the call itself, futures.TimeoutError is the builtin TimeoutError since Python 3.11
+                raise
+            # a call that already started runs on, Earth Engine's own deadline ends it
+            future.cancel()
+            raise DeadlineExceeded(f'no answer within {self.timeout:g}s')
+
+
+_executor = EEExecutor()
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> EEExecutor:
+    return _executor
+
+
+def configure(**kwargs) -> EEExecutor:
+    """Replace the executor shared by the process, e.g. `configure(timeout=30.)`, see EEExecutor."""
+    global _executor
+    with _executor_lock:
+        _executor = EEExecutor(**kwargs)
+    return _executor
@@ -1,15 +1,177 @@
+import json
+import logging
+import math
 import re
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
 
+import numpy as np
+import shapely
 from geopy.geocoders import Nominatim
+from shapely import STRtree
 from shapely.geometry import box
 
+from . import metrics
+from .cache import ResultCache
+
+log = logging.getLogger(__name__)
+
+# Nominatim zoom of the reverse lookups, the address is resolved at county/region level
+GEOCODE_ZOOM = 8
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket; `acquire` blocks until a token is available, so bursts queue up.
+
+    Parameters:
+    rate: float, default 1.
+        Tokens added per second, Nominatim allows one request per second.
+    capacity: int, default 1
+        Maximum number of tokens, i.e. the largest burst.
+    """
+
+    def __init__(self, rate: float = 1., capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _haversine_km(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371. * math.asin(math.sqrt(a))
+
+
+def tile_of(lon: float, lat: float, zoom: int = GEOCODE_ZOOM) -> Tuple[int, int]:
+    """Slippy map tile containing the point."""
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.) / 360. * n) % n
+    y = int((1. - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2. * n)
+    return x, min(max(y, 0), n - 1)
+
+
+class ReverseGeocodeCache:
+    """
+    Cache of reverse geocoded points, indexed by the map tile they fall in at the lookup zoom.
+
+    A point reuses the result of the nearest cached point, searched in its own tile and the neighbouring
+    ones, if it is less than `max_distance_km` away.
+
+    Parameters:
+    max_distance_km: float, default 10.
+        Largest distance at which a cached result is reused.
+    maxsize: int, default 4096
+        Maximum number of tiles held.
+    path: str, optional
+        File where the cache is persisted, see ResultCache.
+    zoom: int, default GEOCODE_ZOOM
+        Zoom of the tile index.
+    """
+
+    # results kept per tile, the oldest are dropped first
+    MAX_PER_TILE = 16
+
+    def __init__(self, max_distance_km: float = 10., maxsize: int = 4096, path: str = None,
+                 zoom: int = GEOCODE_ZOOM):
+        self.max_distance_km = max_distance_km
+        self.zoom = zoom
+        self.cache = ResultCache(maxsize=maxsize, path=path)
+        self._lock = threading.Lock()
+
+    def _key(self, x: int, y: int) -> str:
+        return self.cache.make_key(self.zoom, x, y)
+
+    def get(self, lon: float, lat: float) -> Optional[Tuple[str, str]]:
+        x, y = tile_of(lon, lat, self.zoom)
+        n = 2 ** self.zoom
+        best, best_distance = None, self.max_distance_km
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if not 0 <= y + dy < n:
+                    continue
+                key = self._key((x + dx) % n, y + dy)
+                if key not in self.cache:
+                    continue
+                for c_lon, c_lat, region, country in self.cache.get(key) or []:
+                    distance = _haversine_km(lon, lat, c_lon, c_lat)
+                    if distance <= best_distance:
+                        best, best_distance = (region, country), distance
+        return best
+
+    def set(self, lon: float, lat: float, region: str, country: str):
+        key = self._key(*tile_of(lon, lat, self.zoom))
+        with self._lock:
+            entries = list(self.cache.get(key) or [])
+            entries.append([lon, lat, region, country])
+            self.cache.set(key, entries[-self.MAX_PER_TILE:])
+
+
+# Shared by every Geocoder of the process, so concurrent sessions respect the Nominatim usage policy together
+_rate_limiter = TokenBucket(rate=1., capacity=1)
+_cache = ReverseGeocodeCache()
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
 
 class Geocoder(Nominatim):
-    def __init__(self, user_agent):
+    def __init__(self, user_agent, cache: ReverseGeocodeCache = None, rate_limiter: TokenBucket = None):
         super().__init__(user_agent=user_agent)
+        self.cache = cache if cache is not None else _cache
+        self.rate_limiter = rate_limiter if rate_limiter is not None else _rate_limiter
 
     def reverse_geocode(self, center_point):
-        location = self.reverse("{}, {}".format(center_point.y, center_point.x), language='en', zoom=8, namedetails=True)
+        lon, lat = center_point.x, center_point.y
+        cached = self.cache.get(lon, lat)
+        metrics.cache_lookup('geocoder', cached is not None)
+        if cached is not None:
+            log.info(f'[Geocoder]: cache hit for {lat}, {lon}')
+            return tuple(cached)
+
+        # concurrent lookups of the same point wait for the request already on its way
+        key = (round(lon, 4), round(lat, 4))
+        with _in_flight_lock:
+            future = _in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = _in_flight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = self._reverse_geocode(center_point)
+            self.cache.set(lon, lat, *result)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with _in_flight_lock:
+                _in_flight.pop(key, None)
+
+    def _reverse_geocode(self, center_point):
+        self.rate_limiter.acquire()
+        location = self.reverse("{}, {}".format(center_point.y, center_point.x), language='en',
+                                zoom=GEOCODE_ZOOM, namedetails=True)
         location = str(location)
 
         # Remove all occurrences of numbers from the string
@@ -27,6 +189,98 @@ class Geocoder(Nominatim):
         return region, country
 
 
+
+def load_boundaries(path: str, name_field: str, country_field: str = None):
+    """
+    Read boundaries from a GeoJSON FeatureCollection or a GeoParquet file.
+
+    Returns the shapely geometries, their names and, if `country_field` is given, their country names.
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+        geometries = shapely.from_wkb(table.column('geometry').to_numpy(zero_copy_only=False))
+        names = table.column(name_field).to_pylist()
+        countries = table.column(country_field).to_pylist() if country_field else None
+    else:
+        with open(path) as f:
+            features = json.load(f)['features']
+        geometries = shapely.from_geojson([json.dumps(feature['geometry']) for feature in features])
+        names = [feature['properties'].get(name_field) for feature in features]
+        countries = [feature['properties'].get(country_field) for feature in features] if country_field else None
+
+    return np.asarray(geometries), names, countries
+
+
+class OfflineGeocoder:
+    """
+    Reverse geocoder resolving points against local admin-0/admin-1 boundaries, without network access.
+
+    Boundaries are loaded once and indexed with an STRtree, each lookup is a point-in-polygon query.
+    It has the same `reverse_geocode(center_point) -> (region, country)` interface as Geocoder.
+    Points outside every boundary, e.g. at sea, resolve to the nearest one within `max_distance`.
+
+    Parameters:
+    admin1_path: str
+        GeoJSON or GeoParquet of the first level subdivisions, e.g. Natural Earth admin-1 states and provinces.
+    admin0_path: str, optional
+        Countries, used for the points that fall in no subdivision.
+    region_field: str, default "name"
+        Property holding the name of a subdivision.
+    country_field: str, default "admin"
+        Property of the subdivisions holding their country name.
+    admin0_field: str, default "ADMIN"
+        Property of the countries holding their name.
+    max_distance: float, default 0.5
+        Largest distance, in degrees, at which the nearest boundary is used.
+    """
+
+    def __init__(self, admin1_path: str, admin0_path: str = None, region_field: str = "name",
+                 country_field: str = "admin", admin0_field: str = "ADMIN", max_distance: float = 0.5):
+        self.max_distance = max_distance
+        geometries, self.regions, self.countries = load_boundaries(admin1_path, region_field, country_field)
+        self.admin1 = STRtree(geometries)
+
+        self.admin0 = None
+        if admin0_path is not None:
+            geometries, self.admin0_names, _ = load_boundaries(admin0_path, admin0_field)
+            self.admin0 = STRtree(geometries)
+
+    def _lookup(self, tree, points):
+        """Index in `tree` of the boundary of every point, -1 if none."""
+        index = np.full(len(points), -1, dtype=np.int64)
+        point_idx, tree_idx = tree.query(points, predicate='intersects')
+        # a point on a shared border belongs to the first boundary found
+        index[point_idx[::-1]] = tree_idx[::-1]
+
+        missing = np.flatnonzero(index < 0)
+        if missing.size and self.max_distance:
+            point_idx, tree_idx = tree.query_nearest(points[missing], max_distance=self.max_distance,
+                                                     all_matches=False)
+            index[missing[point_idx]] = tree_idx
+        return index
+
+    def reverse_geocode_many(self, points) -> List[Tuple[str, str]]:
+        """Resolve many shapely points at once, returns one `(region, country)` per point."""
+        points = np.asarray(points)
+        admin1 = self._lookup(self.admin1, points)
+        admin0 = self._lookup(self.admin0, points) if self.admin0 is not None else None
+
+        results = []
+        for i, j in enumerate(admin1):
+            if j >= 0:
+                results.append((self.regions[j] or '', self.countries[j] or ''))
+            elif admin0 is not None and admin0[i] >= 0:
+                results.append(('', self.admin0_names[admin0[i]] or ''))
+            else:
+                results.append(('', ''))
+        return results
+
+    def reverse_geocode(self, center_point) -> Tuple[str, str]:
+        return self.reverse_geocode_many([center_point])[0]
+
+
 if __name__ == '__main__':
     # Define bbox
     bbox = (-2.1860969951349887, 43.04779100897747, -2.16548765387617, 43.058403937201916)
@@ -1,18 +1,35 @@
-import os
-import openai
-from dotenv import load_dotenv
+import hashlib
+import json
+from typing import Iterator
 
-load_dotenv()  # take environment variables from .env.
+from . import metrics, resources
+from .cache import ResultCache
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+
+# Only the significant digits of the prompt inputs are part of the cache key, the prompt shows one decimal
+SIGNATURE_DECIMALS = 1
 
 
 class GeoDescriber:
-    def __init__(self, model_name):
+    def __init__(self, model_name, cache: ResultCache = None):
         self.model_name = model_name
         self.prompt = None
+        # descriptions are reused for identical prompt inputs, see `signature`
+        self.cache = cache
 
-    def generate_description(self, land_cover_per, climate_per, region_name, country):
+    def signature(self, land_cover_per, climate_per, region_name, country) -> str:
+        """Canonical key of the prompt inputs: rounded percentages, region, country and model."""
+        def rounded(fractions):
+            return sorted((name, round(fraction, SIGNATURE_DECIMALS)) for name, fraction in fractions.items())
+
+        payload = json.dumps({'model': self.model_name,
+                              'region': region_name,
+                              'country': country,
+                              'land_cover': rounded(land_cover_per),
+                              'climate': rounded(climate_per)}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def build_prompt(self, land_cover_per, climate_per, region_name, country):
         input_text = f"I am analyzing a region whose centroid has the following address: {region_name}, {country}." \
             f"The Köppen climate classification distribution in that region consists of:"
         for climate, fraction in climate_per.items():
@@ -31,7 +48,12 @@ class GeoDescriber:
         #self.prompt = f"{input_text}\n\nDescribe the climate, landscape, and geography of this region:"
         self.prompt = f"{input_text}\n\nDescribe the climate, landscape, and socioeconomics of the region:"
 
-        response = openai.Completion.create(
+        return self.prompt
+
+    def _create_completion(self, stream: bool = False):
+        # the client and its API key are set up on first use, not when the app starts
+        openai = resources.get('openai')
+        return openai.Completion.create(
             #engine="davinci",
             model=self.model_name,
             prompt=self.prompt,
@@ -39,8 +61,57 @@ class GeoDescriber:
             temperature=1,
             n=1,
             stop=None,  # add a stop sequence to indicate the end of the paragraph
+            stream=stream,
         )
-        return response.choices[0].text.strip()
+
+    def generate_description(self, land_cover_per, climate_per, region_name, country):
+        key = None
+        if self.cache is not None:
+            key = self.signature(land_cover_per, climate_per, region_name, country)
+            description = self.cache.get(key)
+            metrics.cache_lookup('description', description is not None)
+            if description is not None:
+                return description
+
+        self.build_prompt(land_cover_per, climate_per, region_name, country)
+        with metrics.span('describe', self.model_name):
+            description = self._create_completion().choices[0].text.strip()
+
+        if key is not None:
+            self.cache.set(key, description)
+        return description
+
+    def stream_description(self, land_cover_per, climate_per, region_name, country) -> Iterator[str]:
+        """
+        Yield the description piece by piece as the model generates it.
+
+        A cached description is yielded at once; a streamed one is cached once it is complete.
+        """
+        key = None
+        if self.cache is not None:
+            key = self.signature(land_cover_per, climate_per, region_name, country)
+            description = self.cache.get(key)
+            metrics.cache_lookup('description', description is not None)
+            if description is not None:
+                yield description
+                return
+
+        self.build_prompt(land_cover_per, climate_per, region_name, country)
+        pieces = []
+        # the span includes the time the caller takes to show each piece
+        with metrics.span('describe', self.model_name):
+            for chunk in self._create_completion(stream=True):
+                text = chunk.choices[0].text
+                # leading whitespace is stripped like in generate_description
+                if not pieces:
+                    text = text.lstrip()
+                    if not text:
+                        continue
+                pieces.append(text)
+                yield text
+
+        if key is not None:
+            self.cache.set(key, ''.join(pieces).strip())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+"""
+Preparation of the AOIs: drawn rectangles and polygons as well as uploaded GeoJSON boundaries.
+
+AOIs are validated on all their vertices at once, repaired, wrapped to [-180, 180] and split along the
+antimeridian into a MultiPolygon when they cross it. Before a geometry is sent to Earth Engine it is
+simplified, without changing its topology, to a tolerance tied to the pixel size of the reduced dataset,
+so detailed boundaries do not inflate the request payload or the server-side clipping cost.
+"""
+import json
+import logging
+from typing import Optional, Union
+
+import numpy as np
+import shapely
+from shapely.affinity import translate
+from shapely.geometry import MultiPolygon, Point, Polygon, box, mapping, shape
+from shapely.geometry.polygon import orient
+from shapely.validation import make_valid
+
+from .verification import coordinates_array, selected_bbox_in_boundary
+
+log = logging.getLogger(__name__)
+
+# Simplification tolerance, as a fraction of the pixel size. Vertices closer than half a pixel to the
+# simplified boundary change which pixel centres fall inside it by less than one pixel along the edge.
+SIMPLIFY_PIXELS = 0.5
+# Upper bound of the vertices sent to Earth Engine, the tolerance is doubled until the AOI fits.
+MAX_VERTICES = 5000
+
+
+def validate(geometry: dict) -> Optional[str]:
+    """Reason why the AOI cannot be analysed, None if it can."""
+    if geometry.get('type') not in ('Polygon', 'MultiPolygon'):
+        return f"Only polygons can be analysed, got {geometry.get('type')}."
+    try:
+        coordinates = coordinates_array(geometry)
+    except (KeyError, ValueError, IndexError, TypeError):
+        return "The coordinates of the region are malformed."
+    if coordinates.size == 0 or not np.isfinite(coordinates).all():
+        return "The coordinates of the region are malformed."
+    if not selected_bbox_in_boundary(geometry):
+        return "The region extends beyond the poles or wraps around the whole world."
+    return None
+
+
+def split_antimeridian(aoi: Union[Polygon, MultiPolygon]) -> Union[Polygon, MultiPolygon]:
+    """Shift `aoi` by whole turns so it starts in [-180, 180) and cut what exceeds 180 back to the west."""
+    min_x = aoi.bounds[0]
+    aoi = translate(aoi, xoff=-360 * np.floor((min_x + 180) / 360))
+    if aoi.bounds[2] <= 180:
+        return aoi
+
+    west = aoi.intersection(box(-180, -90, 180, 90))
+    east = translate(aoi.intersection(box(180, -90, 540, 90)), xoff=-360)
+    return MultiPolygon([polygon for part in (west, east) for polygon in _polygons(part) if polygon.area > 0])
+
+
+def prepare_aoi(geometry: dict) -> dict:
+    """
+    Validate and normalise an AOI: repair it, drop degenerate parts, orient the rings counter-clockwise,
+    wrap it to [-180, 180] and split it along the antimeridian. Raises ValueError if it is not valid.
+    """
+    reason = validate(geometry)
+    if reason is not None:
+        raise ValueError(reason)
+
+    aoi = shape(geometry)
+    if not aoi.is_valid:
+        # e.g. self-intersecting drawings or overlapping uploaded features
+        aoi = make_valid(aoi)
+    polygons = [orient(polygon) for polygon in _polygons(aoi) if polygon.area > 0]
+    if not polygons:
+        raise ValueError("The region has no area.")
+
+    aoi = polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
+    return _to_geojson(split_antimeridian(aoi))
+
+
+def simplify(geometry: dict, pixel_size: float) -> dict:
+    """
+    Simplify an AOI to SIMPLIFY_PIXELS times `pixel_size` degrees, keeping its topology, and further
+    until it has at most MAX_VERTICES vertices. Rectangles are returned as they are.
+    """
+    vertices = len(coordinates_array(geometry))
+    if vertices <= 5 or not pixel_size:
+        return geometry
+
+    aoi = shape(geometry)
+    tolerance = pixel_size * SIMPLIFY_PIXELS
+    simplified = aoi.simplify(tolerance, preserve_topology=True)
+    while shapely.get_num_coordinates(simplified) > MAX_VERTICES:
+        tolerance *= 2
+        simplified = aoi.simplify(tolerance, preserve_topology=True)
+
+    log.info(f'[simplify]: {vertices} -> {shapely.get_num_coordinates(simplified)} vertices, '
+             f'tolerance {tolerance:g} degrees')
+    return _to_geojson(simplified)
+
+
+def center(geometry: dict):
+    """Centre of the bounding box of an AOI, taken on the side of the antimeridian it lies on."""
+    aoi = shape(geometry)
+    min_x, _, max_x, _ = aoi.bounds
+    if isinstance(aoi, MultiPolygon) and max_x - min_x > 180:
+        # parts split along the antimeridian: move the western ones next to the eastern ones
+        aoi = MultiPolygon([translate(p, xoff=360) if p.bounds[2] <= 0 else p for p in aoi.geoms])
+    point = aoi.envelope.centroid
+    return Point(((point.x + 180) % 360) - 180, point.y)
+
+
+def read_geojson(data: Union[str, bytes, dict]) -> dict:
+    """
+    The AOI of an uploaded GeoJSON: a geometry, a Feature or a FeatureCollection, whose polygons
+    are combined into one MultiPolygon.
+    """
+    if not isinstance(data, dict):
+        data = json.loads(data)
+
+    if data.get('type') == 'FeatureCollection':
+        geometries = [feature.get('geometry') for feature in data.get('features', [])]
+    elif data.get('type') == 'Feature':
+        geometries = [data.get('geometry')]
+    else:
+        geometries = [data]
+
+    polygons = []
+    for geometry in geometries:
+        if geometry is None:
+            continue
+        if geometry.get('type') == 'Polygon':
+            polygons.append(geometry['coordinates'])
+        elif geometry.get('type') == 'MultiPolygon':
+            polygons.extend(geometry['coordinates'])
+    if not polygons:
+        raise ValueError("The file holds no polygon.")
+
+    if len(polygons) == 1:
+        return {'type': 'Polygon', 'coordinates': polygons[0]}
+    return {'type': 'MultiPolygon', 'coordinates': polygons}
+
+
+def _polygons(aoi) -> list:
+    """The polygons of any geometry, collections of the output of make_valid included."""
+    if isinstance(aoi, Polygon):
+        return [aoi]
+    return [polygon for part in getattr(aoi, 'geoms', []) for polygon in _polygons(part)]
+
+
+def _to_geojson(aoi) -> dict:
+    geometry = mapping(aoi)
+    # plain lists, so the geometry can be serialised and compared like the GeoJSON of the map
+    return json.loads(json.dumps(geometry))
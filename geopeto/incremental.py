@@ -0,0 +1,124 @@
+"""
+Incremental reductions of rectangles nudged by the user, from the strips added and removed since the last one.
+"""
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from shapely.geometry import box, mapping, shape
+
+from . import metrics
+from .tiling import compute_all, merge_histograms
+
+log = logging.getLogger(__name__)
+
+# Above this fraction of the area of the new rectangle, reducing the strips is no cheaper than reducing it whole.
+MAX_CHANGED_FRACTION = 0.5
+
+Bounds = Tuple[float, float, float, float]
+
+
+def rectangle_bounds(geometry: dict) -> Optional[Bounds]:
+    """Bounds of an axis-aligned rectangle, None for any other geometry."""
+    if geometry.get('type') != 'Polygon':
+        return None
+    aoi = shape(geometry)
+    return aoi.bounds if aoi.equals(aoi.envelope) else None
+
+
+def subtract_rectangle(a: Bounds, b: Bounds) -> List[Bounds]:
+    """Split the part of rectangle `a` outside rectangle `b` into at most four rectangles."""
+    min_x, min_y = max(a[0], b[0]), max(a[1], b[1])
+    max_x, max_y = min(a[2], b[2]), min(a[3], b[3])
+    if min_x >= max_x or min_y >= max_y:
+        return [a]
+
+    strips = [(a[0], a[1], min_x, a[3]),      # west, full height
+              (max_x, a[1], a[2], a[3]),      # east, full height
+              (min_x, a[1], max_x, min_y),    # south, between west and east
+              (min_x, max_y, max_x, a[3])]    # north, between west and east
+    return [s for s in strips if s[2] > s[0] and s[3] > s[1]]
+
+
+def _area(bounds: Bounds) -> float:
+    return (bounds[2] - bounds[0]) * (bounds[3] - bounds[1])
+
+
+def _negate(histogram: dict) -> dict:
+    return {key: _negate(value) if isinstance(value, dict) else -value
+            for key, value in histogram.items() if value is not None}
+
+
+def _prune(histogram: dict) -> dict:
+    # classes that were only in the removed strips cancel out, up to rounding of the weighted counts
+    return {key: _prune(value) if isinstance(value, dict) else value
+            for key, value in histogram.items() if isinstance(value, dict) or value > 1e-9}
+
+
+def apply_delta(histogram: dict, added: List[dict], removed: List[dict]) -> dict:
+    """Add the histograms of the `added` strips to `histogram` and subtract those of the `removed` ones."""
+    return _prune(merge_histograms([histogram] + added + [_negate(h) for h in removed]))
+
+
+class LastAOI:
+    """
+    The last rectangle reduced by a session and its raw histograms, per reduction setting.
+
+    Parameters:
+    max_changed_fraction: float, default MAX_CHANGED_FRACTION
+        Largest area of the added and removed strips, as a fraction of the area of the new rectangle,
+        for which they are reduced instead of the whole rectangle.
+    """
+
+    def __init__(self, max_changed_fraction: float = MAX_CHANGED_FRACTION):
+        self.max_changed_fraction = max_changed_fraction
+        self._last: Dict[str, Tuple[Bounds, dict]] = {}
+        self._lock = threading.Lock()
+
+    def remember(self, setting: str, geometry: dict, histogram: dict):
+        bounds = rectangle_bounds(geometry)
+        with self._lock:
+            if bounds is not None and histogram:
+                self._last[setting] = (bounds, histogram)
+            else:
+                self._last.pop(setting, None)
+
+    def reduce(self, setting: str, geometry: dict, compute: Callable[[dict], dict],
+               succeeded: Callable[[dict], bool] = bool) -> dict:
+        """
+        The raw histogram of `geometry`, from the strips that changed since the last rectangle of `setting`
+        if that is cheaper, otherwise from `compute` on the whole geometry.
+
+        `compute` must not be cached by snapped geometry, strips can be thinner than the grid of the cache.
+        `succeeded` tells failed results of `compute` apart, they are never used nor remembered.
+        """
+        histogram = self._reduce_delta(setting, geometry, compute, succeeded)
+        metrics.cache_lookup('last_aoi', histogram is not None)
+        if histogram is None:
+            histogram = compute(geometry)
+        self.remember(setting, geometry, histogram if succeeded(histogram) else {})
+        return histogram
+
+    def _reduce_delta(self, setting: str, geometry: dict, compute: Callable[[dict], dict],
+                      succeeded: Callable[[dict], bool]) -> Optional[dict]:
+        bounds = rectangle_bounds(geometry)
+        with self._lock:
+            last = self._last.get(setting)
+        if bounds is None or last is None:
+            return None
+
+        last_bounds, last_histogram = last
+        added, removed = subtract_rectangle(bounds, last_bounds), subtract_rectangle(last_bounds, bounds)
+        changed = sum(_area(s) for s in added + removed)
+        if changed > self.max_changed_fraction * _area(bounds):
+            return None
+
+        strips = [mapping(box(*s)) for s in added + removed]
+        histograms = compute_all(compute, strips)
+        if not all(succeeded(h) for h in histograms):
+            log.error('[LastAOI]: at least one strip failed, reducing the whole region.')
+            return None
+
+        log.info(f'[LastAOI]: {setting}: {len(added)} strips added, {len(removed)} removed, '
+                 f'{changed / _area(bounds):.1%} of the region')
+        return apply_delta(last_histogram, histograms[:len(added)], histograms[len(added):])
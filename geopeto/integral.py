@@ -0,0 +1,272 @@
+"""
+Per-class integral images (summed-area tables) of the categorical GEEData layers.
+
+An index is built once from a local raster with `python -m geopeto.integral` and stores, for each
+pyramid level, the cumulative class counts of blocks of 2**level pixels in a memory-mapped uint32 file.
+The histogram of any rectangle then costs four lookups per class for the interior blocks of the coarsest
+level, the same for the blocks of the finer levels in the rim around them, plus reading the thin strips of
+pixels along its edges from the raster, so the counts are exact at every level.
+
+Counts are accumulated modulo 2**32. The difference of four corners is still exact as long as a single
+rectangle holds fewer than 2**32 pixels, which keeps the files at half the size of uint64 tables.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+from shapely.geometry import shape
+
+from .backends import LocalRasterBackend, pixel_bounds
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the pixels and of the block counts, blocks * classes, held in memory while building.
+CHUNK_PIXELS = 16 * 1024 * 1024
+CHUNK_CELLS = 64 * 1024 * 1024
+
+
+def _class_lut(codes: List[int]) -> np.ndarray:
+    """Map every class code to the index of its class, -1 for values that are not a class."""
+    lut = np.full(max(codes) + 1, -1, dtype=np.int16)
+    lut[codes] = np.arange(len(codes))
+    return lut
+
+
+def _classify(data: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    data = data.astype(np.int64, copy=False)
+    classes = np.full(data.shape, -1, dtype=np.int16)
+    valid = (data >= 0) & (data < lut.size)
+    classes[valid] = lut[data[valid]]
+    return classes
+
+
+def _level_path(index_dir: str, level: int) -> str:
+    return os.path.join(index_dir, f'level_{level}.u32')
+
+
+def build_index(raster_path: str, gee_data, index_dir: str, levels: List[int] = (4, 6, 8), band: int = 1) -> dict:
+    """
+    Build the integral image pyramid of a categorical raster in EPSG:4326.
+
+    Parameters:
+    raster_path: str
+        Local raster holding the class codes of `gee_data`.
+    gee_data: GEEData
+        Dataset of the raster, its class names define the classes that are counted.
+    index_dir: str
+        Directory where the index is written.
+    levels: list of int, default (4, 6, 8)
+        Pyramid levels to build, level `l` counts blocks of 2**l x 2**l pixels. Level 0 needs no
+        raster reads at query time but takes 4 bytes per pixel and class.
+    band: int, default 1
+        Band of the raster holding the class codes.
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    codes = gee_data.spec.codes.tolist()
+    levels = sorted(set(levels))
+    os.makedirs(index_dir, exist_ok=True)
+
+    with rasterio.open(raster_path) as src:
+        lut = _class_lut(codes)
+        height, width, n_classes = src.height, src.width, len(codes)
+
+        factors = {level: 2 ** level for level in levels}
+        shapes = {level: (math.ceil(height / f), math.ceil(width / f)) for level, f in factors.items()}
+        outputs = {level: np.memmap(_level_path(index_dir, level), dtype=np.uint32, mode='w+',
+                                    shape=(h + 1, w + 1, n_classes))
+                   for level, (h, w) in shapes.items()}
+        for out in outputs.values():
+            out[0] = 0
+            out[:, 0] = 0
+
+        # chunks span whole blocks of the coarsest level and are sized by the finest one
+        max_f, min_f = max(factors.values()), min(factors.values())
+        rows = min(CHUNK_CELLS // max(1, math.ceil(width / min_f) * n_classes) * min_f,
+                   CHUNK_PIXELS // width)
+        rows = max(max_f, rows // max_f * max_f)
+
+        for row in range(0, height, rows):
+            window = Window(0, row, width, min(rows, height - row))
+            classes = _classify(src.read(band, window=window), lut)
+            r, c = np.nonzero(classes >= 0)
+            k = classes[r, c]
+
+            for level, f in factors.items():
+                h, w = shapes[level]
+                block_row = row // f
+                n_rows = math.ceil(window.height / f)
+                cells = ((r // f) * w + (c // f)) * n_classes + k
+                counts = np.bincount(cells, minlength=n_rows * w * n_classes)
+                counts = counts.reshape(n_rows, w, n_classes).astype(np.uint32)
+
+                # integrate along columns and rows; uint32 wraps around, see the module docstring
+                integral = np.cumsum(np.cumsum(counts, axis=1, dtype=np.uint32), axis=0, dtype=np.uint32)
+                out = outputs[level]
+                out[block_row + 1:block_row + 1 + n_rows, 1:] = integral + out[block_row, 1:]
+
+            log.info(f'[build_index]: {gee_data.dataset} rows {row + window.height}/{height}')
+
+        for out in outputs.values():
+            out.flush()
+
+        metadata = {'dataset': gee_data.dataset,
+                    'raster': os.path.abspath(raster_path),
+                    'band': band,
+                    'transform': list(src.transform)[:6],
+                    'height': height,
+                    'width': width,
+                    'codes': codes,
+                    'levels': {str(level): list(shapes[level]) for level in levels}}
+
+    with open(os.path.join(index_dir, 'index.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+    return metadata
+
+
+class IntegralIndex:
+    """
+    Query engine of an index written by `build_index`.
+
+    Parameters:
+    index_dir: str
+        Directory of the index.
+    levels: list of int, optional
+        Levels to memory-map, all the built levels if not given. Finer levels leave thinner edge
+        strips to read from the raster, coarser ones cover the interior with fewer pages of the index.
+    """
+
+    def __init__(self, index_dir: str, levels: List[int] = None):
+        from affine import Affine
+
+        with open(os.path.join(index_dir, 'index.json')) as f:
+            self.metadata = json.load(f)
+
+        self.transform = Affine(*self.metadata['transform'])
+        self.codes = self.metadata['codes']
+        self.lut = _class_lut(self.codes)
+        # coarsest level first, it covers the interior with the fewest blocks, see _count_blocks
+        self.levels = {}
+        for level, (h, w) in sorted(self.metadata['levels'].items(), key=lambda x: -int(x[0])):
+            if levels is not None and int(level) not in levels:
+                continue
+            self.levels[int(level)] = np.memmap(_level_path(index_dir, int(level)), dtype=np.uint32, mode='r',
+                                                shape=(h + 1, w + 1, len(self.codes)))
+
+    def pixel_window(self, bounds: Tuple[float, float, float, float]) -> Tuple[int, int, int, int]:
+        return pixel_bounds(self.transform, bounds, self.metadata['height'], self.metadata['width'])
+
+    def counts(self, bounds: Tuple[float, float, float, float]) -> np.ndarray:
+        """Count the pixels of every class whose centres fall inside `bounds`, in the order of `codes`."""
+        r0, r1, c0, c1 = self.pixel_window(bounds)
+        counts = np.zeros(len(self.codes), dtype=np.int64)
+        if r0 >= r1 or c0 >= c1:
+            return counts
+
+        edges = self._count_blocks((r0, r1, c0, c1), list(self.levels), counts)
+        if edges:
+            counts += self._read_counts(edges)
+
+        return counts
+
+    def _count_blocks(self, window: Tuple[int, int, int, int], levels: List[int],
+                      counts: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        """
+        Add the counts of the whole blocks of `window` to `counts`, the interior from the coarsest of `levels`
+        that has one and the rim around it from the finer ones. Returns the windows left to read from the raster.
+        """
+        r0, r1, c0, c1 = window
+        if r0 >= r1 or c0 >= c1:
+            return []
+
+        for n, level in enumerate(levels):
+            f = 2 ** level
+            bi0, bi1 = math.ceil(r0 / f), r1 // f
+            bj0, bj1 = math.ceil(c0 / f), c1 // f
+            if bi1 <= bi0 or bj1 <= bj0:
+                continue
+
+            table = self.levels[level]
+            interior = (table[bi1, bj1] - table[bi0, bj1] - table[bi1, bj0] + table[bi0, bj0])
+            counts += interior.astype(np.int64)
+
+            # pixels of the window outside the interior blocks: top, bottom, left and right strips
+            i0, i1, j0, j1 = bi0 * f, bi1 * f, bj0 * f, bj1 * f
+            edges = []
+            for rim in [(r0, i0, c0, c1), (i1, r1, c0, c1), (i0, i1, c0, j0), (i0, i1, j1, c1)]:
+                edges += self._count_blocks(rim, levels[n + 1:], counts)
+            return edges
+
+        return [window]
+
+    def histogram(self, bounds: Tuple[float, float, float, float]) -> dict:
+        counts = self.counts(bounds)
+        return {'b1': {str(code): int(count) for code, count in zip(self.codes, counts) if count}}
+
+    def _read_counts(self, windows: List[Tuple[int, int, int, int]]) -> np.ndarray:
+        import rasterio
+        from rasterio.windows import Window
+
+        counts = np.zeros(len(self.codes), dtype=np.int64)
+        with rasterio.open(self.metadata['raster']) as src:
+            for r0, r1, c0, c1 in windows:
+                classes = _classify(src.read(self.metadata['band'], window=Window(c0, r0, c1 - c0, r1 - r0)),
+                                    self.lut)
+                counts += np.bincount(classes[classes >= 0].astype(np.int64), minlength=len(self.codes))
+        return counts
+
+
+class IntegralIndexBackend:
+    """
+    ZonalStatistics backend answering rectangles from integral image indexes.
+
+    Other shapes, and datasets without an index, are read with LocalRasterBackend.
+
+    Parameters:
+    index_dirs: dict
+        Mapping of dataset name to the directory of its index.
+    raster_paths: dict, optional
+        Mapping of dataset name to the path or URL of its raster, for the datasets without an index.
+        The rasters of the indexed datasets are those they were built from.
+    """
+
+    name = 'integral'
+
+    def __init__(self, index_dirs: Dict[str, str], raster_paths: Dict[str, str] = None):
+        self.indexes = {dataset: IntegralIndex(index_dir) for dataset, index_dir in index_dirs.items()}
+        self.fallback = LocalRasterBackend({**(raster_paths or {}),
+                                            **{dataset: index.metadata['raster']
+                                               for dataset, index in self.indexes.items()}})
+
+    def histogram(self, gee_data, geometry: dict) -> dict:
+        aoi = shape(geometry)
+        index = self.indexes.get(gee_data.dataset)
+        if index is None or not aoi.equals(aoi.envelope):
+            if gee_data.dataset not in self.fallback.paths:
+                raise ValueError(f'{gee_data.dataset} has neither an integral index nor a raster')
+            return self.fallback.histogram(gee_data, geometry)
+
+        stats = index.histogram(aoi.bounds)
+        log.info(f'[IntegralIndexBackend]: {gee_data.dataset} stats: {stats["b1"]}')
+        return stats
+
+
+if __name__ == '__main__':
+    from .data import GEEData
+
+    parser = argparse.ArgumentParser(description='Build the integral image index of a categorical GEEData layer.')
+    parser.add_argument('dataset', help='dataset name, e.g. Global-Land-Cover')
+    parser.add_argument('raster', help='local GeoTIFF/COG of the dataset in EPSG:4326')
+    parser.add_argument('index_dir', help='output directory')
+    parser.add_argument('--levels', type=int, nargs='+', default=[4, 6, 8],
+                        help='pyramid levels, level l counts blocks of 2**l pixels')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_index(args.raster, GEEData(args.dataset), args.index_dir, levels=args.levels)
@@ -0,0 +1,187 @@
+"""
+Queue of the analyses of the Streamlit sessions, which poll their job rather than run it in their script thread.
+
+A job identical to one still queued or running is not run again, the sessions share the job in flight.
+
+    job, coalesced = jobs.analyse(geojson, plan)
+    ...
+    job = jobs.get(job.id)
+    if job.done:
+        ...
+"""
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import metrics
+from .admission import Plan
+from .cache import ResultCache, normalize_geometry
+from .incremental import LastAOI
+from .pipeline import AnalysisPipeline
+from .timeseries import LandCoverChange
+
+log = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# analyses running at the same time in the process, the others wait in the queue
+MAX_JOBS = 4
+# seconds a finished job can still be polled
+JOB_RETENTION = 15 * 60
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    key: str
+    status: str = QUEUED
+    # fraction of the tiles reduced so far
+    progress: float = 0.
+    # set as soon as the statistics are known, before the description is generated
+    result: Any = None
+    # description received so far
+    text: str = ''
+    error: Optional[str] = None
+    # why the region could not be described, the statistics in `result` are still valid
+    description_error: Optional[str] = None
+    # stage timings of the run, see metrics.Trace.breakdown
+    trace: List[dict] = field(default_factory=list)
+    # sessions waiting for it
+    waiters: int = 1
+    submitted: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+
+class JobManager:
+    """
+    Run the analyses of every session on a shared pool, coalescing identical ones in flight.
+
+    Parameters:
+    pipeline: AnalysisPipeline
+        Pipeline of the analyses and refinements, its datasets and cache grid are part of the job keys.
+    max_jobs: int, default MAX_JOBS
+        Jobs running at the same time.
+    retention: float, default JOB_RETENTION
+        Seconds a finished job can still be polled.
+    """
+
+    def __init__(self, pipeline: AnalysisPipeline, max_jobs: int = MAX_JOBS, retention: float = JOB_RETENTION):
+        self.pipeline = pipeline
+        self.retention = retention
+        self._jobs: Dict[str, Job] = {}
+        self._in_flight: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='geopeto-job')
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """The job of `job_id`, None once it has expired."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def key(self, kind: str, geometry: dict, *parts) -> str:
+        return ResultCache.make_key(kind, *self.pipeline.datasets, *parts,
+                                    normalize_geometry(geometry, grid=self.pipeline.cache_grid))
+
+    def analyse(self, geojson: dict, plan: Plan = None, last_aoi: LastAOI = None) -> Tuple[Job, bool]:
+        """
+        Queue the analysis of `geojson`, see AnalysisPipeline.run, and whether it was coalesced with one in flight.
+
+        Check the region with `AnalysisPipeline.check_region` first, the job does not: it cannot write to the page.
+        The `last_aoi` of the session is only used if the job is not coalesced.
+        """
+        def work(job: Job):
+            def on_stats(result):
+                job.result = result
+
+            def on_progress(fraction):
+                job.progress = fraction
+
+            def on_text(text):
+                job.text = text
+
+            try:
+                return self.pipeline.run(geojson, on_stats=on_stats, on_progress=on_progress, on_text=on_text,
+                                         plan=plan, last_aoi=last_aoi, check=False)
+            except Exception as e:
+                if job.result is None:
+                    raise
+                # the statistics are known, only the location or the description failed
+                log.exception(f'[JobManager]: analyse job {job.id} could not describe the region')
+                job.description_error = str(e)
+                job.result.description = None
+                return job.result
+
+        return self.submit('analyse', self.key('analyse', geojson['geometry'], *_plan_parts(plan)), work)
+
+    def refine(self, geojson: dict, plan: Plan) -> Tuple[Job, bool]:
+        """Queue the statistics of `geojson` with `plan`, see AnalysisPipeline.refine."""
+        return self.submit('refine', self.key('refine', geojson['geometry'], *_plan_parts(plan)),
+                           lambda job: self.pipeline.refine(geojson, plan).result())
+
+    def land_cover_change(self, change: LandCoverChange, geometry: dict, years: List[int]) -> Tuple[Job, bool]:
+        """Queue the land cover change of `geometry` over `years`, see LandCoverChange.compute."""
+        years = sorted(set(years))
+        return self.submit('change', self.key('change', geometry, change.dataset, *years),
+                           lambda job: change.compute(geometry, years))
+
+    def submit(self, kind: str, key: str, work: Callable[[Job], Any]) -> Tuple[Job, bool]:
+        """
+        Queue `work(job)`, its return value becoming the result of the job, unless a job of `key` is in flight.
+
+        Returns the job and whether it was coalesced with the one in flight.
+        """
+        with self._lock:
+            self._expire()
+            job = self._in_flight.get(key)
+            metrics.cache_lookup('in_flight_jobs', job is not None)
+            if job is not None:
+                job.waiters += 1
+                log.info(f'[JobManager]: {kind} coalesced with job {job.id}, {job.waiters} waiters')
+                return job, True
+
+            job = Job(id=uuid.uuid4().hex, kind=kind, key=key)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job
+
+        metrics.JOBS.labels(kind, QUEUED).inc()
+        self._executor.submit(self._run, job, work)
+        return job, False
+
+    def _run(self, job: Job, work: Callable[[Job], Any]):
+        metrics.JOB_WAIT_SECONDS.labels(job.kind).observe(time.monotonic() - job.submitted)
+        job.status = RUNNING
+        with metrics.trace() as trace:
+            try:
+                job.result = work(job)
+                status = DONE
+            except Exception as e:
+                log.exception(f'[JobManager]: {job.kind} job {job.id} failed')
+                job.error = str(e)
+                status = FAILED
+
+        job.trace = trace.breakdown()
+        job.finished = time.monotonic()
+        with self._lock:
+            self._in_flight.pop(job.key, None)
+        # last, the sessions polling the job read everything else once it is done
+        job.status = status
+        metrics.JOBS.labels(job.kind, status).inc()
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id in [job.id for job in self._jobs.values()
+                       if job.finished is not None and now - job.finished > self.retention]:
+            del self._jobs[job_id]
+
+
+def _plan_parts(plan: Optional[Plan]) -> list:
+    return [plan.execution, f'{plan.scale:g}' if plan.scale is not None else None] if plan is not None else []
@@ -0,0 +1,120 @@
+"""
+Timing spans and counters of the hot paths, exported in the Prometheus text format.
+
+    with metrics.span('zonal_statistics', dataset='Global-Land-Cover', area=4.):
+        ...
+
+Every span is observed in the `geopeto_stage_seconds` histogram, labelled by stage, dataset and AOI size
+class, and appended to the Trace of the current request, if any, which backs the debug panel of the app.
+Metrics are served with `start_server(port)` or written with `write_textfile(path)` for node_exporter.
+"""
+import contextlib
+import contextvars
+import threading
+import time
+from typing import List, Optional
+
+from prometheus_client import REGISTRY, Counter, Histogram, start_http_server, write_to_textfile
+
+# upper bounds, in square degrees, of the AOI size classes used as label
+AREA_CLASSES = (1., 5., 25., 100., 500., 2500.)
+
+STAGE_SECONDS = Histogram('geopeto_stage_seconds', 'Duration of the stages of an analysis',
+                          ['stage', 'dataset', 'area'],
+                          buckets=(.01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120.))
+CACHE_HITS = Counter('geopeto_cache_hits_total', 'Lookups answered by a cache', ['cache'])
+CACHE_MISSES = Counter('geopeto_cache_misses_total', 'Lookups missing from a cache', ['cache'])
+EE_ERRORS = Counter('geopeto_ee_errors_total', 'Failed Earth Engine requests', ['operation'])
+EE_RETRIES = Counter('geopeto_ee_retries_total', 'Earth Engine requests retried after a transient error',
+                     ['operation'])
+SCALE_FALLBACKS = Counter('geopeto_scale_fallbacks_total',
+                          'Reductions retried at a coarser scale after an Earth Engine limit', ['dataset'])
+JOBS = Counter('geopeto_jobs_total', 'Jobs of the shared queue by kind and state reached', ['kind', 'status'])
+JOB_WAIT_SECONDS = Histogram('geopeto_job_wait_seconds', 'Time jobs spend in the queue before running', ['kind'],
+                             buckets=(.01, .05, .1, .5, 1., 5., 10., 30., 60.))
+BEST_EFFORT = Counter('geopeto_best_effort_reductions_total',
+                      'Reductions where Earth Engine may coarsen the scale to stay within maxPixels', ['dataset'])
+
+
+def area_class(area: Optional[float]) -> str:
+    """Label of the size class of an AOI of `area` square degrees, e.g. '5-25'."""
+    if area is None:
+        return ''
+    lower = 0
+    for upper in AREA_CLASSES:
+        if area <= upper:
+            return f'{lower:g}-{upper:g}'
+        lower = upper
+    return f'>{lower:g}'
+
+
+class Trace:
+    """Spans of a single request, recorded from every thread working on it."""
+
+    def __init__(self):
+        self.spans: List[dict] = []
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, dataset: str, area: Optional[float], start: float, seconds: float):
+        with self._lock:
+            self.spans.append({'stage': stage, 'dataset': dataset, 'area': area,
+                               'start_ms': (start - self.start) * 1000., 'ms': seconds * 1000.})
+
+    def breakdown(self) -> List[dict]:
+        """Spans ordered by start, plus the total wall time of the request."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start_ms'])
+        return spans + [{'stage': 'total', 'dataset': '', 'area': None, 'start_ms': 0.,
+                         'ms': (time.perf_counter() - self.start) * 1000.}]
+
+
+_trace = contextvars.ContextVar('geopeto_trace', default=None)
+
+
+@contextlib.contextmanager
+def trace():
+    """Collect the spans of the enclosed request, including those of the work it submits with `bind`."""
+    current = Trace()
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        _trace.reset(token)
+
+
+def bind(function):
+    """Wrap `function` to run in the context of the caller, so its spans join the caller's trace."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # a context can only be entered by one thread at a time, tiles run concurrently
+        return context.copy().run(function, *args, **kwargs)
+    return run
+
+
+@contextlib.contextmanager
+def span(stage: str, dataset: str = '', area: float = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage, dataset, area_class(area)).observe(seconds)
+        current = _trace.get()
+        if current is not None:
+            current.add(stage, dataset, area, start, seconds)
+
+
+def cache_lookup(cache: str, hit: bool):
+    (CACHE_HITS if hit else CACHE_MISSES).labels(cache).inc()
+
+
+def start_server(port: int, addr: str = '0.0.0.0'):
+    """Serve the metrics on `http://<addr>:<port>/metrics` from a daemon thread."""
+    start_http_server(port, addr=addr)
+
+
+def write_textfile(path: str):
+    """Write the metrics atomically to `path`, in the format of the node_exporter textfile collector."""
+    write_to_textfile(path, REGISTRY)
@@ -0,0 +1,249 @@
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, Dict, Optional
+
+from shapely.geometry import shape
+
+from . import execution, metrics
+from .admission import Plan
+from .cache import ResultCache
+from .geocoder import Geocoder
+from .geometry import center, prepare_aoi
+from .incremental import LastAOI
+from .geodescriber import GeoDescriber
+from .processing import CombinedZonalStatistics, ZonalStatistics
+from .verification import selected_bbox_too_large
+
+log = logging.getLogger(__name__)
+
+# Bounded, process-wide pool: every Streamlit session shares it so the number of concurrent
+# requests to Earth Engine and Nominatim stays capped regardless of how many users are active.
+MAX_WORKERS = 8
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='geopeto')
+
+
+def top_classes(stats: dict, n: int = 8) -> dict:
+    """Sort the items from top to bottom and take the top `n` elements."""
+    return dict(sorted(stats.items(), key=lambda x: x[1], reverse=True)[:n])
+
+
+@dataclass
+class PipelineResult:
+    stats: Dict[str, dict] = field(default_factory=dict)
+    region: Optional[str] = None
+    country: Optional[str] = None
+    description: Optional[str] = None
+    # how the statistics were computed and how long it took
+    plan: Optional[Plan] = None
+    stats_seconds: Optional[float] = None
+    # what produced the statistics, e.g. "cache, Earth Engine, 1 retry", see execution.Outcome
+    path: Optional[str] = None
+
+    @property
+    def failed(self) -> bool:
+        """Whether the statistics of a dataset could not be computed, see processing.summarize."""
+        return not self.stats or any(stats is None for stats in self.stats.values())
+
+
+class AnalysisPipeline:
+    """
+    Run the zonal statistics of every dataset and the reverse geocoding concurrently,
+    then describe the region with the LLM once all of them are available.
+
+    Parameters:
+    datasets: dict
+        Mapping of dataset name to GEEData.
+    max_allowed_area_size: float
+        Largest area, in square degrees, that may be analysed.
+    cache: ResultCache, optional
+        Cache shared by the ZonalStatistics of every dataset.
+    cache_grid: float, default 0.01
+        Grid size, in degrees, the geometry is snapped to when used as a cache key.
+    user_agent: str, default "my-app"
+        User agent of the Nominatim geocoder.
+    model_name: str, default "text-davinci-003"
+        OpenAI model used to describe the region.
+    combined: bool, default True
+        Reduce all datasets with a single Earth Engine request instead of one request per dataset.
+    backend: optional
+        Backend of the zonal statistics, Earth Engine if not given.
+    max_tiled_area_size: float, optional
+        Areas larger than `max_allowed_area_size` but up to this size are reduced at the native
+        resolution in parallel tiles instead of being refused.
+    tile_size: float, default 5.
+        Size, in degrees, of the tiles.
+    geocoder: optional
+        Reverse geocoder, such as OfflineGeocoder, a Nominatim Geocoder if not given.
+    description_cache: ResultCache, optional
+        Cache of the generated descriptions.
+    """
+
+    def __init__(self, datasets: dict, max_allowed_area_size: float, cache: ResultCache = None,
+                 cache_grid: float = 0.01, user_agent: str = "my-app", model_name: str = "text-davinci-003",
+                 combined: bool = True, backend=None, max_tiled_area_size: float = None,
+                 tile_size: float = 5., geocoder=None, description_cache: ResultCache = None):
+        self.datasets = datasets
+        self.max_allowed_area_size = max_allowed_area_size
+        self.cache = cache
+        self.cache_grid = cache_grid
+        self.user_agent = user_agent
+        self.model_name = model_name
+        self.combined = combined
+        self.backend = backend
+        self.max_tiled_area_size = max_tiled_area_size
+        self.tile_size = tile_size
+        self.geocoder = geocoder
+        self.description_cache = description_cache
+
+    def is_tiled(self, geometry: dict) -> bool:
+        return (self.max_tiled_area_size is not None and
+                selected_bbox_too_large(geometry, threshold=self.max_allowed_area_size))
+
+    def zonal_statistics(self, dataset: str, tiled: bool = False, scale: float = None,
+                         last_aoi: LastAOI = None) -> ZonalStatistics:
+        return ZonalStatistics(self.datasets[dataset],
+                               self.max_tiled_area_size if tiled else self.max_allowed_area_size,
+                               cache=self.cache, cache_grid=self.cache_grid, backend=self.backend,
+                               best_effort=not tiled, scale=scale, last_aoi=last_aoi)
+
+    def combined_zonal_statistics(self, tiled: bool = False, scale: float = None,
+                                  last_aoi: LastAOI = None) -> CombinedZonalStatistics:
+        return CombinedZonalStatistics(self.datasets,
+                                       self.max_tiled_area_size if tiled else self.max_allowed_area_size,
+                                       cache=self.cache, cache_grid=self.cache_grid, backend=self.backend,
+                                       best_effort=not tiled, scale=scale, last_aoi=last_aoi)
+
+    def workers(self, tiled: bool = False, scale: float = None, last_aoi: LastAOI = None) -> dict:
+        """The zonal statistics to compute, a single combined one keyed by None or one per dataset."""
+        if self.combined:
+            return {None: self.combined_zonal_statistics(tiled, scale, last_aoi)}
+        return {dataset: self.zonal_statistics(dataset, tiled, scale, last_aoi) for dataset in self.datasets}
+
+    def check_region(self, geometry: dict, plan: Plan = None) -> bool:
+        """
+        Whether the region can be analysed, with a warning in the sidebar otherwise.
+
+        The checks write to the Streamlit page, so they must run in the script thread: call it before
+        running the analysis anywhere else, see geopeto.jobs.
+        """
+        tiled = plan.execution == 'tiled' if plan is not None else self.is_tiled(geometry)
+        zs = next(iter(self.workers(tiled).values()))
+        # a plan has already accounted for the size of the region
+        return zs.check_boundary(geometry) if plan is not None else zs.check_area(geometry)
+
+    def reverse_geocode(self, geometry: dict):
+        # reverse geocode center point of box to get region and country
+        center_point = center(geometry)
+        geocoder = self.geocoder if self.geocoder is not None else Geocoder(user_agent=self.user_agent)
+        with metrics.span('reverse_geocode', area=shape(geometry).area):
+            return geocoder.reverse_geocode(center_point)
+
+    def run(self, geojson: dict, on_stats: Callable[[PipelineResult], None] = None,
+            on_progress: Callable[[float], None] = None,
+            on_text: Callable[[str], None] = None, plan: Plan = None,
+            last_aoi: LastAOI = None, check: bool = True) -> Optional[PipelineResult]:
+        """
+        Analyse the region of `geojson`.
+
+        Returns None if the region is not valid. `on_stats` is called from the calling thread as soon as
+        the statistics are known, before the location is resolved and the description generated, so an
+        error of the geocoder or of the LLM raised after it does not concern the statistics.
+        `on_progress` is called from the calling thread with the fraction of tiles reduced so far.
+        If `on_text` is given the description is streamed and it is called with the text received so far.
+        Spans of the work done in other threads join the trace of the caller, see `metrics.trace`.
+        If the statistics failed, see `PipelineResult.failed`, the region is not described.
+        A `plan` of the AdmissionController replaces the size checks in square degrees.
+        With the `last_aoi` of the session, a rectangle nudged since the last one is reduced incrementally,
+        tiled reductions are always made from scratch.
+        The region is checked with `check_region` unless `check` is False, which must be the case outside
+        of the script thread, the caller having checked it there already.
+        """
+        geometry = geojson['geometry']
+        if plan is not None:
+            tiled, scale = plan.execution == 'tiled', plan.scale
+        else:
+            tiled, scale = self.is_tiled(geometry), None
+        tile_size = self.tile_size if tiled else None
+
+        # tiles are counted from the worker threads and reported from the calling thread
+        progress = {}
+
+        def count_tiles(dataset, done, total):
+            progress[dataset] = (done, total)
+
+        workers = self.workers(tiled, scale, last_aoi=None if tiled else last_aoi)
+        if check and not self.check_region(geometry, plan):
+            return None
+
+        # wrapped to [-180, 180] and split along the antimeridian
+        geometry = prepare_aoi(geometry)
+        start = time.monotonic()
+        with execution.outcome() as outcome:
+            futures = {dataset: _executor.submit(metrics.bind(zs.compute_stats), geometry, tile_size,
+                                                 partial(count_tiles, dataset))
+                       for dataset, zs in workers.items()}
+        location_future = _executor.submit(metrics.bind(self.reverse_geocode), geometry)
+
+        pending = set(futures.values())
+        while pending:
+            _, pending = wait(pending, timeout=0.2)
+            if on_progress is not None and progress:
+                done = sum(d for d, _ in progress.values())
+                total = sum(t for _, t in progress.values())
+                on_progress(done / total if total else 0.)
+
+        result = PipelineResult(plan=plan, stats_seconds=time.monotonic() - start, path=outcome.describe())
+        if self.combined:
+            result.stats = futures[None].result()
+        else:
+            result.stats = {dataset: future.result() for dataset, future in futures.items()}
+
+        if on_stats is not None:
+            on_stats(result)
+        if result.failed:
+            log.error(f'[AnalysisPipeline]: statistics failed: {result.path}')
+            return result
+
+        result.region, result.country = location_future.result()
+        log.info(f'[AnalysisPipeline]: region: {result.region}, country: {result.country}')
+
+        # geodescribe the region with OpenAI API
+        geo_describer = GeoDescriber(model_name=self.model_name, cache=self.description_cache)
+        inputs = dict(land_cover_per=top_classes(result.stats['Global-Land-Cover']),
+                      climate_per=top_classes(result.stats['Koppen-Geiger-Climate']),
+                      region_name=result.region,
+                      country=result.country)
+        if on_text is None:
+            result.description = geo_describer.generate_description(**inputs)
+        else:
+            result.description = ''
+            for text in geo_describer.stream_description(**inputs):
+                result.description += text
+                on_text(result.description)
+            result.description = result.description.strip()
+
+        return result
+
+    def refine(self, geojson: dict, plan: Plan) -> Future:
+        """
+        Compute the statistics again with `plan` in the background, e.g. at a finer scale than a first answer.
+
+        The future holds a PipelineResult with the statistics, plan and duration only. Nothing is written
+        to the Streamlit page, so the caller decides when to show it.
+        """
+        geometry = prepare_aoi(geojson['geometry'])
+        tiled = plan.execution == 'tiled'
+        tile_size = self.tile_size if tiled else None
+        workers = self.workers(tiled, plan.scale)
+
+        def compute() -> PipelineResult:
+            start = time.monotonic()
+            with execution.outcome() as outcome:
+                stats = {dataset: zs.compute_stats(geometry, tile_size) for dataset, zs in workers.items()}
+            return PipelineResult(stats=stats[None] if self.combined else stats, plan=plan,
+                                  stats_seconds=time.monotonic() - start, path=outcome.describe())
+
+        return _executor.submit(metrics.bind(compute))
@@ -1,71 +1,495 @@
 import logging
+from typing import List, Optional
 
 import ee
 import streamlit as st
+from shapely.geometry import shape
 
+from . import execution, metrics
+from .cache import ResultCache, normalize_geometry
+from .geometry import prepare_aoi, simplify
+from .incremental import LastAOI
+from .registry import METRES_PER_DEGREE
+from .tiling import reduce_tiles, scale_histograms
 from .utils import get_region
-from .verification import selected_bbox_in_boundary, selected_bbox_too_large
+from .verification import selected_bbox_too_large
 
 
-def serialize_output(data):
+# maxPixels of the native resolution requests made when bestEffort is disabled
+MAX_PIXELS = 1e10
+# multiples of the pixel size a reduction is retried at when it exceeds the memory or time limits of Earth Engine
+FALLBACK_FACTORS = (4, 16)
+# percentiles of the values of the continuous datasets
+PERCENTILES = (10, 50, 90)
+
+
+def reduce_region_params(region, best_effort: bool, scale: float = None, reducer: ee.Reducer = None) -> dict:
+    # bestEffort would silently coarsen an explicit scale, maxPixels bounds the reduction instead
+    best_effort = best_effort and scale is None
+    params = {'reducer': reducer if reducer is not None else ee.Reducer.frequencyHistogram(),
+              'geometry': region,
+              'bestEffort': best_effort,
+              }
+    if not best_effort:
+        params['maxPixels'] = MAX_PIXELS
+    if scale is not None:
+        params['scale'] = scale
+    return params
+
+
+def serialize_output(data, band: str = 'b1'):
     # Sort stats by key value
-    data = data['b1']
-    data = {int(k): data[k] for k in data}
+    data = data.get(band) or {}
+    data = {int(float(k)): data[k] for k in data}
     data = {str(k): data[k] for k in sorted(data)}
 
     return data
 
 
+def statistics_reducer() -> ee.Reducer:
+    """Mean, min, max, standard deviation, PERCENTILES and pixel count of a continuous band, in a single pass."""
+    return (ee.Reducer.mean()
+            .combine(ee.Reducer.minMax(), sharedInputs=True)
+            .combine(ee.Reducer.stdDev(), sharedInputs=True)
+            .combine(ee.Reducer.percentile(list(PERCENTILES)), sharedInputs=True)
+            .combine(ee.Reducer.count(), sharedInputs=True))
+
+
+def combined_reducer(categorical: List[str], continuous: List[str]) -> ee.Reducer:
+    """
+    Frequency histograms of the `categorical` bands and statistics of the `continuous` ones in one reducer.
+
+    The inputs of the reducer are the categorical bands followed by the continuous ones, in the order of the
+    image reduced. The statistics of band `b2` are named `b2_mean`, `b2_p50`, ..., see serialize_statistics.
+    """
+    reducer = statistics_reducer().forEach(continuous)
+    if categorical:
+        reducer = ee.Reducer.frequencyHistogram().forEach(categorical).combine(reducer, sharedInputs=False)
+    return reducer
+
+
+def serialize_statistics(data, band: str = 'b1') -> dict:
+    """
+    The statistics of a continuous `band` in a response of statistics_reducer, e.g. `{'mean': 312.5, 'count': 1e4}`.
+
+    A region without any valid pixel has a count of 0 and no other statistic.
+    """
+    prefix = f'{band}_'
+    stats = {key[len(prefix):]: value for key, value in (data or {}).items()
+             if key.startswith(prefix) and value is not None}
+    return stats if stats.get('count') else {'count': 0.}
+
+
+def serialize_bands(data, bands: List[str]) -> dict:
+    """Serialize the histogram of each of the `bands` of a frequencyHistogram response, see serialize_output."""
+    return {band: serialize_output(data, band) for band in bands}
+
+
+def to_percentages(stats: dict, gee_data) -> dict:
+    """Convert the serialized histogram of a dataset to the percentage of the area covered by each class name."""
+    return gee_data.spec.percentages(gee_data.spec.count_vector(stats))
+
+
+def summarize(stats: dict, gee_data) -> Optional[dict]:
+    """
+    The percentages of a categorical dataset, see to_percentages, or the statistics of a continuous one.
+
+    None if the request failed, which leaves `stats` empty; a region without any valid pixel, e.g. in the
+    ocean, has a histogram without classes and no percentages.
+    """
+    if not stats:
+        return None
+    if gee_data.spec.continuous:
+        return dict(stats.get('b1') or {})
+    return to_percentages(stats.get('b1'), gee_data)
+
+
 class ZonalStatistics:
-    def __init__(self, gee_data, max_allowed_area_size: float = 25.):
+    def __init__(self, gee_data, max_allowed_area_size: float = 25., cache: ResultCache = None,
+                 cache_grid: float = 0.01, backend=None, best_effort: bool = True, scale: float = None,
+                 last_aoi: LastAOI = None, simplify_regions: bool = True):
         self.gee_data = gee_data
         self.max_allowed_area_size = max_allowed_area_size
+        # results are looked up by dataset and geometry snapped to `cache_grid` degrees
+        self.cache = cache
+        self.cache_grid = cache_grid
+        # histograms come from Earth Engine unless a backend such as LocalRasterBackend is given
+        self.backend = backend
+        # without bestEffort Earth Engine reduces at the native resolution, use it with compute_tiled
+        self.best_effort = best_effort
+        # reduce at this many metres instead of the native scale, see geopeto.admission
+        self.scale = scale
+        # reduce only the strips a rectangle changed by since the last one of the session
+        self.last_aoi = last_aoi
+        # simplify the regions to the pixel size before sending them, not the tiles of an AOI simplified once
+        self.simplify_regions = simplify_regions
 
-    def check_area_and_compute(self, geojson: dict) -> None:
-        geometry = geojson['geometry']
+    def check_area(self, geometry: dict) -> bool:
         if selected_bbox_too_large(geometry, threshold=self.max_allowed_area_size):
             st.sidebar.warning(
                 "Selected region is too large, fetching data for this area would consume too many resources. "
                 "Please select a smaller region."
             )
-        elif not selected_bbox_in_boundary(geometry):
-            st.sidebar.warning(
-                "Selected rectangle is not within the allowed region of the world map. "
-                "Do not scroll too far to the left or right. "
-                "Ensure to use the initial center view of the world for drawing your rectangle."
-            )
-        else:
-            # it is important to spawn this success message in the sidebar, because state will get lost otherwise
+            return False
+        return self.check_boundary(geometry)
+
+    def check_boundary(self, geometry: dict) -> bool:
+        try:
+            prepare_aoi(geometry)
+        except ValueError as e:
+            st.sidebar.warning(f"{e} Please select another region.")
+            return False
+        return True
+
+    @property
+    def pixel_size(self) -> float:
+        """Size, in degrees, of the pixels reduced: the native ones or those of `scale` if coarser."""
+        return max(self.gee_data.spec.nominal_scale, self.scale or 0.) / METRES_PER_DEGREE
+
+    def check_area_and_compute(self, geojson: dict) -> None:
+        geometry = geojson['geometry']
+        if self.check_area(geometry):
+            with execution.outcome() as outcome:
+                stats = self.compute_stats(geometry)
+            # it is important to spawn these messages in the sidebar, because state will get lost otherwise
+            if stats is None:
+                st.sidebar.error(f"Zonal Statistics could not be computed ({outcome.describe()}), "
+                                 "please try again later.")
+                return None
             st.sidebar.success("Successfully computed Zonal Statistics!")
 
+            return stats
+
+    def compute_stats(self, geometry: dict, tile_size: float = None, on_progress=None) -> dict:
+        """
+        Compute the percentage of the area covered by each class, or the statistics of the values of
+        a continuous dataset, None if it failed. Does not touch the Streamlit page.
+
+        If `tile_size` is given the geometry is reduced in tiles of that many degrees, see `compute_tiled`.
+        """
+        if tile_size is not None:
+            stats = self.compute_tiled(geometry, tile_size, on_progress=on_progress)
+        else:
             stats = self.compute(geometry)
 
-            # Sort stats by key value
-            stats = serialize_output(stats)
+        stats = summarize(stats, self.gee_data)
 
-            # convert each item to percentages
-            total_area = sum(stats.values())
-            stats = {key: (item / total_area) * 100 for key, item in stats.items()}
+        logging.info(f'[ZonalStatistics]: {self.gee_data.dataset} stats: {stats}')
 
-            # add class names
-            stats = {self.gee_data.class_names()[key]: item for key, item in stats.items()}
+        return stats
 
-            print('Stats: ', stats)
+    def setting(self) -> list:
+        """What, besides the geometry, changes the histograms: backend, bestEffort, scale and dataset."""
+        prefix = [self.backend.name] if self.backend is not None else []
+        if not self.best_effort:
+            prefix.append('native')
+        if self.scale is not None:
+            prefix.append(f'scale={self.scale:g}')
+        # the default year keeps the keys of the results cached before time series
+        if self.gee_data.image_year != self.gee_data.spec.default_year:
+            prefix.append(f'year={self.gee_data.image_year}')
+        return prefix + [self.gee_data.dataset]
 
-            return stats
+    def cache_key(self, geometry: dict) -> str:
+        return self.cache.make_key(*self.setting(), normalize_geometry(geometry, grid=self.cache_grid))
 
     def compute(self, geometry: dict) -> None:
-        region = get_region(geometry)  # Create an EE feature
+        with metrics.span('zonal_statistics', self.gee_data.dataset, shape(geometry).area):
+            try:
+                return self._compute_cached(geometry)
+            except execution.LimitExceeded as e:
+                return self._compute_coarser(geometry, e)
+
+    def with_scale(self, scale: float, simplify_regions: bool = None) -> 'ZonalStatistics':
+        """The same statistics reduced at `scale` metres, without the last rectangle of the session."""
+        return ZonalStatistics(self.gee_data, self.max_allowed_area_size, cache=self.cache,
+                               cache_grid=self.cache_grid, backend=self.backend, best_effort=self.best_effort,
+                               scale=scale, simplify_regions=self.simplify_regions if simplify_regions is None
+                               else simplify_regions)
+
+    def _compute_cached(self, geometry: dict) -> dict:
+        if self.cache is None:
+            return self._compute_incremental(geometry)
+
+        key = self.cache_key(geometry)
+        stats = self.cache.get(key)
+        metrics.cache_lookup('zonal_statistics', stats is not None)
+        if stats is not None:
+            logging.info(f'[ZonalStatistics]: cache hit for {self.gee_data.dataset}, {self.cache.stats()}')
+            execution.record('cache')
+            if self.incremental:
+                self.last_aoi.remember(ResultCache.make_key(*self.setting()), geometry, stats)
+            return stats
+
+        stats = self._compute_incremental(geometry)
+        # never cache failed requests, they should be retried on the next click
+        if stats:
+            self.cache.set(key, stats)
+
+        return stats
+
+    def _compute_coarser(self, geometry: dict, error: execution.LimitExceeded) -> dict:
+        """
+        Retry at the coarser scales of FALLBACK_FACTORS after Earth Engine exceeded a limit.
+
+        The counts are scaled back to pixels of the original size, so they still add up with those of
+        other tiles or strips; percentages are unchanged.
+        """
+        for factor in FALLBACK_FACTORS:
+            coarser = self.with_scale(self.pixel_size * METRES_PER_DEGREE * factor)
+            logging.warning(f'[ZonalStatistics]: {self.gee_data.dataset}: {error.reason}, '
+                            f'retrying at {coarser.scale:,.0f} m')
+            metrics.SCALE_FALLBACKS.labels(self.gee_data.dataset).inc()
+            try:
+                stats = coarser._compute_cached(geometry)
+            except execution.LimitExceeded as e:
+                error = e
+                continue
+            if stats:
+                execution.record(f'coarser scale of {coarser.scale:,.0f} m after {error.reason}')
+            return scale_histograms(stats, (coarser.pixel_size / self.pixel_size) ** 2)
+
+        logging.error(f'[ZonalStatistics]: {self.gee_data.dataset}: {error.reason} at every scale.')
+        execution.record(f'failed: {error.reason}')
+        return {}
+
+    def compute_tiled(self, geometry: dict, tile_size: float, on_progress=None) -> dict:
+        """Reduce the geometry in parallel tiles of `tile_size` degrees and add up their histograms."""
+        # simplified once, simplifying every tile on its own would move the edges they share
+        tiles = self.with_scale(self.scale, simplify_regions=False)
+        return reduce_tiles(tiles.compute, simplify(geometry, self.pixel_size), tile_size, on_progress=on_progress)
+
+    @property
+    def incremental(self) -> bool:
+        # min, max and percentiles cannot be updated by the strips a rectangle changed by
+        return self.last_aoi is not None and not self.gee_data.spec.continuous
+
+    def _compute_incremental(self, geometry: dict) -> dict:
+        if not self.incremental:
+            return self._compute(geometry)
+        return self.last_aoi.reduce(ResultCache.make_key(*self.setting()), geometry, self._compute)
+
+    def _compute(self, geometry: dict) -> None:
+        continuous = self.gee_data.spec.continuous
+        # the local backends read class rasters, continuous datasets always come from Earth Engine
+        if self.backend is not None and not continuous:
+            execution.record(self.backend.name)
+            return self.backend.histogram(self.gee_data, geometry)
+
+        region = get_region(geometry, self.pixel_size if self.simplify_regions else None)  # Create an EE feature
         img = self.gee_data.ee_image()
+        if self.best_effort and self.scale is None:
+            metrics.BEST_EFFORT.labels(self.gee_data.dataset).inc()
+        reducer = statistics_reducer().forEach(['b1']) if continuous else None
+        request = img.reduceRegion(**reduce_region_params(region, self.best_effort, self.scale, reducer))
         try:
-            stats = img.reduceRegion(**{'reducer': ee.Reducer.frequencyHistogram(),
-                                        'geometry': region,
-                                        'bestEffort': True,
-                                        }).getInfo()
+            stats = execution.get_executor().run(request.getInfo, 'reduceRegion')
             logging.info(f'[ZonalStatistics]: stats: {stats}')
-        except:
-            logging.error('[ZonalStatistics]: EE failed.')
-            stats = {}
+        except execution.LimitExceeded:
+            raise
+        except Exception as e:
+            logging.error(f'[ZonalStatistics]: EE failed: {e}')
+            execution.record(f'failed: {e}')
+            return {}
+
+        execution.record('Earth Engine')
+        if continuous:
+            return {'b1': serialize_statistics(stats)}
+        return stats or {}
+
+
+
+class CombinedZonalStatistics:
+    """
+    Compute the zonal statistics of several datasets with a single Earth Engine request.
+
+    The images of all datasets are stacked into one multi-band image, reduced in one pass and the response
+    is split back into one `{'b1': histogram}` per dataset, so cached results are shared with ZonalStatistics.
+    Continuous datasets share the same request: their bands follow the categorical ones and are reduced by
+    the statistics part of a combined reducer, see combined_reducer.
+    Pixels are counted in the projection of the first dataset, which only matters for the absolute counts.
+
+    Parameters:
+    gee_datas: dict
+        Mapping of dataset name to GEEData.
+    max_allowed_area_size: float, default 25.
+        Largest area, in square degrees, that may be analysed.
+    cache: ResultCache, optional
+        Cache of the per-dataset results.
+    cache_grid: float, default 0.01
+        Grid size, in degrees, the geometry is snapped to when used as a cache key.
+    backend: optional
+        Local backend such as LocalRasterBackend. Each dataset is then read separately, as there is
+        no request to save.
+    best_effort: bool, default True
+        Let Earth Engine coarsen the resolution of large areas. Disable it together with tiling.
+    scale: float, optional
+        Reduce at this many metres instead of the native scale of each dataset.
+    last_aoi: LastAOI, optional
+        Last rectangle of the session, only the strips a rectangle changed by since are then reduced.
+    """
+
+    def __init__(self, gee_datas: dict, max_allowed_area_size: float = 25., cache: ResultCache = None,
+                 cache_grid: float = 0.01, backend=None, best_effort: bool = True, scale: float = None,
+                 last_aoi: LastAOI = None, simplify_regions: bool = True):
+        self.gee_datas = gee_datas
+        self.zonal_statistics = {dataset: ZonalStatistics(data, max_allowed_area_size, cache=cache,
+                                                          cache_grid=cache_grid, backend=backend,
+                                                          best_effort=best_effort, scale=scale,
+                                                          simplify_regions=simplify_regions)
+                                 for dataset, data in gee_datas.items()}
+        self.cache = cache
+        self.backend = backend
+        self.best_effort = best_effort
+        self.scale = scale
+        self.last_aoi = last_aoi
+        self.simplify_regions = simplify_regions
+
+    def check_area(self, geometry: dict) -> bool:
+        return next(iter(self.zonal_statistics.values())).check_area(geometry)
+
+    def check_boundary(self, geometry: dict) -> bool:
+        return next(iter(self.zonal_statistics.values())).check_boundary(geometry)
+
+    def compute_stats(self, geometry: dict, tile_size: float = None, on_progress=None) -> dict:
+        """Compute the percentage of the area covered by each class of every dataset, None for a failed one."""
+        if tile_size is not None:
+            stats = self.compute_tiled(geometry, tile_size, on_progress=on_progress)
+        else:
+            stats = self.compute(geometry)
+        stats = {dataset: summarize(stats[dataset], self.gee_datas[dataset]) for dataset in self.gee_datas}
+
+        logging.info(f'[CombinedZonalStatistics]: stats: {stats}')
+
+        return stats
+
+    def compute(self, geometry: dict) -> dict:
+        with metrics.span('zonal_statistics', 'combined', shape(geometry).area):
+            try:
+                return self._compute_cached(geometry)
+            except execution.LimitExceeded as e:
+                return self._compute_coarser(geometry, e)
+
+    def with_scale(self, scale: float, simplify_regions: bool = None) -> 'CombinedZonalStatistics':
+        """The same statistics reduced at `scale` metres, without the last rectangle of the session."""
+        first = next(iter(self.zonal_statistics.values()))
+        return CombinedZonalStatistics(self.gee_datas, first.max_allowed_area_size, cache=self.cache,
+                                       cache_grid=first.cache_grid, backend=self.backend,
+                                       best_effort=self.best_effort, scale=scale,
+                                       simplify_regions=self.simplify_regions if simplify_regions is None
+                                       else simplify_regions)
+
+    def _compute_cached(self, geometry: dict) -> dict:
+        stats = {}
+        missing = list(self.gee_datas)
+        if self.cache is not None:
+            keys = {dataset: zs.cache_key(geometry) for dataset, zs in self.zonal_statistics.items()}
+            for dataset, key in keys.items():
+                cached = self.cache.get(key)
+                metrics.cache_lookup('zonal_statistics', cached is not None)
+                if cached is not None:
+                    stats[dataset] = cached
+            missing = [dataset for dataset in missing if dataset not in stats]
+            if stats:
+                execution.record('cache')
+
+        if missing:
+            computed = self._compute_incremental(geometry, missing)
+            for dataset in missing:
+                stats[dataset] = computed.get(dataset, {})
+                if self.cache is not None and stats[dataset]:
+                    self.cache.set(keys[dataset], stats[dataset])
+        elif self.incremental:
+            self.last_aoi.remember(self.setting(), geometry, stats)
 
         return stats
 
+    def _compute_coarser(self, geometry: dict, error: execution.LimitExceeded) -> dict:
+        """Retry at coarser scales, like ZonalStatistics, the counts of each dataset scaled to its own pixels."""
+        pixel_size = min(zs.pixel_size for zs in self.zonal_statistics.values())
+        for factor in FALLBACK_FACTORS:
+            coarser = self.with_scale(pixel_size * METRES_PER_DEGREE * factor)
+            logging.warning(f'[CombinedZonalStatistics]: {error.reason}, retrying at {coarser.scale:,.0f} m')
+            for dataset in self.gee_datas:
+                metrics.SCALE_FALLBACKS.labels(dataset).inc()
+            try:
+                stats = coarser._compute_cached(geometry)
+            except execution.LimitExceeded as e:
+                error = e
+                continue
+            if all(stats.values()):
+                execution.record(f'coarser scale of {coarser.scale:,.0f} m after {error.reason}')
+            return {dataset: scale_histograms(stats.get(dataset, {}),
+                                              (coarser.zonal_statistics[dataset].pixel_size / zs.pixel_size) ** 2)
+                    for dataset, zs in self.zonal_statistics.items()}
+
+        logging.error(f'[CombinedZonalStatistics]: {error.reason} at every scale.')
+        execution.record(f'failed: {error.reason}')
+        return {dataset: {} for dataset in self.gee_datas}
+
+    def compute_tiled(self, geometry: dict, tile_size: float, on_progress=None) -> dict:
+        """Reduce the geometry in parallel tiles of `tile_size` degrees and add up their histograms."""
+        # simplified once to the finest dataset, like ZonalStatistics.compute_tiled
+        tiles = self.with_scale(self.scale, simplify_regions=False)
+        geometry = simplify(geometry, min(zs.pixel_size for zs in self.zonal_statistics.values()))
+        stats = reduce_tiles(tiles._compute_tile, geometry, tile_size, on_progress=on_progress)
+        return stats or {dataset: {} for dataset in self.gee_datas}
+
+    def _compute_tile(self, geometry: dict) -> dict:
+        stats = self.compute(geometry)
+        # a dataset without histogram means the request failed, report the whole tile as failed
+        return stats if all(stats.values()) else {}
+
+    def setting(self) -> str:
+        return ResultCache.make_key(*next(iter(self.zonal_statistics.values())).setting()[:-1], *self.gee_datas)
+
+    @property
+    def incremental(self) -> bool:
+        return all(zs.incremental for zs in self.zonal_statistics.values()) and self.last_aoi is not None
+
+    def _compute_incremental(self, geometry: dict, datasets: list) -> dict:
+        if not self.incremental:
+            return self._compute(geometry, datasets)
+        # the last rectangle is remembered with the histograms of every dataset, the strips are cheap
+        datasets = list(self.gee_datas)
+        return self.last_aoi.reduce(self.setting(), geometry, lambda region: self._compute(region, datasets),
+                                    succeeded=lambda stats: len(stats) == len(datasets) and all(stats.values()))
+
+    def stacked_image(self, datasets: list) -> ee.Image:
+        # band names are positional so that dataset names never have to be valid EE band names
+        return ee.Image.cat([self.gee_datas[dataset].ee_image().select(0).rename(f'b{i}')
+                             for i, dataset in enumerate(datasets)])
+
+    def _compute(self, geometry: dict, datasets: list) -> dict:
+        if self.backend is not None:
+            return {dataset: self.zonal_statistics[dataset]._compute(geometry) for dataset in datasets}
+
+        # the inputs of the combined reducer are the categorical bands first, the sort is stable
+        datasets = sorted(datasets, key=lambda dataset: self.gee_datas[dataset].spec.continuous)
+        bands = [f'b{i}' for i in range(len(datasets))]
+        continuous = [band for band, dataset in zip(bands, datasets) if self.gee_datas[dataset].spec.continuous]
+
+        # simplified to the finest of the reduced datasets
+        pixel_size = min(self.zonal_statistics[dataset].pixel_size for dataset in datasets)
+        region = get_region(geometry, pixel_size if self.simplify_regions else None)
+        img = self.stacked_image(datasets)
+        if self.best_effort and self.scale is None:
+            for dataset in datasets:
+                metrics.BEST_EFFORT.labels(dataset).inc()
+        # only categorical bands keep the plain frequencyHistogram, and the requests made before continuous datasets
+        reducer = combined_reducer(bands[:len(bands) - len(continuous)], continuous) if continuous else None
+        request = img.reduceRegion(**reduce_region_params(region, self.best_effort, self.scale, reducer))
+        try:
+            stats = execution.get_executor().run(request.getInfo, 'reduceRegion') or {}
+            logging.info(f'[CombinedZonalStatistics]: stats: {stats}')
+        except execution.LimitExceeded:
+            raise
+        except Exception as e:
+            logging.error(f'[CombinedZonalStatistics]: EE failed: {e}')
+            execution.record(f'failed: {e}')
+            return {}
+
+        execution.record('Earth Engine')
+        histograms = serialize_bands(stats, [band for band in bands if band not in continuous])
+        return {dataset: {'b1': serialize_statistics(stats, band) if band in continuous else histograms[band]}
+                for band, dataset in zip(bands, datasets)}
@@ -0,0 +1,242 @@
+"""
+Declarative registry of the datasets.
+
+Each categorical dataset is described once by its classes; the lookup tables, the class name and colour
+mappings and the SLD style used to display it are all compiled from that description the first time they
+are needed and shared afterwards. Specs are immutable, so the compiled tables are safe to share between
+threads and Streamlit sessions. Continuous datasets, such as elevation, have no classes: they are summarised
+by statistics of their values instead, see processing.statistics_reducer.
+"""
+from dataclasses import dataclass
+from functools import cached_property
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional, Tuple
+
+import numpy as np
+
+# metres per degree at the equator, how Earth Engine converts a scale in metres for geographic projections
+METRES_PER_DEGREE = 111319.49
+
+
+@dataclass(frozen=True)
+class ClassSpec:
+    code: int
+    # classes without a name are only styled on the map, e.g. values masked out of the statistics
+    name: Optional[str]
+    color: str
+    opacity: float = 1
+    # masked out of the Earth Engine image, see data.GEEData, so never drawn although the SLD styles it
+    masked: bool = False
+
+
+@dataclass(frozen=True)
+class DatasetSpec:
+    name: str
+    classes: Tuple[ClassSpec, ...]
+    image_collection_id: str = ''
+    crs: str = 'EPSG:4326'
+    # native pixel size, in degrees for EPSG:4326 and in metres for projected rasters
+    pixel_size: float = 0.
+    # years of the annual images of a time series, `default_year` is analysed unless other years are asked for
+    years: Tuple[int, ...] = ()
+    default_year: Optional[int] = None
+    # "categorical" bands hold class codes, "continuous" ones measured values in `unit`
+    kind: str = 'categorical'
+    unit: str = ''
+
+    @property
+    def continuous(self) -> bool:
+        return self.kind == 'continuous'
+
+    @property
+    def geographic(self) -> bool:
+        return self.crs == 'EPSG:4326'
+
+    @cached_property
+    def nominal_scale(self) -> float:
+        """Native pixel size in metres, the `scale` of an Earth Engine reduction at native resolution."""
+        return self.pixel_size * METRES_PER_DEGREE if self.geographic else self.pixel_size
+
+    @cached_property
+    def named_classes(self) -> Tuple[ClassSpec, ...]:
+        return tuple(c for c in self.classes if c.name is not None)
+
+    @cached_property
+    def codes(self) -> np.ndarray:
+        """Codes of the named classes, the order of the count vectors."""
+        return np.array([c.code for c in self.named_classes], dtype=np.int64)
+
+    @cached_property
+    def names(self) -> Tuple[str, ...]:
+        return tuple(c.name for c in self.named_classes)
+
+    @cached_property
+    def class_names(self) -> Mapping[str, str]:
+        return MappingProxyType({str(c.code): c.name for c in self.named_classes})
+
+    @cached_property
+    def class_colors(self) -> Mapping[str, str]:
+        return MappingProxyType({str(c.code): c.color for c in self.named_classes})
+
+    @cached_property
+    def colors_by_name(self) -> Mapping[str, str]:
+        return MappingProxyType({c.name: c.color for c in self.named_classes})
+
+    @cached_property
+    def index_lut(self) -> np.ndarray:
+        """Dense table from class code to position in the count vectors, -1 for unknown codes."""
+        lut = np.full(max(c.code for c in self.classes) + 1, -1, dtype=np.int64)
+        lut[self.codes] = np.arange(self.codes.size)
+        lut.flags.writeable = False
+        return lut
+
+    @cached_property
+    def name_lut(self) -> np.ndarray:
+        """Dense table from class code to class name, None for unknown codes."""
+        lut = np.full(self.index_lut.size, None, dtype=object)
+        for c in self.named_classes:
+            lut[c.code] = c.name
+        lut.flags.writeable = False
+        return lut
+
+    @cached_property
+    def rgba_lut(self) -> np.ndarray:
+        """Dense table from class code to RGBA colour, transparent for codes that are not styled or masked."""
+        lut = np.zeros((self.index_lut.size, 4), dtype=np.uint8)
+        for c in self.classes:
+            if c.masked:
+                continue
+            lut[c.code] = [int(c.color[i:i + 2], 16) for i in (1, 3, 5)] + [round(255 * c.opacity)]
+        lut.flags.writeable = False
+        return lut
+
+    @cached_property
+    def sld_interval(self) -> str:
+        entries = []
+        for c in self.classes:
+            opacity = f' opacity="{c.opacity:g}"' if c.opacity != 1 else ''
+            entries.append(f'<ColorMapEntry color="{c.color}" quantity="{c.code}"{opacity} />')
+        return ('<RasterSymbolizer>' + '<ColorMap type="values" extended="false">' +
+                ''.join(entries) +
+                '</ColorMap>' + '</RasterSymbolizer>')
+
+    def count_vector(self, histogram: Dict[str, float]) -> np.ndarray:
+        """
+        Convert a `{code: count}` frequency histogram to a count vector ordered like `codes`.
+
+        Histograms keep the `{code: count}` shape of Earth Engine's answers through the cache, the tile and
+        strip merges and the combined reductions, which also hold the statistics of continuous bands; they
+        become count vectors here, where percentages, transitions and batch rows are computed.
+        """
+        counts = np.zeros(self.codes.size, dtype=np.float64)
+        if not histogram:
+            return counts
+
+        codes = np.fromiter((int(float(k)) for k in histogram), dtype=np.int64, count=len(histogram))
+        values = np.fromiter(histogram.values(), dtype=np.float64, count=len(histogram))
+        valid = (codes >= 0) & (codes < self.index_lut.size)
+        index = np.full(codes.size, -1, dtype=np.int64)
+        index[valid] = self.index_lut[codes[valid]]
+        known = index >= 0
+
+        return counts + np.bincount(index[known], weights=values[known], minlength=self.codes.size)
+
+    def percentages(self, counts: np.ndarray) -> Dict[str, float]:
+        """Percentage of the total of a count vector per class name, for the classes that are present."""
+        total = counts.sum()
+        if not total:
+            return {}
+
+        stats = {}
+        for i in np.flatnonzero(counts):
+            # classes sharing a name are added up
+            stats[self.names[i]] = stats.get(self.names[i], 0.) + float(counts[i] / total * 100)
+        return stats
+
+
+DATASETS: Dict[str, DatasetSpec] = {spec.name: spec for spec in (
+    DatasetSpec('Global-Land-Cover', image_collection_id='projects/soils-revealed/ESA_landcover_ipcc',
+                pixel_size=1 / 360, years=tuple(range(1992, 2019)), default_year=2018, classes=(
+        ClassSpec(10, 'Cropland, rainfed', '#ffff64'),
+        ClassSpec(11, 'Cropland, rainfed, herbaceous cover', '#ffff64'),
+        ClassSpec(12, 'Cropland, rainfed, tree, or shrub cover', '#ffff00'),
+        ClassSpec(20, 'Cropland, irrigated or post-flooding', '#aaf0f0'),
+        ClassSpec(30, 'Mosaic cropland (>50%) / natural vegetation (tree, shrub, herbaceous cover) (<50%)', '#dcf064'),
+        ClassSpec(40, 'Mosaic natural vegetation (tree, shrub, herbaceous cover) (>50%) / cropland (<50%)', '#c8c864'),
+        ClassSpec(50, 'Tree cover, broadleaved, evergreen, closed to open (>15%)', '#006400'),
+        ClassSpec(60, 'Tree cover, broadleaved, deciduous, closed to open (>15%)', '#00a000'),
+        ClassSpec(61, 'Tree cover, broadleaved, deciduous, closed (>40%)', '#00a000'),
+        ClassSpec(62, 'Tree cover, broadleaved, deciduous, open (15- 40%)', '#aac800'),
+        ClassSpec(70, 'Tree cover, needleleaved, evergreen, closed to open (>15%)', '#003c00'),
+        ClassSpec(71, 'Tree cover, needleleaved, evergreen, closed (>40%)', '#003c00'),
+        ClassSpec(72, 'Tree cover, needleleaved, evergreen, open (15-40%)', '#005000'),
+        ClassSpec(80, 'Tree cover, needleleaved, deciduous, closed to open (>15%)', '#285000'),
+        ClassSpec(81, 'Tree cover, needleleaved, deciduous, closed (>40%)', '#285000'),
+        ClassSpec(82, 'Tree cover, needleleaved, deciduous, open (15-40%)', '#286400'),
+        ClassSpec(90, 'Tree cover, mixed leaf type (broadleaved and needleleaved)', '#788200'),
+        ClassSpec(100, 'Mosaic tree and shrub (>50%) / herbaceous cover (<50%)', '#8ca000'),
+        ClassSpec(110, 'Mosaic herbaceous cover (>50%) / tree and shrub (<50%)', '#be9600'),
+        ClassSpec(120, 'Shrubland', '#966400'),
+        ClassSpec(121, 'Evergreen shrubland', '#966400'),
+        ClassSpec(122, 'Deciduous shrubland', '#966400'),
+        ClassSpec(130, 'Grassland', '#ffb432'),
+        ClassSpec(140, 'Lichens and mosses', '#ffdcd2'),
+        ClassSpec(150, 'Sparse vegetation (tree, shrub, herbaceous cover) (<15%)', '#ffebaf'),
+        ClassSpec(151, 'Sparse tree (<15%)', '#ffc864'),
+        ClassSpec(152, 'Sparse shrub (<15%)', '#ffd278'),
+        ClassSpec(153, 'Sparse herbaceous cover (<15%)', '#ffebaf'),
+        ClassSpec(160, 'Tree cover, flooded, fresh, or brackish water', '#00785a'),
+        ClassSpec(170, 'Tree cover, flooded, saline water', '#009678'),
+        ClassSpec(180, 'Shrub or herbaceous cover, flooded, fresh/saline/brackish water', '#00dc82'),
+        ClassSpec(190, 'Urban areas', '#c31400'),
+        ClassSpec(200, 'Bare areas ', '#fff5d7'),
+        ClassSpec(201, 'Consolidated bare areas', '#dcdcdc'),
+        ClassSpec(202, 'Unconsolidated bare areas', '#fff5d7'),
+        ClassSpec(210, 'Water bodies', '#0046c8', opacity=0),
+        ClassSpec(220, 'Permanent snow and ice ', '#ffffff'),
+    )),
+    DatasetSpec('Koppen-Geiger-Climate', pixel_size=1 / 12, classes=(
+        ClassSpec(0, 'Tropical rainforest climate', '#960000'),
+        ClassSpec(1, 'Tropical monsoon climate', '#FF0000'),
+        ClassSpec(2, 'Tropical wet and dry or savanna climate', '#FF6E6E'),
+        ClassSpec(3, 'Tropical wet and dry or savanna climate', '#FFCCCC'),
+        ClassSpec(4, 'Hot semi-arid climate', '#CC8D14'),
+        ClassSpec(5, 'Cold semi-arid climate', '#CCAA54'),
+        ClassSpec(6, 'Hot desert climate', '#FFCC00'),
+        ClassSpec(7, 'Cold desert climate', '#FFFF64'),
+        ClassSpec(8, 'Humid subtropical climate', '#007800'),
+        ClassSpec(9, 'Temperate oceanic climate or subtropical highland climate', '#005000'),
+        ClassSpec(10, 'Subpolar oceanic climate', '#003200'),
+        ClassSpec(11, 'Hot-summer Mediterranean climate', '#96FF00'),
+        ClassSpec(12, 'Warm-summer Mediterranean climate', '#00D700'),
+        ClassSpec(13, 'Cold-summer Mediterranean climate', '#00AA00'),
+        ClassSpec(14, 'Monsoon-influenced humid subtropical climate', '#BEBE00'),
+        ClassSpec(15, 'Subtropical highland climate or Monsoon-influenced temperate oceanic climate', '#8C8C00'),
+        ClassSpec(16, 'Cold subtropical highland climate or Monsoon-influenced subpolar oceanic climate', '#5A5A00'),
+        ClassSpec(17, 'Hot-summer humid continental climate', '#550055'),
+        ClassSpec(18, 'Warm-summer humid continental climate', '#820082'),
+        ClassSpec(19, 'Subarctic climate', '#C800C8'),
+        ClassSpec(20, 'Extremely cold subarctic climate', '#FF6EFF'),
+        ClassSpec(21, 'Mediterranean-influenced hot-summer humid continental climate', '#646464'),
+        ClassSpec(22, 'Mediterranean-influenced warm-summer humid continental climate', '#8C8C8C'),
+        ClassSpec(23, 'Mediterranean-influenced subarctic climate', '#BEBEBE'),
+        ClassSpec(24, 'Mediterranean-influenced extremely cold subarctic climate', '#E6E6E6'),
+        ClassSpec(25, 'Monsoon-influenced hot-summer humid continental climate', '#6E28B4'),
+        ClassSpec(26, 'Monsoon-influenced warm-summer humid continental climate', '#B464FA'),
+        ClassSpec(27, 'Monsoon-influenced subarctic climate', '#C89BFA'),
+        ClassSpec(28, 'Monsoon-influenced extremely cold subarctic climate', '#C8C8FF'),
+        ClassSpec(29, 'Ice cap climate', '#6496FF'),
+        ClassSpec(30, 'Tundra climate', '#64FFFF'),
+        ClassSpec(31, None, '#F5FFFF', masked=True),
+    )),
+    # GMTED2010 breakline emphasis elevation, 7.5 arc-seconds
+    DatasetSpec('Elevation', classes=(), pixel_size=1 / 480, kind='continuous', unit='m'),
+    # mean of the MODIS 16-day NDVI composites of 2018
+    DatasetSpec('NDVI', classes=(), crs='SR-ORG:6974', pixel_size=463.3127, kind='continuous'),
+    # WorldClim annual precipitation, 1970-2000, 30 arc-seconds
+    DatasetSpec('Precipitation', classes=(), pixel_size=1 / 120, kind='continuous', unit='mm/year'),
+)}
+
+
+def get_dataset(name: str) -> DatasetSpec:
+    return DATASETS[name]
@@ -0,0 +1,147 @@
+"""
+XYZ map tiles of the categorical GEEData layers rendered from their local rasters, served by the TileProxy.
+"""
+import argparse
+import io
+import logging
+import math
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from . import metrics
+from .registry import get_dataset
+
+log = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+# Largest side of the window read for a tile; wider windows are decimated, from the overviews if any.
+MAX_READ_PIXELS = 2 * TILE_SIZE
+# Overview factors of `build_overviews`, the coarsest keeps a whole-world raster of 5' within a few tiles.
+OVERVIEW_FACTORS = (2, 4, 8, 16, 32, 64)
+
+
+def tile_centers(z: int, x: int, y: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Longitudes of the pixel columns and latitudes of the pixel rows of an XYZ tile, at the pixel centres."""
+    n = 2 ** z
+    steps = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    lon = (x + steps) / n * 360. - 180.
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + steps) / n))))
+    return lon, lat
+
+
+def _encode(rgba: np.ndarray) -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+# tiles outside the rasters are all alike
+_EMPTY_TILE = None
+
+
+def empty_tile() -> bytes:
+    global _EMPTY_TILE
+    if _EMPTY_TILE is None:
+        _EMPTY_TILE = _encode(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+    return _EMPTY_TILE
+
+
+class TileRenderer:
+    """
+    Render the XYZ tiles of GEEData layers from local GeoTIFF/COG copies in EPSG:4326.
+
+    Parameters:
+    paths: dict
+        Mapping of dataset name to the path or URL of its raster, as for LocalRasterBackend.
+    band: int, default 1
+        Band of the rasters holding the class codes.
+    """
+
+    def __init__(self, paths: Dict[str, str], band: int = 1):
+        self.paths = paths
+        self.band = band
+        # rasterio datasets must not be shared between threads, the proxy renders from many
+        self._local = threading.local()
+
+    def _open(self, dataset: str):
+        import rasterio
+
+        sources = self._local.__dict__.setdefault('sources', {})
+        if dataset not in sources:
+            sources[dataset] = rasterio.open(self.paths[dataset])
+        return sources[dataset]
+
+    def style(self, dataset: str) -> str:
+        """The colours of the tiles of `dataset`, which the TileProxy keys its cache on."""
+        return get_dataset(dataset).rgba_lut.tobytes().hex()
+
+    def render(self, dataset: str, z: int, x: int, y: int) -> bytes:
+        """The PNG of tile `z/x/y` of `dataset`, transparent outside the raster and for unstyled classes."""
+        with metrics.span('render_tile', dataset):
+            codes, valid = self._sample(dataset, z, x, y)
+            if not valid.any():
+                return empty_tile()
+
+            lut = get_dataset(dataset).rgba_lut
+            valid &= (codes >= 0) & (codes < lut.shape[0])
+            rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+            rgba[valid] = lut[codes[valid]]
+            return _encode(rgba)
+
+    def _sample(self, dataset: str, z: int, x: int, y: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Class codes at the pixel centres of the tile, and where they fall on the raster."""
+        from rasterio.enums import Resampling
+        from rasterio.windows import Window
+
+        src = self._open(dataset)
+        transform = src.transform
+        lon, lat = tile_centers(z, x, y)
+        cols = np.floor((lon - transform.c) / transform.a).astype(np.int64)
+        rows = np.floor((lat - transform.f) / transform.e).astype(np.int64)
+        valid_cols = (cols >= 0) & (cols < src.width)
+        valid_rows = (rows >= 0) & (rows < src.height)
+        valid = valid_rows[:, None] & valid_cols[None, :]
+        if not valid.any():
+            return np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.int64), valid
+
+        row_start, row_stop = rows[valid_rows].min(), rows[valid_rows].max() + 1
+        col_start, col_stop = cols[valid_cols].min(), cols[valid_cols].max() + 1
+        height, width = row_stop - row_start, col_stop - col_start
+        # nearest neighbour keeps the class codes intact; GDAL reads the overview closest to out_shape
+        out_shape = (min(height, MAX_READ_PIXELS), min(width, MAX_READ_PIXELS))
+        data = src.read(self.band, window=Window(col_start, row_start, width, height),
+                        out_shape=out_shape, resampling=Resampling.nearest)
+
+        row_index = np.clip((rows - row_start) * out_shape[0] // height, 0, out_shape[0] - 1)
+        col_index = np.clip((cols - col_start) * out_shape[1] // width, 0, out_shape[1] - 1)
+        codes = data[row_index[:, None], col_index[None, :]].astype(np.int64)
+        if src.nodata is not None:
+            valid &= codes != src.nodata
+        return codes, valid
+
+
+def build_overviews(raster_path: str, factors: List[int] = OVERVIEW_FACTORS) -> None:
+    """Build the internal overviews of a categorical raster, by the most frequent class of every block."""
+    import rasterio
+    from rasterio.enums import Resampling
+
+    with rasterio.open(raster_path, 'r+') as src:
+        factors = [f for f in factors if math.ceil(max(src.height, src.width) / f) >= TILE_SIZE // 4]
+        src.build_overviews(factors, Resampling.mode)
+        src.update_tags(ns='rio_overview', resampling='mode')
+    log.info(f'[build_overviews]: {raster_path} factors {factors}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the overviews the tile renderer reads at low zooms.')
+    parser.add_argument('raster', help='local GeoTIFF of a dataset in EPSG:4326, updated in place')
+    parser.add_argument('--factors', type=int, nargs='+', default=list(OVERVIEW_FACTORS),
+                        help='decimation factors of the overviews')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_overviews(args.raster, factors=args.factors)
@@ -0,0 +1,79 @@
+"""
+Process-wide registry of lazily initialised clients.
+
+Heavy clients are created on first use instead of at import time, so a cold start only pays for
+what the page renders. Every caller, in any thread or Streamlit session, shares the same instance.
+
+    openai = resources.get('openai')
+"""
+import json
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict
+
+from . import execution
+
+log = logging.getLogger(__name__)
+
+_factories: Dict[str, Callable[[], Any]] = {}
+_resources: Dict[str, Any] = {}
+_lock = threading.RLock()
+
+
+def register(name: str, factory: Callable[[], Any]) -> None:
+    """Register the factory of a resource, replacing the instance created by a previous factory."""
+    with _lock:
+        _factories[name] = factory
+        _resources.pop(name, None)
+
+
+def get(name: str) -> Any:
+    """Return the resource `name`, creating it on first use."""
+    # fast path without the lock once the resource exists
+    if name in _resources:
+        return _resources[name]
+
+    with _lock:
+        if name not in _resources:
+            log.info(f'[resources]: initialising {name}')
+            _resources[name] = _factories[name]()
+        return _resources[name]
+
+
+def reset(name: str = None) -> None:
+    """Drop one or every created resource, they are created again on next use."""
+    with _lock:
+        if name is None:
+            _resources.clear()
+        else:
+            _resources.pop(name, None)
+
+
+def _init_ee():
+    import ee
+
+    # a service account key in EE_PRIVATE_KEY takes precedence over the local credentials
+    private_key = os.getenv("EE_PRIVATE_KEY")
+    if private_key:
+        credentials = ee.ServiceAccountCredentials(email=json.loads(private_key)['client_email'],
+                                                   key_data=private_key)
+        ee.Initialize(credentials=credentials)
+    else:
+        ee.Initialize()
+    # the client gives up with the executor, so calls it abandoned do not hold a connection, see geopeto.execution
+    ee.data.setDeadline(int(execution.get_executor().timeout * 1000))
+    return ee
+
+
+def _init_openai():
+    import openai
+    from dotenv import load_dotenv
+
+    load_dotenv()  # take environment variables from .env.
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    return openai
+
+
+register('ee', _init_ee)
+register('openai', _init_openai)
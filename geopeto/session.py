@@ -0,0 +1,56 @@
+"""
+Memoization of the work of a Streamlit session across reruns.
+
+Streamlit reruns the whole script on every interaction with the page. Results, figures and the map are kept
+in the session state, keyed by the AOI they were built for, so a rerun that does not change the AOI shows
+them again without any request to Earth Engine, Nominatim or OpenAI.
+
+    results = SessionMemo(st.session_state, 'results')
+    memoized = results.get(geojson['geometry'])
+"""
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, MutableMapping
+
+
+def aoi_key(aoi: Any) -> str:
+    """Key of an AOI, or of any JSON value, the same for equal geometries whatever the order of their keys."""
+    return hashlib.sha1(json.dumps(aoi, sort_keys=True).encode()).hexdigest()
+
+
+class SessionMemo:
+    """
+    The last values of a session keyed by AOI, evicting the least recently used first.
+
+    Parameters:
+    state: MutableMapping
+        State of the session, such as st.session_state, the values survive the reruns in it.
+    name: str
+        Key of the memo in `state`.
+    maxsize: int, default 8
+        Number of AOIs remembered.
+    """
+
+    def __init__(self, state: MutableMapping, name: str, maxsize: int = 8):
+        self.maxsize = maxsize
+        if name not in state:
+            state[name] = OrderedDict()
+        self._values = state[name]
+
+    def get(self, aoi: Any) -> Any:
+        key = aoi_key(aoi)
+        if key not in self._values:
+            return None
+        self._values.move_to_end(key)
+        return self._values[key]
+
+    def set(self, aoi: Any, value: Any) -> None:
+        key = aoi_key(aoi)
+        self._values[key] = value
+        self._values.move_to_end(key)
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+
+    def __contains__(self, aoi: Any) -> bool:
+        return aoi_key(aoi) in self._values
@@ -0,0 +1,255 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional
+
+import ee
+import requests
+from cachetools import TTLCache
+
+from . import execution, metrics
+
+log = logging.getLogger(__name__)
+
+# Earth Engine map ids stay valid for a few hours, refresh them well before that
+MAP_ID_TTL = 60 * 60
+
+_map_ids = TTLCache(maxsize=64, ttl=MAP_ID_TTL)
+_map_ids_lock = threading.Lock()
+
+
+def get_tile_url(image: ee.Image, sld_interval: str, name: str) -> str:
+    """
+    Return the XYZ url template of an Earth Engine image styled with `sld_interval`.
+
+    The template is cached per layer name and style for MAP_ID_TTL seconds, so Streamlit reruns
+    do not request a new map id from Earth Engine every time a widget changes.
+    """
+    key = (name, sld_interval)
+    with _map_ids_lock:
+        url = _map_ids.get(key)
+    metrics.cache_lookup('map_id', url is not None)
+    if url is not None:
+        return url
+
+    with metrics.span('get_map_id', name):
+        # errors are counted by the executor
+        mapid = execution.get_executor().run(image.sldStyle(sld_interval).getMapId, 'getMapId')
+    url = mapid['tile_fetcher'].url_format
+    log.info(f'[get_tile_url]: new map id for {name}')
+
+    with _map_ids_lock:
+        _map_ids[key] = url
+    return url
+
+
+class TileCache:
+    """
+    Size-bounded on-disk cache of map tiles, evicting the least recently used tiles first.
+
+    Parameters:
+    directory: str
+        Directory where tiles are stored as `<layer>/<z>/<x>/<y>.png`.
+    max_bytes: int, default 1 GiB
+        Maximum size of the cached tiles.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._sizes = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self._scan()
+
+    def path(self, layer: str, z: int, x: int, y: int) -> str:
+        return os.path.join(self.directory, layer, str(z), str(x), f'{y}.png')
+
+    def get(self, layer: str, z: int, x: int, y: int) -> Optional[bytes]:
+        path = self.path(layer, z, x, y)
+        with self._lock:
+            if path not in self._sizes:
+                self.misses += 1
+                return None
+            self._sizes.move_to_end(path)
+            self.hits += 1
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            with self._lock:
+                self._forget(path)
+            return None
+
+    def set(self, layer: str, z: int, x: int, y: int, content: bytes) -> None:
+        path = self.path(layer, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._forget(path)
+            self._sizes[path] = len(content)
+            self._total += len(content)
+            while self._total > self.max_bytes and len(self._sizes) > 1:
+                evicted, _ = next(iter(self._sizes.items()))
+                self._forget(evicted)
+                try:
+                    os.remove(evicted)
+                except OSError:
+                    pass
+
+    def _forget(self, path: str):
+        size = self._sizes.pop(path, None)
+        if size is not None:
+            self._total -= size
+
+    def _scan(self):
+        # rebuild the recency order from the access times of the tiles left by a previous process
+        tiles = []
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith('.png'):
+                    path = os.path.join(root, file)
+                    stat = os.stat(path)
+                    tiles.append((stat.st_atime, path, stat.st_size))
+        for _, path, size in sorted(tiles):
+            self._sizes[path] = size
+            self._total += size
+
+
+class TileProxy:
+    """
+    Local HTTP endpoint serving `/tiles/<layer>/<z>/<x>/<y>` from a TileCache, fetching missing tiles upstream.
+
+    Layers are registered with a callable returning their current upstream url template, so expired
+    Earth Engine map ids are refreshed transparently, or with a callable rendering their tiles locally,
+    see geopeto.render. The style of a layer is part of its name in the urls and in the cache, so a
+    restyled layer is never served the tiles of its previous style.
+
+    Parameters:
+    cache: TileCache
+        Cache of the tiles.
+    host: str, default "127.0.0.1"
+        Interface the server listens on.
+    port: int, default 8765
+        Port the server listens on.
+    public_url: str, optional
+        Url under which browsers reach the server, `http://<host>:<port>` if not given, on the loopback
+        interface if `host` is every interface.
+    """
+
+    def __init__(self, cache: TileCache, host: str = "127.0.0.1", port: int = 8765, public_url: str = None):
+        self.cache = cache
+        self.host = host
+        self.port = port
+        address = '127.0.0.1' if host in ('0.0.0.0', '') else host
+        self.public_url = (public_url or f'http://{address}:{port}').rstrip('/')
+        self.layers: Dict[str, Callable[[], str]] = {}
+        self.renderers: Dict[str, Callable[[int, int, int], Optional[bytes]]] = {}
+        # requests.Session is not thread-safe, every handler thread of the server gets its own
+        self._local = threading.local()
+        self._server = None
+
+    def register(self, layer: str, url_provider: Callable[[], str], style: str = '') -> str:
+        """Register a layer styled with `style`, e.g. its SLD, and return the url template browsers should use."""
+        layer = _versioned(layer, style)
+        self.layers[layer] = url_provider
+        return f'{self.public_url}/tiles/{layer}/{{z}}/{{x}}/{{y}}'
+
+    def register_renderer(self, layer: str, render: Callable[[int, int, int], Optional[bytes]],
+                          style: str = '') -> str:
+        """Register a layer whose PNG tiles are rendered by `render(z, x, y)` and return its url template."""
+        layer = _versioned(layer, style)
+        self.renderers[layer] = render
+        return f'{self.public_url}/tiles/{layer}/{{z}}/{{x}}/{{y}}'
+
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def fetch(self, layer: str, z: int, x: int, y: int) -> Optional[bytes]:
+        content = self.cache.get(layer, z, x, y)
+        if content is not None:
+            return content
+
+        if layer in self.renderers:
+            content = self.renderers[layer](z, x, y)
+            if content is not None:
+                self.cache.set(layer, z, x, y, content)
+            return content
+
+        url = self.layers[layer]().format(z=z, x=x, y=y)
+        response = self.session.get(url, timeout=30)
+        if response.status_code != 200:
+            log.error(f'[TileProxy]: {layer}/{z}/{x}/{y} failed with {response.status_code}')
+            return None
+
+        self.cache.set(layer, z, x, y, response.content)
+        return response.content
+
+    def start(self) -> 'TileProxy':
+        if self._server is not None:
+            return self
+
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                if (len(parts) != 5 or parts[0] != 'tiles' or
+                        (parts[1] not in proxy.layers and parts[1] not in proxy.renderers)):
+                    self.send_error(404)
+                    return
+                try:
+                    z, x, y = (int(part.split('.')[0]) for part in parts[2:])
+                    content = proxy.fetch(parts[1], z, x, y)
+                except (execution.CircuitOpen, execution.DeadlineExceeded) as e:
+                    # Earth Engine is failing or slow, the map id of the layer cannot be refreshed now
+                    log.warning(f'[TileProxy]: {self.path}: {e}')
+                    self.send_error(503)
+                    return
+                except Exception as e:
+                    log.error(f'[TileProxy]: {self.path} failed: {e!r}')
+                    content = None
+                if content is None:
+                    self.send_error(502)
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('Cache-Control', 'public, max-age=86400')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='geopeto-tile-proxy', daemon=True).start()
+        log.info(f'[TileProxy]: serving tiles on {self.public_url}')
+
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _versioned(layer: str, style: str) -> str:
+    return f'{layer}.{hashlib.sha1(style.encode()).hexdigest()[:12]}' if style else layer
@@ -0,0 +1,127 @@
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List
+
+from shapely.geometry import box, mapping, shape
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+# tiles reduced at the same time
+MAX_TILE_WORKERS = 8
+_tile_executor = ThreadPoolExecutor(max_workers=MAX_TILE_WORKERS, thread_name_prefix='geopeto-tile')
+
+
+def split_geometry(geometry: dict, tile_size: float) -> List[dict]:
+    """
+    Split a GeoJSON geometry into tiles of `tile_size` degrees.
+
+    Tiles are aligned to a global grid, so the interior tiles of overlapping AOIs are identical
+    and their results can be reused from the cache.
+    """
+    aoi = shape(geometry)
+    min_x, min_y, max_x, max_y = aoi.bounds
+    is_rectangle = aoi.equals(aoi.envelope)
+
+    tiles = []
+    for i in range(math.floor(min_x / tile_size), math.ceil(max_x / tile_size)):
+        for j in range(math.floor(min_y / tile_size), math.ceil(max_y / tile_size)):
+            tile = box(i * tile_size, j * tile_size, (i + 1) * tile_size, (j + 1) * tile_size)
+            tile = tile.intersection(aoi.envelope if is_rectangle else aoi)
+            if tile.is_empty or tile.area == 0:
+                continue
+            if is_rectangle:
+                # keep the tiles as clean rectangles, intersection may rotate their vertices
+                tile = box(*tile.bounds)
+            tiles.append(mapping(tile))
+
+    return tiles
+
+
+def is_statistics(value) -> bool:
+    """Whether `value` holds the statistics of a continuous band, see processing.serialize_statistics."""
+    return isinstance(value, dict) and 'count' in value
+
+
+def merge_statistics(statistics: List[dict]) -> dict:
+    """
+    Combine the statistics of a continuous band over several tiles.
+
+    Count, mean, standard deviation, min and max are exact. Percentiles cannot be combined from those of the
+    tiles, they are approximated by their mean weighted by the pixel count.
+    """
+    statistics = [s for s in statistics if s.get('count')]
+    if not statistics:
+        return {'count': 0.}
+
+    count = sum(s['count'] for s in statistics)
+    mean = sum(s['count'] * s['mean'] for s in statistics) / count
+    # the variance of every tile around the overall mean
+    variance = sum(s['count'] * ((s.get('stdDev') or 0.) ** 2 + (s['mean'] - mean) ** 2) for s in statistics) / count
+    merged = {'count': count, 'mean': mean, 'stdDev': math.sqrt(variance),
+              'min': min(s['min'] for s in statistics), 'max': max(s['max'] for s in statistics)}
+    for key in statistics[0]:
+        if key not in merged:
+            having = [s for s in statistics if key in s]
+            merged[key] = sum(s['count'] * s[key] for s in having) / sum(s['count'] for s in having)
+    return merged
+
+
+def merge_histograms(histograms: List[dict]) -> dict:
+    """
+    Add up nested frequency histograms, e.g. `{'b1': {'10': 3}}` or `{dataset: {'b1': {...}}}`.
+
+    The statistics of continuous bands they hold are combined with merge_statistics.
+    """
+    merged, nested = {}, {}
+    for histogram in histograms:
+        for key, value in histogram.items():
+            if isinstance(value, dict):
+                nested.setdefault(key, []).append(value)
+            elif value is not None:
+                merged[key] = merged.get(key, 0) + value
+    for key, values in nested.items():
+        merged[key] = merge_statistics(values) if any(map(is_statistics, values)) else merge_histograms(values)
+    return merged
+
+
+def scale_histograms(histogram: dict, factor: float) -> dict:
+    """Multiply every count of a nested frequency histogram by `factor`, e.g. to convert them to finer pixels."""
+    if is_statistics(histogram):
+        return {**histogram, 'count': histogram['count'] * factor}
+    return {key: scale_histograms(value, factor) if isinstance(value, dict) else value * factor
+            for key, value in histogram.items() if value is not None}
+
+
+def compute_all(compute: Callable[[dict], dict], geometries: List[dict]) -> List[dict]:
+    """Run `compute` on every geometry in parallel on the tile workers, the results in the same order."""
+    futures = [_tile_executor.submit(metrics.bind(compute), geometry) for geometry in geometries]
+    return [future.result() for future in futures]
+
+
+def reduce_tiles(compute: Callable[[dict], dict], geometry: dict, tile_size: float,
+                 on_progress: Callable[[int, int], None] = None) -> dict:
+    """
+    Reduce `geometry` tile by tile in parallel with `compute` and merge the histograms.
+
+    Histograms are additive, so the result is the same as reducing the whole geometry at once.
+    `on_progress(done, total)` is called from the calling thread after each tile.
+    Returns an empty dict if any tile failed, like a failed single request.
+    """
+    tiles = split_geometry(geometry, tile_size)
+    log.info(f'[reduce_tiles]: {len(tiles)} tiles of {tile_size} degrees')
+
+    futures = [_tile_executor.submit(metrics.bind(compute), tile) for tile in tiles]
+    histograms = []
+    for done, future in enumerate(as_completed(futures), start=1):
+        histograms.append(future.result())
+        if on_progress is not None:
+            on_progress(done, len(tiles))
+
+    if not all(histograms):
+        log.error('[reduce_tiles]: at least one tile failed.')
+        return {}
+
+    return merge_histograms(histograms)
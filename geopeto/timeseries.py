@@ -0,0 +1,227 @@
+"""
+Land cover change over the years of an annual image collection: per-year histograms and transition matrix.
+"""
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import ee
+import numpy as np
+from shapely.geometry import shape
+
+from . import execution, metrics
+from .cache import ResultCache, normalize_geometry
+from .data import GEEData
+from .processing import FALLBACK_FACTORS, ZonalStatistics, reduce_region_params, serialize_output, summarize
+from .registry import METRES_PER_DEGREE, get_dataset
+from .utils import get_region
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class ChangeResult:
+    # percentage of the area covered by each class name, per year, None for the years that failed
+    years: Dict[int, Optional[Dict[str, float]]] = field(default_factory=dict)
+    # percentage of the area going from a class name of the first year to a class name of the last year,
+    # None if they failed
+    transitions: Optional[Dict[str, Dict[str, float]]] = field(default_factory=dict)
+    # what produced the histograms, see execution.Outcome
+    path: Optional[str] = None
+
+    @property
+    def failed(self) -> bool:
+        # a region without valid pixels, e.g. in the ocean, has empty percentages and transitions
+        return not self.years or any(stats is None for stats in self.years.values()) or self.transitions is None
+
+
+def transition_counts(response: dict) -> Dict[str, Dict[str, float]]:
+    """Convert the response of a frequencyHistogram grouped by the class of the first year to `{from: {to: count}}`."""
+    return {str(int(group['from'])): serialize_output({'b1': group['histogram']})
+            for group in response.get('groups', [])}
+
+
+def transition_percentages(spec, counts: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """Convert `{from code: {to code: count}}` to the percentage of the total per pair of class names."""
+    n = spec.codes.size
+    matrix = np.zeros((n, n), dtype=np.float64)
+    for from_code, histogram in counts.items():
+        code = int(from_code)
+        if not 0 <= code < spec.index_lut.size or spec.index_lut[code] < 0:
+            continue
+        matrix[spec.index_lut[code]] = spec.count_vector(histogram)
+
+    total = matrix.sum()
+    if not total:
+        return {}
+    transitions = {}
+    for i, j in zip(*np.nonzero(matrix)):
+        # classes sharing a name are added up
+        row = transitions.setdefault(spec.names[i], {})
+        row[spec.names[j]] = row.get(spec.names[j], 0.) + float(matrix[i, j] / total * 100)
+    return transitions
+
+
+class LandCoverChange:
+    """
+    Per-year class histograms and transition matrix of a time series dataset.
+
+    Parameters:
+    dataset: str, default "Global-Land-Cover"
+        Dataset with annual images, see `DatasetSpec.years`.
+    cache: ResultCache, optional
+        Cache of the per-year histograms and of the transitions, shared with ZonalStatistics.
+    cache_grid: float, default 0.01
+        Grid size, in degrees, the geometry is snapped to when used as a cache key.
+    best_effort: bool, default True
+        Let Earth Engine coarsen the resolution of large areas.
+    scale: float, optional
+        Reduce at this many metres instead of the native scale.
+    """
+
+    def __init__(self, dataset: str = 'Global-Land-Cover', cache: ResultCache = None, cache_grid: float = 0.01,
+                 best_effort: bool = True, scale: float = None):
+        self.dataset = dataset
+        self.spec = get_dataset(dataset)
+        self.cache = cache
+        self.cache_grid = cache_grid
+        self.best_effort = best_effort
+        self.scale = scale
+
+    def zonal_statistics(self, year: Optional[int]) -> ZonalStatistics:
+        return ZonalStatistics(GEEData(self.dataset, year), cache=self.cache, cache_grid=self.cache_grid,
+                               best_effort=self.best_effort, scale=self.scale)
+
+    def check_years(self, years: List[int]):
+        unknown = sorted(set(years) - set(self.spec.years))
+        if unknown:
+            raise ValueError(f'{self.dataset} has no image for {", ".join(map(str, unknown))}')
+        if len(set(years)) < 2:
+            raise ValueError('At least two years are needed to analyse a change.')
+
+    def compute(self, geometry: dict, years: List[int]) -> ChangeResult:
+        """
+        Percentages per year and transitions between the first and the last of `years`.
+
+        Reduced again at the coarser scales of FALLBACK_FACTORS if Earth Engine exceeds a limit.
+        """
+        years = sorted(set(years))
+        self.check_years(years)
+        with metrics.span('land_cover_change', self.dataset, shape(geometry).area), \
+                execution.outcome() as outcome:
+            try:
+                result = self._compute(geometry, years)
+            except execution.LimitExceeded as e:
+                result = self._compute_coarser(geometry, years, e)
+        result.path = outcome.describe()
+        return result
+
+    def _compute(self, geometry: dict, years: List[int]) -> ChangeResult:
+        histograms = self.histograms(geometry, years)
+        transitions = self.transitions(geometry, years[0], years[-1])
+        return ChangeResult(
+            years={year: summarize(histograms[year], GEEData(self.dataset, year)) for year in years},
+            transitions=transition_percentages(self.spec, transitions) if transitions is not None else None)
+
+    def _compute_coarser(self, geometry: dict, years: List[int], error: execution.LimitExceeded) -> ChangeResult:
+        # percentages do not depend on the size of the pixels, the counts need no scaling
+        pixel_size = self.zonal_statistics(None).pixel_size
+        for factor in FALLBACK_FACTORS:
+            coarser = LandCoverChange(self.dataset, cache=self.cache, cache_grid=self.cache_grid,
+                                      best_effort=self.best_effort, scale=pixel_size * METRES_PER_DEGREE * factor)
+            log.warning(f'[LandCoverChange]: {error.reason}, retrying at {coarser.scale:,.0f} m')
+            metrics.SCALE_FALLBACKS.labels(self.dataset).inc()
+            try:
+                result = coarser._compute(geometry, years)
+            except execution.LimitExceeded as e:
+                error = e
+                continue
+            if not result.failed:
+                execution.record(f'coarser scale of {coarser.scale:,.0f} m after {error.reason}')
+            return result
+
+        log.error(f'[LandCoverChange]: {error.reason} at every scale.')
+        execution.record(f'failed: {error.reason}')
+        return ChangeResult()
+
+    def histograms(self, geometry: dict, years: List[int]) -> Dict[int, dict]:
+        """Raw `{'b1': histogram}` of every year, the missing ones reduced with one request."""
+        stats, keys = {}, {}
+        if self.cache is not None:
+            for year in years:
+                keys[year] = self.zonal_statistics(year).cache_key(geometry)
+                cached = self.cache.get(keys[year])
+                metrics.cache_lookup('zonal_statistics', cached is not None)
+                if cached is not None:
+                    stats[year] = cached
+
+        missing = [year for year in years if year not in stats]
+        if missing:
+            log.info(f'[LandCoverChange]: reducing {missing}, {len(stats)} years cached')
+            computed = self._reduce_years(geometry, missing)
+            for year in missing:
+                stats[year] = computed.get(year, {})
+                if self.cache is not None and stats[year]:
+                    self.cache.set(keys[year], stats[year])
+        if len(missing) < len(years):
+            execution.record('cache')
+
+        return stats
+
+    def transitions(self, geometry: dict, first: int, last: int) -> Optional[Dict[str, Dict[str, float]]]:
+        """Raw `{from code: {to code: count}}` of the pixels between the `first` and the `last` year, None if failed."""
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(*self.zonal_statistics(None).setting()[:-1], self.dataset,
+                                      f'transition={first}-{last}',
+                                      normalize_geometry(geometry, grid=self.cache_grid))
+            cached = self.cache.get(key)
+            metrics.cache_lookup('zonal_statistics', cached is not None)
+            if cached is not None:
+                execution.record('cache')
+                return cached
+
+        counts = self._reduce_transitions(geometry, first, last)
+        if key is not None and counts is not None:
+            self.cache.set(key, counts)
+        return counts
+
+    def _region(self, geometry: dict):
+        pixel_size = self.zonal_statistics(None).pixel_size
+        return get_region(geometry, pixel_size)
+
+    def _reduce_years(self, geometry: dict, years: List[int]) -> Dict[int, dict]:
+        # band names are positional, like the stacked image of CombinedZonalStatistics
+        img = ee.Image.cat([GEEData(self.dataset, year).ee_image().select(0).rename(f'b{i}')
+                            for i, year in enumerate(years)])
+        if self.best_effort and self.scale is None:
+            metrics.BEST_EFFORT.labels(self.dataset).inc()
+        request = img.reduceRegion(**reduce_region_params(self._region(geometry), self.best_effort, self.scale))
+        stats = self._run(request)
+        # a failed request leaves the histograms empty, one without valid pixels has bands without classes
+        if not stats:
+            return {}
+        return {year: {'b1': stats.get(f'b{i}') or {}} for i, year in enumerate(years)}
+
+    def _reduce_transitions(self, geometry: dict, first: int, last: int) -> Optional[Dict[str, Dict[str, float]]]:
+        # the histogram of the class of the last year, band 0, grouped by the class of the first year, band 1
+        img = (GEEData(self.dataset, last).ee_image().select(0).rename('to')
+               .addBands(GEEData(self.dataset, first).ee_image().select(0).rename('from')))
+        params = reduce_region_params(self._region(geometry), self.best_effort, self.scale)
+        params['reducer'] = ee.Reducer.frequencyHistogram().group(groupField=1, groupName='from')
+        response = self._run(img.reduceRegion(**params))
+        return transition_counts(response) if response else None
+
+    def _run(self, request) -> dict:
+        """The answer of a reduceRegion `request`, empty if it failed; LimitExceeded is raised for a coarser scale."""
+        try:
+            response = execution.get_executor().run(request.getInfo, 'reduceRegion')
+        except execution.LimitExceeded:
+            raise
+        except Exception as e:
+            log.error(f'[LandCoverChange]: EE failed: {e}')
+            execution.record(f'failed: {e}')
+            return {}
+
+        execution.record('Earth Engine')
+        return response or {}
@@ -1,12 +1,24 @@
 import ee
 
+from . import resources
+from .geometry import simplify
 
-def get_region(geom):
+
+def get_region(geom, pixel_size: float = None):
     """Take a valid geojson object, get the feature in that object.
         Build up a EE Polygons, and finally return an EE Feature
         collection.)
+        If `pixel_size` is given, in degrees, the geometry is first simplified to that resolution.
+        Edges are straight lines in EPSG:4326, like those drawn on the map, not geodesics: the strips and
+        tiles of a region then cover exactly the region, see geopeto.incremental and geopeto.tiling.
     """
+    resources.get('ee')  # initialise Earth Engine on first use
+    if pixel_size:
+        geom = simplify(geom, pixel_size)
     polygons = []
     coordinates = geom.get('coordinates')
-    polygons.append(ee.Geometry.Polygon(coordinates))
+    if geom.get('type') == 'MultiPolygon':
+        polygons.append(ee.Geometry.MultiPolygon(coordinates, None, False))
+    else:
+        polygons.append(ee.Geometry.Polygon(coordinates, None, False))
     return ee.FeatureCollection(polygons)
@@ -1,23 +1,29 @@
 import logging
-from math import sqrt
-from typing import List
+
+import numpy as np
+from shapely.geometry import shape
 
 log = logging.getLogger(__name__)
 
 
-def _get_distance(c1: List[float], c2: List[float]) -> float:
-    return sqrt((c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2)
+def coordinates_array(geometry: dict) -> np.ndarray:
+    """All the vertices of a GeoJSON Polygon or MultiPolygon as an (n, 2) array of lon, lat."""
+    coordinates = geometry["coordinates"]
+    if geometry.get("type") == "MultiPolygon":
+        rings = [ring for polygon in coordinates for ring in polygon]
+    else:
+        rings = coordinates
+    if not rings:
+        return np.empty((0, 2))
+    return np.concatenate([np.asarray(ring, dtype=float)[:, :2] for ring in rings])
 
 
-def _get_area(bbox: List[List[float]]) -> float:
-    width = _get_distance(c1=bbox[0], c2=bbox[1])
-    height = _get_distance(c1=bbox[1], c2=bbox[2])
-    return round(abs(width * height), 2)
+def _get_area(geometry: dict) -> float:
+    return round(shape(geometry).area, 2)
 
 
 def selected_bbox_too_large(geometry: dict, threshold: float) -> bool:
-    bbox = geometry["coordinates"][0]
-    area = _get_area(bbox=bbox)
+    area = _get_area(geometry)
     log.info(f"📏  area with size: {area} was selected, threshold is: {threshold}")
     return area > threshold
 
@@ -30,12 +36,9 @@ class CoordinateBoundaries:
 
 
 def selected_bbox_in_boundary(geometry: dict, boundary: CoordinateBoundaries = CoordinateBoundaries) -> bool:
-    bbox = geometry["coordinates"][0]
-    for coordinate in bbox:
-        lon = coordinate[0]
-        lat = coordinate[1]
-        if lon < boundary.lon_min or lon > boundary.lon_max:
-            return False
-        elif lat < boundary.lat_min or lat > boundary.lat_max:
-            return False
-    return True
\ No newline at end of file
+    coordinates = coordinates_array(geometry)
+    lon, lat = coordinates[:, 0], coordinates[:, 1]
+    # regions drawn across the antimeridian, or on a copy of the world, are wrapped back by
+    # geometry.prepare_aoi, so only their extent in longitude is limited
+    return bool(((lat >= boundary.lat_min) & (lat <= boundary.lat_max)).all() and
+                lon.max() - lon.min() < boundary.lon_max - boundary.lon_min)
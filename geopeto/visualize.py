@@ -1,14 +1,21 @@
+from functools import partial
 from typing import List
 
 import ee
 import folium
-import pandas as pd
 from folium.plugins import Draw
 from branca.element import MacroElement
-from plotly import express as px
-import ipyleaflet as ipyl
 
-from .data import GEEData
+from . import metrics
+from .tiles import TileProxy, get_tile_url
+
+
+def __getattr__(name):
+    # ipyleaflet is only needed by the notebooks, import it when ipyleafletMapGEE is first accessed
+    if name == 'ipyleafletMapGEE':
+        from .visualize_ipyleaflet import ipyleafletMapGEE
+        return ipyleafletMapGEE
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class foliumMapGEE(folium.Map):
@@ -46,7 +53,7 @@ class foliumMapGEE(folium.Map):
                 "polyline": False,
                 "poly": False,
                 "circle": False,
-                "polygon": False,
+                "polygon": True,
                 "marker": False,
                 "circlemarker": False,
                 "rectangle": True
@@ -69,7 +76,7 @@ class foliumMapGEE(folium.Map):
 
         self.add_child(MacroElement().add_child(folium.Html(js)))
         
-    def add_gee_layer(self, image: ee.Image, sld_interval: str, name: str):
+    def add_gee_layer(self, image: ee.Image, sld_interval: str, name: str, tile_proxy: TileProxy = None):
         """
         Add GEE layer to map.
 
@@ -77,13 +84,39 @@ class foliumMapGEE(folium.Map):
         image (ee.Image): The Earth Engine image to display.
         sld_interval (str): SLD style of discrete intervals to apply to the image.
         name (str): lLayer name.
+        tile_proxy (TileProxy): Optional local proxy caching the tiles on disk.
+        """
+        # map ids are cached, so reruns of the page do not request a new one
+        if tile_proxy is not None:
+            tiles_url = tile_proxy.register(name, lambda: get_tile_url(image, sld_interval, name),
+                                            style=sld_interval)
+        else:
+            tiles_url = get_tile_url(image, sld_interval, name)
+
+        self.add_tile_layer(tiles_url, name)
+
+    def add_local_layer(self, renderer, dataset: str, tile_proxy: TileProxy):
+        """
+        Add a layer rendered from the local raster of a dataset instead of Earth Engine.
+
+        Parameters:
+        renderer (TileRenderer): Renderer of the tiles, see geopeto.render.
+        dataset (str): Dataset name, also the layer name.
+        tile_proxy (TileProxy): Local server the tiles are rendered by and cached in.
+        """
+        # the cache of the proxy is per layer, so the rendered tiles never mix with the Earth Engine ones
+        tiles_url = tile_proxy.register_renderer(f'{dataset}.local', partial(renderer.render, dataset),
+                                                 style=renderer.style(dataset))
+        self.add_tile_layer(tiles_url, dataset)
+
+    def add_tile_layer(self, tiles_url: str, name: str):
+        """
+        Add an XYZ tile layer to map.
+
+        Parameters:
+        tiles_url (str): Url template of the tiles.
+        name (str): Layer name.
         """
-        ee_tiles = '{tile_fetcher.url_format}'
-        
-        image = image.sldStyle(sld_interval)
-        mapid = image.getMapId()
-        tiles_url = ee_tiles.format(**mapid)
-        
         tile_layer = folium.TileLayer(
             tiles=tiles_url, 
             name=name,
@@ -95,102 +128,36 @@ class foliumMapGEE(folium.Map):
         
         tile_layer.add_to(self)
         
-    def add_layer_control(self):
-        control = folium.LayerControl(position='topright')
-        
-        control.add_to(self)
-        
-
-class ipyleafletMapGEE(ipyl.Map):
-    """
-    A custom Map class that can display Google Earth Engine tiles.
-
-    Inherits from ipyl.Map class.
-    """
-
-    def __init__(self,  geometry=None,  center: List[float] = [25.0, 55.0], zoom: int = 3, **kwargs):
+    def add_aoi(self, geometry: dict, name: str = "Uploaded region"):
         """
-        Constructor for MapGEE class.
+        Outline a region, e.g. an uploaded AOI, on the map.
 
         Parameters:
-        geometry : GeoJSON
-            GeoJSON with a polygon.
-        center: list, default [25.0, 55.0]
-            The current center of the map.
-        zoom: int, default 3
-            The current zoom value of the map.
-        **kwargs: Additional arguments that are passed to the parent constructor.
+        geometry (dict): GeoJSON Polygon or MultiPolygon.
+        name (str): Layer name.
         """
-        self.center = center
-        self.zoom = zoom
-        self.geometry = geometry
-        super().__init__(basemap=ipyl.basemap_to_tiles(ipyl.basemaps.OpenStreetMap.Mapnik),
-                         center=self.center, zoom=self.zoom, **kwargs)
-        
-        self.add_draw_control()
+        folium.GeoJson(
+            geometry,
+            name=name,
+            style_function=lambda feature: {'color': '#2BA4A0', 'weight': 2, 'fillOpacity': 0}
+            ).add_to(self)
+
+    def add_layer_control(self):
+        control = folium.LayerControl(position='topright')
         
-    def add_draw_control(self):
-        control = ipyl.LayersControl(position='topright')
-        self.add_control(control)
+        control.add_to(self)
         
-        if self.geometry:
-            self.geometry['features'][0]['properties'] = {'style': {'color': "#2BA4A0", 'opacity': 1, 'fillOpacity': 0}}
-            geo_json = ipyl.GeoJSON(
-                data=self.geometry
-            )
-            self.add_layer(geo_json)
-
-        else:
-            # Add DrawControl
-            print('Draw a rectangle on map to select and area.')
-
-            draw_control = ipyl.DrawControl(position='topleft')
-            draw_control.display_iframe = True
-
-            draw_control.rectangle = {
-                "shapeOptions": {
-                    "color": "#2BA4A0",
-                    "fillOpacity": 0,
-                    "opacity": 1
-                }
-            }
 
-            feature_collection = {
-                'type': 'FeatureCollection',
-                'features': []
-            }
-
-            def handle_draw(self, action, geo_json):
-                """Do something with the GeoJSON when it's drawn on the map"""    
-                # feature_collection['features'].append(geo_json)
-                feature_collection['features'] = geo_json
-
-            draw_control.on_draw(handle_draw)
-            self.add_control(draw_control)
+def create_stacked_bar(values, colors):
+    with metrics.span('chart'):
+        return _create_stacked_bar(values, colors)
 
-            self.geometry = feature_collection
-    
-    def add_gee_layer(self, image: ee.Image, sld_interval: str, name: str):
-        """
-        Add GEE layer to map.
 
-        Parameters:
-        image (ee.Image): The Earth Engine image to display.
-        sld_interval (str): SLD style of discrete intervals to apply to the image.
-        name (str): lLayer name.
-        """
-        ee_tiles = '{tile_fetcher.url_format}'
-        
-        image = image.sldStyle(sld_interval)
-        mapid = image.getMapId()
-        tiles_url = ee_tiles.format(**mapid)
-        
-        tile_layer = ipyl.TileLayer(url=tiles_url, name=name)
-        
-        self.add_layer(tile_layer)
-    
+def _create_stacked_bar(values, colors):
+    # plotly express and pandas are only needed once statistics have been computed
+    import pandas as pd
+    from plotly import express as px
 
-def create_stacked_bar(values, colors):
     # create a DataFrame with the items of the values dictionary
     df = pd.DataFrame(list(values.items()), columns=["label", "value"])
     df['y_axis'] = ' '
@@ -217,3 +184,44 @@ def create_stacked_bar(values, colors):
     fig.update_yaxes(title=None)
 
     return fig
+
+
+def create_change_chart(years, colors):
+    """Area chart of the percentage covered by each class per year, from `ChangeResult.years`."""
+    with metrics.span('chart'):
+        import pandas as pd
+        from plotly import express as px
+
+        df = pd.DataFrame([{'year': year, 'label': label, 'value': value}
+                           for year, stats in years.items() for label, value in stats.items()])
+        fig = px.area(df, x='year', y='value', color='label', color_discrete_map=colors,
+                      hover_data={'value': ':,.2f'})
+        fig.update_layout(title="Land cover per year", showlegend=False, height=300)
+        fig.update_xaxes(title=None, dtick=1)
+        fig.update_yaxes(title=None, ticksuffix='%')
+        return fig
+
+
+def create_transition_table(transitions):
+    """Table of the percentage of the area per class of the first year (rows) and of the last year (columns)."""
+    import pandas as pd
+
+    df = pd.DataFrame(transitions).T.fillna(0.)
+    # largest classes first, on both axes
+    df = df.loc[df.sum(axis=1).sort_values(ascending=False).index, df.sum().sort_values(ascending=False).index]
+    return df.round(2)
+
+
+def create_statistics_table(statistics, units):
+    """Table of the statistics of the continuous datasets, one row per dataset, labelled with its unit."""
+    import pandas as pd
+
+    rows = {}
+    for dataset, stats in statistics.items():
+        percentiles = sorted((key for key in stats if key[:1] == 'p' and key[1:].isdigit()), key=lambda k: int(k[1:]))
+        columns = [('mean', 'Mean'), ('stdDev', 'Std. dev.'), ('min', 'Min')] + \
+                  [(key, 'Median' if key == 'p50' else key.upper()) for key in percentiles] + [('max', 'Max')]
+        label = f'{dataset} ({units[dataset]})' if units.get(dataset) else dataset
+        # a region without valid pixels only has a count of 0, its row stays empty
+        rows[label] = {name: stats.get(key) for key, name in columns}
+    return pd.DataFrame(rows).T.round(2)
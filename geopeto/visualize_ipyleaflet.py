@@ -0,0 +1,91 @@
+from typing import List
+
+import ee
+import ipyleaflet as ipyl
+
+from .tiles import get_tile_url
+
+
+class ipyleafletMapGEE(ipyl.Map):
+    """
+    A custom Map class that can display Google Earth Engine tiles.
+
+    Inherits from ipyl.Map class.
+    """
+
+    def __init__(self,  geometry=None,  center: List[float] = [25.0, 55.0], zoom: int = 3, **kwargs):
+        """
+        Constructor for MapGEE class.
+
+        Parameters:
+        geometry : GeoJSON
+            GeoJSON with a polygon.
+        center: list, default [25.0, 55.0]
+            The current center of the map.
+        zoom: int, default 3
+            The current zoom value of the map.
+        **kwargs: Additional arguments that are passed to the parent constructor.
+        """
+        self.center = center
+        self.zoom = zoom
+        self.geometry = geometry
+        super().__init__(basemap=ipyl.basemap_to_tiles(ipyl.basemaps.OpenStreetMap.Mapnik),
+                         center=self.center, zoom=self.zoom, **kwargs)
+        
+        self.add_draw_control()
+        
+    def add_draw_control(self):
+        control = ipyl.LayersControl(position='topright')
+        self.add_control(control)
+        
+        if self.geometry:
+            self.geometry['features'][0]['properties'] = {'style': {'color': "#2BA4A0", 'opacity': 1, 'fillOpacity': 0}}
+            geo_json = ipyl.GeoJSON(
+                data=self.geometry
+            )
+            self.add_layer(geo_json)
+
+        else:
+            # Add DrawControl
+            print('Draw a rectangle on map to select and area.')
+
+            draw_control = ipyl.DrawControl(position='topleft')
+            draw_control.display_iframe = True
+
+            draw_control.rectangle = {
+                "shapeOptions": {
+                    "color": "#2BA4A0",
+                    "fillOpacity": 0,
+                    "opacity": 1
+                }
+            }
+
+            feature_collection = {
+                'type': 'FeatureCollection',
+                'features': []
+            }
+
+            def handle_draw(self, action, geo_json):
+                """Do something with the GeoJSON when it's drawn on the map"""    
+                # feature_collection['features'].append(geo_json)
+                feature_collection['features'] = geo_json
+
+            draw_control.on_draw(handle_draw)
+            self.add_control(draw_control)
+
+            self.geometry = feature_collection
+    
+    def add_gee_layer(self, image: ee.Image, sld_interval: str, name: str):
+        """
+        Add GEE layer to map.
+
+        Parameters:
+        image (ee.Image): The Earth Engine image to display.
+        sld_interval (str): SLD style of discrete intervals to apply to the image.
+        name (str): lLayer name.
+        """
+        tiles_url = get_tile_url(image, sld_interval, name)
+        
+        tile_layer = ipyl.TileLayer(url=tiles_url, name=name)
+        
+        self.add_layer(tile_layer)
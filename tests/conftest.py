@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from geopeto.backends import LocalRasterBackend
+from geopeto.data import GEEData
+
+
+@pytest.fixture(scope='session')
+def land_cover(tmp_path_factory):
+    """A random land cover raster of 0.01 degree pixels over [0, 6] x [40, 44], and its backend."""
+    rasterio = pytest.importorskip('rasterio')
+    from rasterio.transform import from_origin
+
+    path = str(tmp_path_factory.mktemp('rasters') / 'land_cover.tif')
+    codes = GEEData('Global-Land-Cover').spec.codes
+    data = np.random.default_rng(0).choice(codes, size=(400, 600)).astype('uint8')
+    with rasterio.open(path, 'w', driver='GTiff', height=400, width=600, count=1, dtype='uint8',
+                       crs='EPSG:4326', transform=from_origin(0, 44, 0.01, 0.01)) as dst:
+        dst.write(data, 1)
+    return GEEData('Global-Land-Cover'), LocalRasterBackend({'Global-Land-Cover': path})
@@ -0,0 +1,40 @@
+import dataclasses
+
+import pytest
+from shapely.geometry import box, mapping
+
+from geopeto.adaptive import AdaptiveResolution, Throughput
+from geopeto.admission import AdmissionController
+from geopeto.data import GEEData
+
+
+def test_throughput_is_an_exponential_moving_average():
+    throughput = Throughput(initial=1e6, alpha=0.5)
+    throughput.observe(3e6, 1.)
+    assert throughput.pixels_per_second == pytest.approx(2e6)
+    throughput.observe(4e6, 2.)
+    assert throughput.pixels_per_second == pytest.approx(2e6)
+    # too short to say anything of the throughput
+    throughput.observe(1e9, 0.1)
+    assert throughput.pixels_per_second == pytest.approx(2e6)
+    assert throughput.pixels_for(3.) == pytest.approx(6e6)
+
+
+def test_the_finest_scale_answering_within_the_latency_budget_is_chosen():
+    admission = AdmissionController({'Global-Land-Cover': GEEData('Global-Land-Cover')})
+    adaptive = AdaptiveResolution(admission, latency_budget=2., throughput=Throughput(initial=1e5))
+    geometry = mapping(box(0, 40, 5, 45))
+
+    plan = adaptive.plan(geometry)
+    estimate = admission.estimate(geometry)
+    ladder = admission.ladder()
+    assert plan.pixels <= 2e5
+    assert admission.pixels_at(estimate, ladder[ladder.index(plan.scale) - 1]) > 2e5
+
+    # a faster Earth Engine answers at a finer scale
+    adaptive.observe(dataclasses.replace(plan, pixels=4e6), 1.)
+    assert adaptive.plan(geometry).scale < plan.scale
+
+    refined = adaptive.refinement(geometry, plan)
+    assert refined.scale < plan.scale and refined.pixels <= admission.request_budget
+    assert adaptive.refinement(geometry, plan, remaining=0) is None
@@ -0,0 +1,42 @@
+from shapely.geometry import box, mapping
+
+from geopeto.admission import AdmissionController
+from geopeto.data import GEEData
+
+DATASETS = ['Global-Land-Cover', 'Koppen-Geiger-Climate']
+
+
+def make_admission(**budgets) -> AdmissionController:
+    return AdmissionController({dataset: GEEData(dataset) for dataset in DATASETS}, **budgets)
+
+
+def test_ladder_starts_at_the_finest_native_scale():
+    ladder = make_admission().ladder()
+    assert ladder[0] == min(GEEData(dataset).spec.nominal_scale for dataset in DATASETS)
+    assert ladder == sorted(ladder)
+
+
+def test_small_regions_are_admitted_at_native_resolution():
+    decision = make_admission().admit(mapping(box(0, 40, 1, 41)))
+    assert decision.admitted
+    assert decision.options[0].execution == 'native'
+    assert decision.options[0].pixels == decision.estimate.total
+
+
+def test_large_regions_are_offered_the_finest_scale_within_budget_or_tiles():
+    admission = make_admission(request_budget=5e6, tiled_budget=5e8, session_budget=1e9)
+    decision = admission.admit(mapping(box(0, 30, 20, 50)))
+    assert not decision.admitted
+    coarser, tiled = decision.options
+    assert coarser.execution == 'coarser' and coarser.pixels <= admission.request_budget
+    finer = admission.ladder()[admission.ladder().index(coarser.scale) - 1]
+    assert admission.pixels_at(decision.estimate, finer) > admission.request_budget
+    assert tiled.execution == 'tiled' and tiled.pixels == decision.estimate.total
+
+
+def test_the_session_budget_bounds_every_option():
+    admission = make_admission(session_budget=1e6)
+    decision = admission.admit(mapping(box(0, 40, 1, 41)), spent=1e6)
+    assert not decision.admitted
+    assert decision.options == []
+    assert 'left in this session' in decision.reason
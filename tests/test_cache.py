@@ -0,0 +1,31 @@
+import json
+
+from geopeto.cache import ResultCache, normalize_geometry
+
+
+def test_the_same_ring_from_another_corner_has_the_same_key():
+    ring = [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]
+    other = [[1.001, 1], [0, 1], [0, 0.002], [0, 0], [1, 0], [1, 1], [1.001, 1]]
+    polygon = normalize_geometry({'type': 'Polygon', 'coordinates': [ring]})
+    assert normalize_geometry({'type': 'Polygon', 'coordinates': [other]}) == polygon
+    assert normalize_geometry({'type': 'Polygon', 'coordinates': [ring[:-1]]}) == polygon
+    assert normalize_geometry({'type': 'Polygon', 'coordinates': [ring]}, grid=0.001) != \
+        normalize_geometry({'type': 'Polygon', 'coordinates': [other]}, grid=0.001)
+
+
+def test_geometry_keys_are_short_digests():
+    ring = [[x / 1000, (x * 7 % 1000) / 1000] for x in range(1000)]
+    key = normalize_geometry({'type': 'Polygon', 'coordinates': [ring + ring[:1]]}, grid=0.0001)
+    assert len(key) == 40
+
+
+def test_inserts_are_saved_together(tmp_path):
+    path = tmp_path / 'cache.json'
+    cache = ResultCache(path=str(path), save_delay=60.)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert not path.exists()
+
+    cache.flush()
+    assert json.loads(path.read_text()) == [['a', 1], ['b', 2]]
+    assert ResultCache(path=str(path)).get('b') == 2
@@ -0,0 +1,34 @@
+import threading
+import time
+
+import pytest
+
+from geopeto.geocoder import ReverseGeocodeCache, TokenBucket, tile_of
+
+
+def test_token_bucket_allows_a_burst_then_the_rate():
+    bucket = TokenBucket(rate=20., capacity=2)
+    start = time.monotonic()
+    threads = [threading.Thread(target=bucket.acquire) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # two tokens are there at once, the four others come at 20 per second
+    assert time.monotonic() - start == pytest.approx(4 / 20., abs=0.08)
+
+
+def test_cached_points_are_found_across_tile_boundaries():
+    cache = ReverseGeocodeCache(max_distance_km=5.)
+    # both sides of the boundary between two tiles of the lookup zoom
+    assert tile_of(2.80, 45.) != tile_of(2.83, 45.)
+    cache.set(2.80, 45., 'Cantal', 'France')
+    assert cache.get(2.83, 45.) == ('Cantal', 'France')
+    assert cache.get(2.90, 45.) is None
+
+
+def test_the_nearest_cached_point_wins():
+    cache = ReverseGeocodeCache(max_distance_km=50.)
+    cache.set(2.50, 45., 'Puy-de-Dome', 'France')
+    cache.set(2.85, 45., 'Cantal', 'France')
+    assert cache.get(2.80, 45.) == ('Cantal', 'France')
@@ -0,0 +1,42 @@
+import random
+
+import pytest
+from shapely.geometry import box, mapping
+
+from geopeto.incremental import LastAOI, apply_delta, subtract_rectangle
+
+
+def test_subtract_rectangle_covers_the_difference():
+    a, b = (0, 0, 4, 3), (1, -1, 5, 2)
+    strips = subtract_rectangle(a, b)
+    assert sum((s[2] - s[0]) * (s[3] - s[1]) for s in strips) == pytest.approx(12 - 6)
+    assert all(box(*s).intersection(box(*b)).area == 0 for s in strips)
+    assert subtract_rectangle(a, (10, 10, 11, 11)) == [a]
+    assert subtract_rectangle(a, (-1, -1, 5, 4)) == []
+
+
+def test_apply_delta_prunes_classes_that_cancel_out():
+    histogram = {'b1': {'10': 5, '20': 2}}
+    assert apply_delta(histogram, [{'b1': {'30': 1}}], [{'b1': {'20': 2}}]) == {'b1': {'10': 5, '30': 1}}
+
+
+def test_nudged_rectangles_match_a_full_reduction(land_cover):
+    gee_data, backend = land_cover
+    calls = []
+
+    def compute(geometry):
+        calls.append(geometry)
+        return backend.histogram(gee_data, geometry)
+
+    last_aoi = LastAOI()
+    rng = random.Random(1)
+    bounds = (1.003, 41.004, 3.007, 42.506)
+    last_aoi.reduce('setting', mapping(box(*bounds)), compute)
+    for _ in range(10):
+        # moved and resized by less than a tenth of its size, off the pixel grid
+        bounds = tuple(value + rng.uniform(-0.1, 0.1) for value in bounds)
+        calls.clear()
+        histogram = last_aoi.reduce('setting', mapping(box(*bounds)), compute)
+
+        assert all(geometry != mapping(box(*bounds)) for geometry in calls), 'reduced from scratch'
+        assert histogram == backend.histogram(gee_data, mapping(box(*bounds)))
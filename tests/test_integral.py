@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from geopeto.integral import IntegralIndex, build_index
+
+
+@pytest.fixture(scope='module')
+def index(land_cover, tmp_path_factory):
+    gee_data, backend = land_cover
+    index_dir = str(tmp_path_factory.mktemp('index'))
+    build_index(backend.paths[gee_data.dataset], gee_data, index_dir, levels=[2, 4, 6])
+    return IntegralIndex(index_dir)
+
+
+def test_blocks_and_edges_count_every_pixel_once(index):
+    import rasterio
+
+    with rasterio.open(index.metadata['raster']) as src:
+        data = src.read(1)
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        r0, r1 = sorted(rng.integers(0, data.shape[0], 2))
+        c0, c1 = sorted(rng.integers(0, data.shape[1], 2))
+        counts = np.zeros(len(index.codes), dtype=np.int64)
+        edges = index._count_blocks((r0, r1, c0, c1), list(index.levels), counts)
+
+        # no block of the finest level is left to the edges, which do not overlap the blocks
+        assert all(-(-e[0] // 4) >= e[1] // 4 or -(-e[2] // 4) >= e[3] // 4 for e in edges)
+        assert counts.sum() + sum((e[1] - e[0]) * (e[3] - e[2]) for e in edges) == (r1 - r0) * (c1 - c0)
+
+        expected = np.array([(data[r0:r1, c0:c1] == code).sum() for code in index.codes])
+        np.testing.assert_array_equal(counts + index._read_counts(edges), expected)
+
+
+def test_the_coarsest_level_covers_the_interior(index):
+    counts = np.zeros(len(index.codes), dtype=np.int64)
+    # one block of level 6, rimmed by a block of level 4 on every side
+    edges = index._count_blocks((48, 128, 48, 128), list(index.levels), counts)
+    assert edges == []
+    assert counts.sum() == 80 * 80
@@ -0,0 +1,15 @@
+from geopeto.data import GEEData
+from geopeto.pipeline import PipelineResult
+from geopeto.processing import summarize
+from geopeto.timeseries import ChangeResult
+
+
+def test_a_region_without_valid_pixels_is_not_a_failure():
+    gee_data = GEEData('Global-Land-Cover')
+    assert summarize({'b1': {}}, gee_data) == {}
+    assert summarize({}, gee_data) is None
+
+    assert not PipelineResult(stats={'Global-Land-Cover': {}, 'Koppen-Geiger-Climate': {}}).failed
+    assert PipelineResult(stats={'Global-Land-Cover': {}, 'Koppen-Geiger-Climate': None}).failed
+    assert not ChangeResult(years={2015: {}, 2018: {}}, transitions={}).failed
+    assert ChangeResult(years={2015: {}, 2018: {}}, transitions=None).failed
@@ -0,0 +1,44 @@
+import math
+
+import numpy as np
+import pytest
+from shapely.geometry import Point, mapping, shape
+from shapely.ops import unary_union
+
+from geopeto.geometry import simplify
+from geopeto.processing import ZonalStatistics
+from geopeto.tiling import merge_statistics, split_geometry
+
+
+def detailed_polygon() -> dict:
+    # a disk of 400 vertices, many more than a rectangle, over the test raster
+    return mapping(Point(3.004, 42.003).buffer(1.6, quad_segs=100))
+
+
+def test_tiles_cover_the_polygon_without_overlap():
+    aoi = shape(detailed_polygon())
+    tiles = [shape(tile) for tile in split_geometry(detailed_polygon(), 0.5)]
+    assert unary_union(tiles).symmetric_difference(aoi).area < 1e-12
+    assert sum(tile.area for tile in tiles) == pytest.approx(aoi.area)
+
+
+def test_tiled_reduction_matches_a_whole_one(land_cover):
+    gee_data, backend = land_cover
+    zs = ZonalStatistics(gee_data, backend=backend, best_effort=False)
+    geometry = detailed_polygon()
+    # the AOI is simplified once before it is split
+    whole = zs.compute(simplify(geometry, zs.pixel_size))
+    assert zs.compute_tiled(geometry, 0.5) == whole
+
+
+def test_merged_statistics_are_exact():
+    rng = np.random.default_rng(0)
+    parts = [rng.normal(size=1000) * 10, rng.normal(size=300) + 5]
+
+    def statistics(values):
+        return {'count': values.size, 'mean': values.mean(), 'stdDev': values.std(),
+                'min': values.min(), 'max': values.max()}
+
+    merged, whole = merge_statistics([statistics(part) for part in parts]), statistics(np.concatenate(parts))
+    assert all(math.isclose(merged[key], whole[key]) for key in whole)
+    assert merge_statistics([{'count': 0.}]) == {'count': 0.}
@@ -0,0 +1,43 @@
+import pytest
+from shapely.geometry import box, mapping
+
+from geopeto.cache import ResultCache
+from geopeto.registry import get_dataset
+from geopeto.timeseries import LandCoverChange, transition_counts, transition_percentages
+
+# a canned answer of the frequency histogram of the last year grouped by the class of the first one
+GROUPED_RESPONSE = {'groups': [{'from': 10, 'histogram': {'10': 30, '50.0': 10}},
+                               {'from': 50.0, 'histogram': {'50': 60}}]}
+
+
+def test_grouped_response_is_read_by_class_of_the_first_year():
+    assert transition_counts(GROUPED_RESPONSE) == {'10': {'10': 30, '50': 10}, '50': {'50': 60}}
+    assert transition_counts({'groups': []}) == {}
+
+
+def test_transition_percentages():
+    spec = get_dataset('Global-Land-Cover')
+    percentages = transition_percentages(spec, transition_counts(GROUPED_RESPONSE))
+    cropland, forest = spec.names[spec.index_lut[10]], spec.names[spec.index_lut[50]]
+    assert percentages == {cropland: {cropland: pytest.approx(30), forest: pytest.approx(10)},
+                           forest: {forest: pytest.approx(60)}}
+    assert transition_percentages(spec, {}) == {}
+
+
+def test_extended_range_only_reduces_the_new_years():
+    change = LandCoverChange(cache=ResultCache())
+    reduced = []
+
+    def reduce_years(geometry, years):
+        reduced.append(years)
+        return {year: {'b1': {'10': 1, '50': year - 2000}} for year in years}
+
+    change._reduce_years = reduce_years
+    change._reduce_transitions = lambda geometry, first, last: transition_counts(GROUPED_RESPONSE)
+    geometry = mapping(box(10, 45, 10.5, 45.5))
+
+    assert not change.compute(geometry, [2015, 2016]).failed
+    result = change.compute(geometry, [2015, 2016, 2017, 2018])
+    assert not result.failed
+    assert reduced == [[2015, 2016], [2017, 2018]]
+    assert 'cache' in result.path